@@ -0,0 +1,218 @@
+import functools
+import http.server
+import json
+import random
+import re
+import struct
+import sys
+import threading
+import time
+from common.tsmux import PAT_PID, TS_PACKET_SIZE, TS_SYNC_BYTE, crc32_mpeg2
+
+_PMT_PID = 0x1000
+_VIDEO = (0x100, 0x1b, 0xe0)  # (PID, stream type, PES stream id)
+_AUDIO = (0x101, 0x0f, 0xc0)
+
+def _ts_packets(pid, payload, cc=0, pusi=True):
+    """ Split `payload` into TS packets of the given PID; the last one is padded via the
+    adaptation field.  Returns the packets and the next continuity counter.
+    """
+    out = bytearray()
+    for off in range(0, len(payload), TS_PACKET_SIZE - 4):
+        chunk = payload[off:off + TS_PACKET_SIZE - 4]
+        hdr = bytes([TS_SYNC_BYTE, (0x40 if pusi and off == 0 else 0) | (pid >> 8), pid & 0xff])
+        pad = TS_PACKET_SIZE - 4 - len(chunk)
+        if pad:
+            af = bytes([pad - 1]) + (b'\x00' + b'\xff' * (pad - 2) if pad > 1 else b'')
+            out += hdr + bytes([0x30 | cc]) + af + chunk
+        else:
+            out += hdr + bytes([0x10 | cc]) + chunk
+        cc = (cc + 1) & 0x0f
+    return out, cc
+
+def _psi_packet(pid, tableId, body):
+    section = bytes([tableId, 0xb0 | ((len(body) + 9) >> 8), (len(body) + 9) & 0xff,
+                     0, 1, 0xc1, 0, 0]) + body
+    section += struct.pack('>I', crc32_mpeg2(section))
+    payload = b'\x00' + section
+    return bytes([TS_SYNC_BYTE, 0x40 | (pid >> 8), pid & 0xff, 0x10]) + payload \
+        + b'\xff' * (TS_PACKET_SIZE - 4 - len(payload))
+
+def _pes_header(streamId, pts):
+    return bytes([0, 0, 1, streamId, 0, 0, 0x80, 0x80, 5,
+                  0x21 | ((pts >> 29) & 0x0e), (pts >> 22) & 0xff, 0x01 | ((pts >> 14) & 0xfe),
+                  (pts >> 7) & 0xff, 0x01 | ((pts << 1) & 0xfe)])
+
+@functools.lru_cache(maxsize=64)
+def ts_segment(stream, seq, duration, frameRate, frameSize):
+    """ Generate a MPEG-TS segment that carries a single elementary stream (`_VIDEO` or `_AUDIO`)
+    of `duration * frameRate` access units of `frameSize` bytes.  Timestamps are derived from
+    `seq`, so that consecutive segments are contiguous.
+    """
+    pid, streamType, streamId = stream
+    out = bytearray(_psi_packet(PAT_PID, 0x00, struct.pack('>HH', 1, 0xe000 | _PMT_PID)))
+    out += _psi_packet(_PMT_PID, 0x02, struct.pack('>HH', 0xe000 | pid, 0xf000)
+                       + struct.pack('>BHH', streamType, 0xe000 | pid, 0xf000))
+    cc = 0
+    for i in range(int(duration * frameRate)):
+        pts = int((seq * duration + i / frameRate) * 90000) & ((1 << 33) - 1)
+        pkts, cc = _ts_packets(pid, _pes_header(streamId, pts) + bytes([i & 0xff]) * frameSize, cc)
+        out += pkts
+    return bytes(out)
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, contentType='application/vnd.apple.mpegurl', status=200):
+        server = self.server
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not server.bandwidth:
+            self.wfile.write(body)
+        else:
+            # Pace the body to `bandwidth` bytes/s
+            start = time.monotonic()
+            for off in range(0, len(body), server.CHUNK_SIZE):
+                self.wfile.write(body[off:off + server.CHUNK_SIZE])
+                ahead = start + (off + server.CHUNK_SIZE) / server.bandwidth - time.monotonic()
+                if ahead > 0:
+                    time.sleep(ahead)
+        with server.lock:
+            server.counters['requests'] += 1
+            server.counters['bytes'] += len(body)
+
+    def do_GET(self):
+        server = self.server
+        live = server.live_edge()
+        path = self.path.partition('?')[0]
+        if path == '/channels':
+            return self.send(json.dumps([{'title': server.CHANNEL, 'id': '1',
+                                          'link': {'href': '/live/1'}}]).encode(), 'application/json')
+        if path == '/live/1':
+            return self.send(json.dumps({'titulo': server.CHANNEL,
+                                         'sourcesLive': [{'src': server.url + '/master.m3u8'}]}).encode(),
+                             'application/json')
+        if path == '/master.m3u8':
+            return self.send(server.master_playlist().encode())
+
+        m = re.match(r'/(video|audio)([0-9]+)\.m3u8$', path)
+        if m and int(m[2]) < len(server.variants if m[1] == 'video' else server.audioRenditions):
+            return self.send(server.media_playlist(m[1] + m[2], live).encode())
+
+        m = re.match(r'/(video|audio)([0-9]+)-([0-9]+)\.ts$', path)
+        if m and server.first_listed(live) <= int(m[3]) < live:
+            if server.errorRate and random.random() < server.errorRate:
+                with server.lock:
+                    server.counters['injected-errors'] += 1
+                return self.send(b'', status=404)
+            seq, idx = int(m[3]), int(m[2])
+            if m[1] == 'video' and idx < len(server.variants):
+                # Bandwidth given in bits/s; 25 frames/s
+                frameSize = max(1, server.variants[idx] // 8 // 25)
+                return self.send(ts_segment(_VIDEO, seq, server.segmentDuration, 25, frameSize), 'video/mp2t')
+            if m[1] == 'audio' and idx < len(server.audioRenditions):
+                return self.send(ts_segment(_AUDIO, seq, server.segmentDuration, 40, 320), 'video/mp2t')
+        self.send(b'', status=404)
+
+class HLSStandInServer(http.server.ThreadingHTTPServer):
+    """ A local live HLS server that mimics the layout of the Atresplayer API (channel list,
+    stream information, master playlist and media playlists) and serves generated MPEG-TS
+    segments, e.g.
+
+      server = HLSStandInServer(latency=0.05, bandwidth=2 << 20, errorRate=0.01)
+      server.start()
+      provider = BenchProvider(server.url)
+      ...
+      server.stop()
+
+    The live edge advances by one segment every `segmentDuration` seconds; only the last `window`
+    segments are listed and served.  Every response is delayed by `latency` +/- `jitter` seconds
+    and, if `bandwidth` is not 0, paced to `bandwidth` bytes/s.  Segment requests fail with 404
+    with probability `errorRate`.
+    """
+    CHANNEL = 'Bench'
+    CHUNK_SIZE = 16384
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), segmentDuration=1.0, window=6, history=3,
+                 variants=(500000, 900000), audioRenditions=('es', 'en'),
+                 latency=0.0, jitter=0.0, bandwidth=0, errorRate=0.0, firstSeq=1000):
+        """ Constructs a HLSStandInServer.
+
+        @param address `(host, port)` to listen on; port 0 picks a free port
+        @param segmentDuration Duration of each segment, in seconds
+        @param window Number of segments listed in the media playlists
+        @param history Number of segments already published when the server starts
+        @param variants Bandwidth of each video variant, in bits/s
+        @param audioRenditions Language of each audio rendition, as an RFC 5646 tag
+        @param latency Delay of every response, in seconds
+        @param jitter Maximum random deviation from `latency`, in seconds
+        @param bandwidth Per-connection bandwidth, in bytes/s; 0 means unlimited
+        @param errorRate Probability that a segment request fails with 404
+        @param firstSeq Sequence number of the first segment
+        """
+        super().__init__(address, _Handler)
+        self.segmentDuration = segmentDuration
+        self.window = window
+        self.variants = variants
+        self.audioRenditions = audioRenditions
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.errorRate = errorRate
+        self.firstSeq = firstSeq
+        self.t0 = time.monotonic() - history * segmentDuration
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'bytes': 0, 'injected-errors': 0}
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def live_edge(self):
+        """ Return the sequence number of the next segment to be published. """
+        return self.firstSeq + int((time.monotonic() - self.t0) / self.segmentDuration)
+
+    def first_listed(self, live):
+        return max(self.firstSeq, live - self.window)
+
+    def master_playlist(self):
+        s = '#EXTM3U\n'
+        for i, lang in enumerate(self.audioRenditions):
+            s += '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="%s",LANGUAGE="%s",DEFAULT=%s,URI="audio%d.m3u8"\n' \
+                % (lang, lang, 'YES' if i == 0 else 'NO', i)
+        for i, bandwidth in enumerate(self.variants):
+            s += '#EXT-X-STREAM-INF:BANDWIDTH=%d,CODECS="avc1.4d401f,mp4a.40.2",AUDIO="aud"\nvideo%d.m3u8\n' \
+                % (bandwidth, i)
+        return s
+
+    def media_playlist(self, name, live):
+        first = self.first_listed(live)
+        s = '#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:%d\n#EXT-X-MEDIA-SEQUENCE:%d\n' \
+            % (max(1, round(self.segmentDuration)), first)
+        for seq in range(first, live):
+            s += '#EXTINF:%.3f,\n%s-%d.ts\n' % (self.segmentDuration, name, seq)
+        return s
+
+    def handle_error(self, request, clientAddress):
+        # Clients routinely drop connections, e.g. when the sink is terminated
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, clientAddress)
+
+    def start(self):
+        """ Serve requests on a background thread. """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
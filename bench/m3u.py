@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+   bench/m3u.py - Microbenchmark of `M3UPlaylist` on large live media playlists
+
+   Measures a full parse, an incremental parse (see `M3UPlaylist`) after one segment is appended
+   and one is dropped, and a parse with the previous regex-based implementation, which is kept
+   here as the baseline.  Run from the top-level directory of the repository, e.g.
+
+     $ python -m bench.m3u --segments=20000
+"""
+
+import getopt
+import re
+import sys
+import timeit
+from common.m3u import M3UPlaylist
+
+_DEFAULT_SEGMENTS = 10000
+
+def media_playlist(first, n):
+    """ Return a live media playlist that lists `n` segments starting at `first`. """
+    s = '#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:6\n#EXT-X-MEDIA-SEQUENCE:%d\n' % first
+    for seq in range(first, first + n):
+        s += '#EXT-X-PROGRAM-DATE-TIME:2021-03-01T12:00:%02d.000Z\n#EXTINF:6.000,\n' \
+             'https://cdn.site.org/live/bitrate_1/segment-%d.ts?token=0123456789abcdef\n' % (seq % 60, seq)
+    return s
+
+def legacy_parse(content):
+    ents = []
+    lines = content.splitlines()
+    del lines[0]
+    attrs = []
+    for line in lines:
+        if not line:
+            continue
+        m = re.match('#([^:]+):?(.*)', line)
+        if m:
+            attrs += [(m[1], m[2].strip())]
+        else:
+            ents += [{'href': line, 'attrs': attrs}]
+            attrs = []
+    return ents
+
+def main():
+    segments = _DEFAULT_SEGMENTS
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'segments='])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(1)
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            print('Usage: python -m bench.m3u [--segments=N]')
+            sys.exit(1)
+        elif o == '--segments':
+            segments = int(a)
+
+    before = media_playlist(1000, segments)
+    after = media_playlist(1001, segments)
+    previous = M3UPlaylist(before, expectExtm3u=True)
+    attrs = 'BANDWIDTH=1500000,CODECS="avc1.4d401f,mp4a.40.2",RESOLUTION=1280x720,AUDIO="aud"'
+
+    cases = [
+        ('legacy parse', lambda: legacy_parse(after)),
+        ('full parse', lambda: M3UPlaylist(after, expectExtm3u=True)),
+        ('incremental parse', lambda: M3UPlaylist(after, expectExtm3u=True, previous=previous)),
+        ('parse_kv_attr', lambda: M3UPlaylist.parse_kv_attr(attrs)),
+    ]
+    print('%d segments, %d bytes' % (segments, len(after)))
+    for name, fn in cases:
+        timer = timeit.Timer(fn)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(3, number)) / number
+        print('%-20s %12.1f us' % (name, best * 1e6))
+
+if __name__ == '__main__':
+    main()
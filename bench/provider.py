@@ -0,0 +1,34 @@
+from common.avsource import AsyncMpegtsSequenceAVSource, CurlMpegtsSequenceAVSource
+from provider.ESatresplayer import AtresplayerProvider
+
+class BenchProvider(AtresplayerProvider):
+    """ Stand-in for `AtresplayerProvider` that streams from a `HLSStandInServer` at `baseUrl`.
+    The metadata cache is disabled unless `cache` is given in `params`.  The `av-source` parameter
+    selects the number of streams: either `mux` (video and audio, see
+    `CurlMpegtsSequenceMuxAVSource`) or `single` (video only, see `CurlMpegtsSequenceAVSource`).
+    The `asyncio` engine uses `AsyncMpegtsSequenceAVSource` in both cases.
+    """
+    def __init__(self, baseUrl, params={}):
+        super().__init__({'cache': 'off', 'av-source': 'mux'} | params)
+        self._URL_CHANNELS = baseUrl + '/channels'
+        self._URL_STREAM_INFO = baseUrl + '/live/%s'
+
+    def get_av_source(self, streamInfo, alternative=-1):
+        if self.params['av-source'] == 'mux':
+            return super().get_av_source(streamInfo, alternative)
+        if self.params['av-source'] != 'single':
+            raise ValueError("'%s': unknown A/V source" % self.params['av-source'])
+        video = self.get_mpegts_url(streamInfo, alternative)[0]
+        variants = None
+        if self.params['abr'] == 'on':
+            variants = self.get_variants(streamInfo, alternative, video)
+        cls = CurlMpegtsSequenceAVSource
+        if self.params['engine'] == 'asyncio':
+            cls = AsyncMpegtsSequenceAVSource
+        return cls(video,
+                   int(self.params['urls-per-proc']),
+                   self.params.get('user-agent'),
+                   self.cookieJar,
+                   self.params,
+                   variants,
+                   self.get_fetcher())
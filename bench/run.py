@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+   bench/run.py - Benchmark the A/V source implementations against a local HLS server
+
+   Each configuration (see `CONFIGS`) is run in a separate process for a fixed duration against
+   a `HLSStandInServer`; its output goes to a sink that writes to `/dev/null` (see `sink.py`).
+   Run from the top-level directory of the repository, e.g.
+
+     $ python -m bench.run --duration=30 --latency=0.05 --jitter=0.02 --error-rate=0.02
+     $ python -m bench.run --bandwidth=262144 http-prefetch http-mux
+"""
+
+import getopt
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+from bench.hlsserver import HLSStandInServer
+from bench.provider import BenchProvider
+
+_SINK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sink.py')
+
+# Provider parameters of each configuration, and the programs it requires
+CONFIGS = {
+    'curl':            ({'engine': 'curl', 'scheduler': 'sequence', 'av-source': 'single'}, ['curl']),
+    'curl-mux':        ({'engine': 'curl', 'scheduler': 'sequence'}, ['curl']),
+    'http-sequence':   ({'engine': 'http', 'scheduler': 'sequence', 'prefetch-depth': 0,
+                         'av-source': 'single'}, []),
+    'http-playlist':   ({'engine': 'http', 'prefetch-depth': 0, 'av-source': 'single'}, []),
+    'http-prefetch':   ({'engine': 'http', 'av-source': 'single'}, []),
+    'http-abr':        ({'engine': 'http', 'abr': 'on', 'av-source': 'single'}, []),
+    'http-mux':        ({'engine': 'http'}, []),
+    'http-mux-ffmpeg': ({'engine': 'http', 'mux': 'ffmpeg'}, ['ffmpeg']),
+    'asyncio':         ({'engine': 'asyncio', 'prefetch-depth': 0, 'av-source': 'single'}, []),
+    'asyncio-prefetch': ({'engine': 'asyncio', 'av-source': 'single'}, []),
+    'asyncio-mux':     ({'engine': 'asyncio'}, []),
+}
+
+_DEFAULT_DURATION = 20
+_DEFAULT_USER_AGENT = 'tvstream-ffplay-bench'
+
+def usage():
+    print("Usage: python -m bench.run [OPTION]... [CONFIG]...\n")
+    print("CONFIG is one of: %s; default is all.\n" % ', '.join(CONFIGS))
+    print("OPTION can be one of:")
+    print("  -h, --help              Show this usage message")
+    print("  --duration=S            Run each configuration for S seconds; default is %d" % _DEFAULT_DURATION)
+    print("  --segment-duration=S    Duration of each segment, in seconds; default is 1")
+    print("  --latency=S             Delay every response by S seconds")
+    print("  --jitter=S              Randomly deviate from the latency by up to S seconds")
+    print("  --bandwidth=B           Limit each connection to B bytes/s")
+    print("  --error-rate=P          Fail segment requests with 404 with probability P")
+    print("  --stall-threshold=S     Count gaps longer than S seconds as stalls; default is 1.5 segments")
+    print("  --param='KEY=VALUE'     Pass an additional parameter to the provider")
+    print("  --json                  Print the results as JSON")
+    sys.exit(1)
+
+def run_child(spec):
+    """ Run a single configuration and print the results as JSON.  This is the entry point of
+    the child processes.
+    """
+    p = BenchProvider(spec['url'], {'user-agent': _DEFAULT_USER_AGENT} | spec['params'])
+    startTime = time.monotonic()
+    info = p.get_stream_info(HLSStandInServer.CHANNEL)
+    source = p.get_av_source(info)
+
+    fd, report = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    sink = subprocess.Popen([sys.executable, _SINK, report, str(spec['stall-threshold'])],
+                            stdin=subprocess.PIPE, bufsize=0)
+    restarts = 0
+
+    def loop():
+        nonlocal source, info, restarts
+        while source.run(sink):
+            restarts += 1
+            time.sleep(0.5)
+            if not source.resumable():
+                info = p.get_stream_info(HLSStandInServer.CHANNEL)
+                source = p.get_av_source(info)
+
+    t = Thread(target=loop, daemon=True)
+    t.start()
+    t.join(spec['duration'] - (time.monotonic() - startTime))
+    sink.terminate()
+    sink.wait()
+    t.join(5)
+
+    with open(report) as f:
+        result = json.load(f)
+    os.unlink(report)
+    # Measured at the sink: `curl` processes write to it directly
+    result |= {'startup': result['first'] - startTime if result['first'] else None,
+               'restarts': restarts,
+               'stats': source.stats()}
+    sys.stdout.write(json.dumps(result))
+    sys.stdout.flush()
+    # Fetch loops might still be blocked on the network
+    os._exit(0)
+
+def run_config(name, url, params, duration, stallThreshold):
+    """ Run the configuration `name` in a child process and return its results. """
+    spec = {'url': url, 'params': CONFIGS[name][0] | params,
+            'duration': duration, 'stall-threshold': stallThreshold}
+    child = subprocess.Popen([sys.executable, '-m', 'bench.run', '--child=' + json.dumps(spec)],
+                             stdout=subprocess.PIPE)
+    out = child.stdout.read()
+    _, status, ru = os.wait4(child.pid, 0)
+    child.returncode = os.waitstatus_to_exitcode(status)
+    if child.returncode != 0 or not out:
+        return None
+    result = json.loads(out)
+    # `ru` covers the child and its descendants, i.e. the sink and any `curl` or `ffmpeg` processes
+    result['cpu'] = ru.ru_utime + ru.ru_stime - result.pop('cpu')
+    result['max-rss'] = ru.ru_maxrss * 1024
+    span = (result['last'] or 0) - (result['first'] or 0)
+    result['throughput'] = result['bytes'] * 8 / span if span > 0 else 0
+    return result
+
+def main():
+    duration = _DEFAULT_DURATION
+    serverArgs = {}
+    stallThreshold = None
+    params = {}
+    asJson = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                                   ['help', 'child=', 'duration=', 'segment-duration=',
+                                    'latency=', 'jitter=', 'bandwidth=', 'error-rate=',
+                                    'stall-threshold=', 'param=', 'json'])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+        elif o == '--child':
+            run_child(json.loads(a))
+        elif o == '--duration':
+            duration = float(a)
+        elif o == '--segment-duration':
+            serverArgs['segmentDuration'] = float(a)
+        elif o == '--latency':
+            serverArgs['latency'] = float(a)
+        elif o == '--jitter':
+            serverArgs['jitter'] = float(a)
+        elif o == '--bandwidth':
+            serverArgs['bandwidth'] = int(a)
+        elif o == '--error-rate':
+            serverArgs['errorRate'] = float(a)
+        elif o == '--stall-threshold':
+            stallThreshold = float(a)
+        elif o == '--param':
+            k, v = a.split('=', 1)
+            params[k] = v
+        elif o == '--json':
+            asJson = True
+
+    for name in args:
+        if name not in CONFIGS:
+            print("'%s': unknown configuration" % name)
+            usage()
+
+    server = HLSStandInServer(**serverArgs)
+    server.start()
+    if stallThreshold is None:
+        stallThreshold = 1.5 * server.segmentDuration
+
+    results = {}
+    for name in args or CONFIGS:
+        missing = [prog for prog in CONFIGS[name][1] if not shutil.which(prog)]
+        if missing:
+            print('%-16s skipped (requires %s)' % (name, ', '.join(missing)), file=sys.stderr)
+            continue
+        results[name] = run_config(name, server.url, params, duration, stallThreshold)
+        if results[name] is None:
+            print('%-16s failed' % name, file=sys.stderr)
+    server.stop()
+
+    if asJson:
+        print(json.dumps(results, indent=2))
+        return
+    print('%-16s %12s %10s %7s %9s %8s %9s' % ('CONFIG', 'kbit/s', 'startup', 'stalls',
+                                                'restarts', 'cpu', 'rss'))
+    for name, r in results.items():
+        if r is None:
+            continue
+        print('%-16s %12.1f %9.3fs %7d %9d %7.2fs %7.1fMB'
+              % (name, r['throughput'] / 1000, r['startup'] or float('nan'), r['stalls'],
+                 r['restarts'], r['cpu'], r['max-rss'] / (1 << 20)))
+
+if __name__ == '__main__':
+    main()
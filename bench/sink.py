@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+""" Benchmark sink: copies its stdin to `/dev/null` and, on EOF or SIGTERM, writes a JSON report
+to REPORT with the number of bytes received, the time of the first and last read (as given by
+`time.monotonic()`), the number and total duration of stalls, i.e. gaps between reads longer
+than STALL_THRESHOLD seconds, and its own CPU time.
+
+Usage: sink.py REPORT STALL_THRESHOLD
+"""
+import json
+import os
+import resource
+import signal
+import sys
+import time
+
+def main():
+    report, stallThreshold = sys.argv[1], float(sys.argv[2])
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    buf = bytearray(1 << 20)
+    nbytes, first, last, stalls, stallTime = 0, None, None, 0, 0.0
+    fhIn = sys.stdin.buffer.raw
+    try:
+        with open(os.devnull, 'wb') as fhOut:
+            while n := fhIn.readinto(buf):
+                now = time.monotonic()
+                if last is not None and now - last > stallThreshold:
+                    stalls += 1
+                    stallTime += now - last
+                first = first or now
+                last = now
+                nbytes += n
+                fhOut.write(buf[:n])
+    finally:
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        with open(report, 'w') as f:
+            json.dump({'bytes': nbytes, 'first': first, 'last': last,
+                       'stalls': stalls, 'stall-time': stallTime,
+                       'cpu': ru.ru_utime + ru.ru_stime}, f)
+
+if __name__ == '__main__':
+    main()
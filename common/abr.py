@@ -0,0 +1,91 @@
+from threading import Lock
+
+class AdaptiveBitrateController:
+    """ Chooses among several variants of a stream based on the measured download throughput.
+    Throughput is tracked by a fast and a slow exponentially-weighted moving average; the lower of
+    both is used as the estimate, so that it drops quickly on congestion and recovers slowly, e.g.
+
+      abr = AdaptiveBitrateController([800000, 1500000, 3000000], 2)
+      abr.record(nbytes, seconds)          # after each segment
+      variant = abr.select()
+
+    Switching down happens as soon as the estimate does not cover the current variant; switching
+    up requires the estimate to cover a higher variant for `upSwitchSegments` segments in a row.
+
+    Instances of this class are thread-safe, e.g. segments may be recorded by several prefetch
+    workers; `update()` records a segment and selects the variant as a single step.
+    """
+    def __init__(self, bandwidths, current, safety=0.8, upSwitchSegments=3):
+        """ Constructs an AdaptiveBitrateController.
+
+        @param bandwidths A list of the bandwidth (bits/s) of each variant, i.e. the `BANDWIDTH`
+        attribute of `EXT-X-STREAM-INF`
+        @param current Index of the variant in use
+        @param safety Fraction of the estimated throughput that may be used
+        @param upSwitchSegments Number of consecutive segments required to switch up
+        """
+        self.bandwidths = bandwidths
+        self.current = current
+        self.safety = safety
+        self.upSwitchSegments = upSwitchSegments
+        self.fast = None
+        self.slow = None
+        self._upCount = 0
+        self._lock = Lock()
+
+    def record(self, nbytes, seconds):
+        """ Record the download of a segment of `nbytes` bytes that took `seconds` seconds. """
+        with self._lock:
+            self._record(nbytes, seconds)
+
+    def _record(self, nbytes, seconds):
+        if seconds <= 0 or nbytes <= 0:
+            return
+        bps = nbytes * 8 / seconds
+        self.fast = bps if self.fast is None else 0.5 * bps + 0.5 * self.fast
+        self.slow = bps if self.slow is None else 0.1 * bps + 0.9 * self.slow
+
+    def estimate(self):
+        """ Return the estimated throughput, in bits/s, or `None` if nothing was recorded yet. """
+        with self._lock:
+            return self._estimate()
+
+    def _estimate(self):
+        if self.fast is None:
+            return None
+        return min(self.fast, self.slow)
+
+    def select(self):
+        """ Return the index of the variant that should be used for the next segment. """
+        with self._lock:
+            return self._select()
+
+    def update(self, nbytes, seconds):
+        """ Record a segment (see `record()`) and return a `(previous, current)` tuple of the
+        indices of the variant in use before and after selecting (see `select()`).
+        """
+        with self._lock:
+            previous = self.current
+            self._record(nbytes, seconds)
+            return previous, self._select()
+
+    def _select(self):
+        est = self._estimate()
+        if est is None:
+            return self.current
+        budget = est * self.safety
+        fitting = [i for i, bw in enumerate(self.bandwidths) if bw <= budget]
+        target = max(fitting, key=lambda i: self.bandwidths[i]) if fitting \
+            else min(range(len(self.bandwidths)), key=lambda i: self.bandwidths[i])
+
+        if self.bandwidths[target] < self.bandwidths[self.current]:
+            self._upCount = 0
+            self.current = target
+        elif self.bandwidths[target] > self.bandwidths[self.current]:
+            self._upCount += 1
+            if self._upCount >= self.upSwitchSegments:
+                self._upCount = 0
+                self.current = target
+        else:
+            self._upCount = 0
+        return self.current
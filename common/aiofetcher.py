@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import random
+import ssl
+import urllib.parse
+from contextlib import aclosing
+from common.fetcher import FetchError, http_headers
+from common.metrics import metrics
+
+class AsyncHTTPFetcher:
+    """ The asyncio counterpart of `HTTPFetcher`: fetches HTTP/HTTPS resources over a pool of
+    persistent HTTP/1.1 connections, using the event loop it was first used on, e.g.
+
+      fetcher = AsyncHTTPFetcher(userAgent='Mozilla/5.0')
+      playlist = await fetcher.get('https://site.org/live/video.m3u8')
+      await fetcher.fetch('https://site.org/mpegts/1000.ts', write)
+      await fetcher.close()
+
+    Only `GET` requests are supported; bodies may be delimited by `Content-Length`, chunked
+    transfer encoding or the end of the connection.
+    """
+    _CHUNK_SIZE = 65536
+
+    def __init__(self, userAgent=None, cookies=[], maxIdlePerHost=4, timeout=15, retryBackoff=0.5):
+        """ Constructs an AsyncHTTPFetcher.
+
+        @param userAgent Value for the `User-agent` HTTP header
+        @param cookies An array of http.cookiejar.Cookie instances
+        @param maxIdlePerHost Maximum number of idle connections kept per host
+        @param timeout Timeout of every network operation, in seconds
+        @param retryBackoff Base delay between retries, in seconds (see `HTTPFetcher`)
+        """
+        self.headers = http_headers(userAgent, cookies)
+        self.maxIdlePerHost = maxIdlePerHost
+        self.timeout = timeout
+        self.retryBackoff = retryBackoff
+        self.copiedBytes = 0
+        self._idle = {}
+        self._ssl = None
+
+    async def _acquire(self, key):
+        idle = self._idle.get(key)
+        if idle:
+            return idle.pop(), True
+        scheme, host, port = key
+        if scheme == 'https' and not self._ssl:
+            self._ssl = ssl.create_default_context()
+        conn = await asyncio.wait_for(asyncio.open_connection(host, port,
+                                                              ssl=self._ssl if scheme == 'https' else None),
+                                      self.timeout)
+        return conn, False
+
+    def _release(self, key, conn):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.maxIdlePerHost:
+            idle.append(conn)
+        else:
+            conn[1].close()
+
+    async def close(self):
+        """ Close all the idle connections. """
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle = {}
+
+    async def _readline(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self.timeout)
+        if not line.endswith(b'\n'):
+            raise asyncio.IncompleteReadError(line, None)
+        return line
+
+    async def open(self, url, headers={}, onResponse=None):
+        """ Issue a GET request for `url` and return a `(key, conn, headers)` tuple, where `headers`
+        is a dictionary with lowercase keys.  The caller should consume the body via `body()`.
+        A stale keep-alive connection is transparently replaced by a new one.
+
+        @param url The URL of the resource
+        @param headers Additional HTTP headers for this request
+        @param onResponse If not `None`, a callable that is called once the response headers are received
+        """
+        u = urllib.parse.urlsplit(url)
+        key = (u.scheme, u.hostname, u.port or (443 if u.scheme == 'https' else 80))
+        path = urllib.parse.urlunsplit(('', '', u.path or '/', u.query, ''))
+        request = 'GET %s HTTP/1.1\r\nHost: %s\r\n' % (path, u.netloc) \
+            + ''.join('%s: %s\r\n' % kv for kv in (self.headers | headers).items()) + '\r\n'
+        while True:
+            conn, reused = None, False
+            try:
+                conn, reused = await self._acquire(key)
+                reader, writer = conn
+                writer.write(request.encode('latin-1'))
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                status = (await self._readline(reader)).split(None, 2)
+                respHeaders = {}
+                while (line := await self._readline(reader)) not in (b'\r\n', b'\n'):
+                    k, _, v = line.decode('latin-1').partition(':')
+                    respHeaders[k.strip().lower()] = v.strip()
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as err:
+                if conn:
+                    conn[1].close()
+                if reused:
+                    logging.debug('Stale connection to %s; reconnecting' % u.netloc)
+                    continue
+                raise FetchError(url, reason=str(err) or type(err).__name__)
+            if len(status) < 2 or status[1] != b'200':
+                conn[1].close()
+                raise FetchError(url, int(status[1]) if len(status) > 1 and status[1].isdigit() else None,
+                                 status[2].decode('latin-1').strip() if len(status) > 2 else '')
+            if onResponse:
+                onResponse()
+            return key, conn, respHeaders
+
+    async def body(self, url, key, conn, headers):
+        """ Return an async iterator over the chunks of the response body (see `open()`).  The
+        connection goes back to the pool once the body has been consumed.
+        """
+        reader, writer = conn
+        keepAlive = headers.get('connection', '').lower() != 'close'
+        complete = False
+        try:
+            if 'chunked' in headers.get('transfer-encoding', '').lower():
+                while size := int((await self._readline(reader)).split(b';')[0], 16):
+                    async for data in self._read(reader, size):
+                        yield data
+                    await asyncio.wait_for(reader.readexactly(2), self.timeout)
+                while (await self._readline(reader)) not in (b'\r\n', b'\n'):
+                    pass
+            elif 'content-length' in headers:
+                async for data in self._read(reader, int(headers['content-length'])):
+                    yield data
+            else:
+                keepAlive = False
+                while data := await asyncio.wait_for(reader.read(self._CHUNK_SIZE), self.timeout):
+                    self.copiedBytes += len(data)
+                    yield data
+            complete = True
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as err:
+            raise FetchError(url, reason=str(err) or type(err).__name__)
+        finally:
+            if complete and keepAlive:
+                self._release(key, conn)
+            else:
+                writer.close()
+
+    async def _read(self, reader, remaining):
+        while remaining:
+            data = await asyncio.wait_for(reader.read(min(remaining, self._CHUNK_SIZE)), self.timeout)
+            if not data:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(data)
+            self.copiedBytes += len(data)
+            yield data
+
+    async def _backoff(self, err, attempt):
+        delay = self.retryBackoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        logging.debug('%s; retrying in %.2fs' % (err, delay))
+        metrics.retry()
+        await asyncio.sleep(delay)
+
+    async def get(self, url, headers={}, onResponse=None, retries=0, validate=None):
+        """ Fetch the given URL and return the response body as `bytes`.
+
+        @param retries Number of times the request is retried on failure
+        @param validate See `HTTPFetcher.get()`
+        """
+        for attempt in range(retries + 1):
+            try:
+                key, conn, respHeaders = await self.open(url, headers, onResponse)
+                async with aclosing(self.body(url, key, conn, respHeaders)) as body:
+                    data = b''.join([data async for data in body])
+                reason = validate(data) if validate else None
+                if reason:
+                    raise FetchError(url, reason=reason)
+                return data
+            except FetchError as err:
+                if attempt == retries:
+                    raise
+                await self._backoff(err, attempt)
+
+    async def fetch(self, url, write, onResponse=None, retries=0):
+        """ Fetch the given URL and pass each chunk of the response body to `await write(data)`.
+        A request is not retried once part of the body was written.
+
+        @return The number of bytes written
+        """
+        nbytes = 0
+        for attempt in range(retries + 1):
+            try:
+                key, conn, respHeaders = await self.open(url, onResponse=onResponse)
+                async with aclosing(self.body(url, key, conn, respHeaders)) as body:
+                    async for data in body:
+                        await write(data)
+                        nbytes += len(data)
+                return nbytes
+            except FetchError as err:
+                if attempt == retries or nbytes > 0:
+                    raise
+                await self._backoff(err, attempt)
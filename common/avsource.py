@@ -1,9 +1,22 @@
+import asyncio
+import itertools
 import logging
 import os
 import shlex
 import subprocess
+import time
 from abc import abstractmethod
 from threading import Thread
+from common.abr import AdaptiveBitrateController
+from common.aiofetcher import AsyncHTTPFetcher
+from common.fetcher import FetchError, HTTPFetcher, http_headers
+from common.flow import FlowController
+from common.metrics import metrics
+from common.prefetch import SegmentPrefetcher
+from common.scheduler import LivePlaylistScheduler, SegmentGoneError
+from common.timing import startup
+from common.tsinspect import TSInspector
+from common.tsmux import MpegtsMuxer
 
 class AVSource:
     """ Abstract interface for A/V sources """
@@ -16,6 +29,50 @@ class AVSource:
         """
         pass
 
+    def stats(self):
+        """ Return a dictionary that describes the current state of this A/V source, e.g. the
+        fill level of its buffers.
+        """
+        return {}
+
+    def resumable(self):
+        """ Return `True` if, after `run()` returned, calling it again continues the stream where
+        it stopped, i.e. without a gap; otherwise, a new A/V source should be created.
+        """
+        return False
+
+def sink_pipe(sink):
+    """ Return the file descriptor of the pipe through which `sink` is fed, or `None` if `sink`
+    buffers its input in-process (e.g. a `FanoutSink`); in that case, the fill level of its pipe
+    tells nothing about how fast the data is consumed.
+    """
+    return None if getattr(sink, 'buffered', False) else sink.stdin.fileno()
+
+class _FirstWriteMarker:
+    """ Wraps a file object to record the `first-sink-write` startup event (see `StageTimer`) and
+    the time spent blocked in each write (see `PipelineMetrics`) unless `timed` is `False`.  `fd`
+    is the sink pipe (see `sink_pipe()`), if any.  Each write is also reported to `flow` (a
+    `FlowController`), if given.
+    """
+    def __init__(self, fh, fd, timed=True, flow=None):
+        self.fh = fh
+        self.fd = fd
+        self.timed = timed
+        self.flow = flow
+
+    def write(self, data):
+        startup.mark('first-sink-write')
+        self.write = self._write if self.timed else self.fh.write
+        return self.write(data)
+
+    def _write(self, data):
+        if self.flow:
+            self.flow.writing(len(data))
+        return metrics.sink_write(self.fd, len(data), lambda: self.fh.write(data))
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
 class CurlMpegtsSequenceAVSource(AVSource):
     """ An A/V source that uses `curl` to fetch a sequence of MPEG Transport
     Streams.  This class spawns a curl process for a batch of MPEG TS URLs and
@@ -29,40 +86,328 @@ class CurlMpegtsSequenceAVSource(AVSource):
     curl https://site.org/mpegts/1000.ts https://site.org/mpegts/1001.ts
     curl https://site.org/mpegts/1002.ts https://site.org/mpegts/1003.ts
     ```
+
+    Alternatively, the `http` engine (see `params`) fetches the same sequence in-process over a
+    pool of persistent HTTP/1.1 connections (see `HTTPFetcher`), which avoids spawning a process
+    and doing a new TLS handshake per batch.  If `prefetch-depth` is greater than 0, the next
+    segments are downloaded in parallel and buffered (see `SegmentPrefetcher`).  If `scheduler` is
+    `playlist` and the URL of the media playlist is given, segments are requested only once listed
+    in the playlist (see `LivePlaylistScheduler`) instead of blindly incrementing the sequence number.
+
+    If `abr` is `on` and several variants of the (first) stream are given, the variant is chosen
+    at each segment boundary based on the measured throughput (see `AdaptiveBitrateController`).
+    This requires the `http` engine and the `playlist` scheduler.
+
+    The sequence number of the last segment fully written is tracked per stream, so that a
+    subsequent call to `run()` resumes at the next one (see `resumable()`); for the `curl` engine,
+    `curl` reports each segment as its transfer completes.  Failed segment
+    downloads are retried `segment-retries` times with a randomized exponential backoff.
     """
-    def __init__(self, urlTemplateAndInitSeq, urlsPerProc, userAgent=None, cookies=[]):
+    _ENGINES = ('curl', 'http')
+    _DEFAULT_PARAMS = {
+        'engine': 'curl',
+        'prefetch-depth': 0,
+        'prefetch-max-bytes': 16 << 20,
+        'scheduler': 'sequence',
+        'live-edge-segments': 3,
+        'zero-copy': 'auto',
+        'abr': 'off',
+        'segment-retries': 3,
+        'low-latency': 'off',
+        'inspect': 'off',
+    }
+
+    def __init__(self, urlTemplateAndInitSeq, urlsPerProc, userAgent=None, cookies=[], params={},
+                 variants=None, fetcher=None, languages=None):
         """ Constructs a CurlMpegtsSequenceAVSource.
 
         @param urlTemplateAndInitSeq A tuple that holds the template to use for URL generation, e.g.
-        `https://domain.tld/path/to/resource/%s.ts` and the sequence number to use in the first URL
+        `https://domain.tld/path/to/resource/%s.ts` and the sequence number to use in the first URL.
+        Optionally, a third element holds the URL of the media playlist
         @param urlsPerProc Number of URLs per `curl` process
         @param userAgent Value for the `User-agent` HTTP header
         @param cookies An array of http.cookiejar.Cookie instances
+        @param params A dictionary of parameters.  `engine` selects how segments are fetched:
+        either `curl` (spawn `curl` processes) or `http` (in-process, see `HTTPFetcher`).  For the
+        `http` engine, `prefetch-depth` and `prefetch-max-bytes` set the number of segments fetched
+        ahead and the memory cap of the prefetch buffer, respectively; `scheduler` is either
+        `sequence` or `playlist`; and `live-edge-segments` is the distance to the live edge, in
+        segments, at which the `playlist` scheduler starts if no sequence number is given.  If
+        `zero-copy` is `auto`, segments are spliced from the socket into the sink pipe where
+        possible (Linux, plain HTTP and `prefetch-depth` 0); `off` disables it.  `abr` (`on` or
+        `off`) enables adaptive bitrate switching among `variants`.  `segment-retries` is the number
+        of times a failed segment download is retried.  If `low-latency` is `on`, the `playlist`
+        scheduler skips forward once fetching falls behind the live edge (see `FlowController`).
+        For the `http` engine, if `inspect` is `on`, the stream is inspected on its way to the sink
+        (see `TSInspector`) and segments that are not well-formed are fetched again, which disables
+        `zero-copy`
+        @param variants A list of `(bandwidth, urlTemplateAndInitSeq)` tuples, one per variant of the
+        first stream, where `bandwidth` is given in bits/s
+        @param fetcher An HTTPFetcher instance to use for the `http` engine, e.g. to share
+        connections with the provider.  If `None`, a new instance is created
+        @param languages A list of language codes (or `None`), one per stream, used to label the
+        audio tracks if several streams are multiplexed (see `MpegtsMuxer`)
         """
         self.urlTemplateAndInitSeq = urlTemplateAndInitSeq
+        self.languages = languages
         self.urlsPerProc = urlsPerProc
-        self.addHeaders = []
-        if userAgent:
-            self.addHeaders += ['-H', 'User-agent: %s' % userAgent]
-        if cookies:
-            self.addHeaders += ['-H', 'Cookie: %s' % '; '.join(map(
-                                lambda c: c.name + '=' + c.value, cookies))]
-
-    def curl_loop(curlArgv, urlTemplate, startAt, urlsPerProc, fhStdout):
+        self.params = self._DEFAULT_PARAMS | params
+        if self.params['engine'] not in self._ENGINES:
+            raise ValueError("'%s': unknown fetch engine" % self.params['engine'])
+        headers = http_headers(userAgent, cookies)
+        self.addHeaders = [x for k, v in headers.items() for x in ('-H', '%s: %s' % (k, v))]
+        self.fetcher = None
+        if self.params['engine'] == 'http':
+            self.fetcher = fetcher or HTTPFetcher(userAgent, cookies,
+                                                  zeroCopy=self.params['zero-copy'] != 'off')
+        self.prefetchers = []
+        self.flow = None
+        self.inspectors = {}
+        self.retries = int(self.params['segment-retries'])
+        # Sequence number of the last segment written to the sink, per stream
+        self.delivered = {}
+        self.gone = False
+        # `(seq, offset)` of the end of each segment fed to the `MpegtsMuxer`, if any, per stream
+        self._segmentEnds = None
+
+        self.variants = variants or []
+        self.abr = None
+        self.abrScheduler = None
+        if self.params['abr'] == 'on' and len(self.variants) > 1:
+            first = urlTemplateAndInitSeq[0] if isinstance(urlTemplateAndInitSeq, list) else urlTemplateAndInitSeq
+            current = [T[:3] for _, T in self.variants]
+            if first[:3] in current:
+                self.abr = AdaptiveBitrateController([bw for bw, _ in self.variants],
+                                                     current.index(first[:3]))
+            else:
+                logging.warning('The selected alternative is not among the ABR variants (e.g. it lacks '
+                                'BANDWIDTH); adaptive bitrate switching is disabled')
+
+    def curl_loop(curlArgv, urlTemplate, startAt, urlsPerProc, fhStdout, onSegment=None):
+        # `curl` reports the status and size of each transfer once its body was written out
+        curlArgv = curlArgv + ['--write-out', '%{stderr}%{http_code} %{size_download}\n']
         while True:
             argv = curlArgv + [urlTemplate % i for i in range(startAt, startAt + urlsPerProc)]
-            startAt += urlsPerProc
 
             logging.debug('Spawning process: ' + shlex.join(argv))
-            curl = subprocess.Popen(argv, stdout=fhStdout)
+            curl = subprocess.Popen(argv, stdout=fhStdout, stderr=subprocess.PIPE)
+            for line in curl.stderr:
+                status, _, nbytes = line.decode('ascii', 'replace').strip().partition(' ')
+                if not (status.startswith('2') and nbytes.isdigit()):
+                    continue
+                if onSegment:
+                    onSegment(startAt, int(nbytes))
+                startAt += 1
             if curl.wait() != 0:
                 return
 
+    def segments(self, urlTemplateAndInitSeq, resume=False):
+        """ Return an iterator of `(seq, url)` tuples for the given MPEG TS sequence. """
+        urlTemplate, startAt = urlTemplateAndInitSeq[:2]
+        if self.params['scheduler'] == 'playlist' and len(urlTemplateAndInitSeq) > 2:
+            return LivePlaylistScheduler(self.fetcher, urlTemplateAndInitSeq[2], urlTemplate, startAt,
+                                         int(self.params['live-edge-segments']), resume)
+        return ((i, urlTemplate % i) for i in itertools.count(startAt))
+
+    def resume_point(self, urlTemplateAndInitSeq, streamIdx=0):
+        """ Return the `urlTemplateAndInitSeq` tuple to use for the next run of the stream
+        `streamIdx`, and whether it continues a previous run.
+        """
+        if streamIdx == 0 and self.abr:
+            urlTemplateAndInitSeq = self.variants[self.abr.current][1]
+        seq = self.delivered.get(streamIdx)
+        if seq is None:
+            return urlTemplateAndInitSeq, False
+        return (urlTemplateAndInitSeq[0], seq + 1) + tuple(urlTemplateAndInitSeq[2:]), True
+
+    def rewind(self):
+        """ Called before a run of several streams.  They resume together (see `resume_point()`) from
+        the one that is furthest behind, so that they stay in step; e.g. if video was delivered up
+        to segment 1007 and audio up to 1005, both resume at 1006 (relative to their first segment).
+        """
+        streams = self.urlTemplateAndInitSeq
+        if not self.delivered or not isinstance(streams, list):
+            return
+        behind = min(self.delivered.get(i, T[1] - 1) - T[1] for i, T in enumerate(streams))
+        delivered = {i: T[1] + behind for i, T in enumerate(streams)}
+        if delivered != self.delivered:
+            logging.debug('Rewinding streams to %s (delivered: %s)' % (delivered, self.delivered))
+        self.delivered = delivered
+
+    def on_delivered(self, streamIdx, seq, nbytes):
+        """ Called after the segment `seq` of the stream `streamIdx`, of `nbytes` bytes, was written out. """
+        self.delivered[streamIdx] = seq
+        if streamIdx in self.inspectors:
+            self.inspectors[streamIdx].delivered(seq)
+        if self._segmentEnds is not None:
+            ends = self._segmentEnds[streamIdx]
+            ends.append((seq, nbytes + (ends[-1][1] if ends else 0)))
+
+    def stop_mux(self, mux):
+        """ Stop `mux` at the end of the last segment that every stream got to (see
+        `MpegtsMuxer.stop()`), so that they end together, and set `delivered` to the segments that
+        it consumed; the segments discarded by the multiplexer are fetched again on resume.
+        """
+        complete = [[end for seq, end in ends if end <= mux.received[i]]
+                    for i, ends in enumerate(self._segmentEnds)]
+        n = min(len(c) for c in complete)
+        try:
+            mux.stop([c[n - 1] if n else 0 for c in complete])
+        except BrokenPipeError:
+            pass
+        for i, ends in enumerate(self._segmentEnds):
+            muxed = [seq for seq, end in ends if end <= mux.received[i]]
+            if muxed:
+                self.delivered[i] = muxed[-1]
+            elif ends:
+                self.delivered[i] = ends[0][0] - 1
+        self._segmentEnds = None
+
+    def on_segment(self, streamIdx, seq, nbytes, seconds):
+        """ Called after a segment of the stream `streamIdx` has been downloaded. """
+        metrics.segment(streamIdx, seq, nbytes, seconds)
+        if streamIdx == 0 and self.abr and self.abrScheduler:
+            previous, current = self.abr.update(nbytes, seconds)
+            if current != previous:
+                bandwidth, T = self.variants[current]
+                logging.info('Switching to variant with bandwidth %d (estimated throughput: %d bits/s)'
+                             % (bandwidth, self.abr.estimate()))
+                self.abrScheduler.switch(T[2], T[0])
+
+    def inspector(self, streamIdx):
+        """ Return the TSInspector of the stream `streamIdx`, or `None` if `inspect` is `off`. """
+        if self.params['inspect'] != 'on':
+            return None
+        if streamIdx not in self.inspectors:
+            self.inspectors[streamIdx] = TSInspector(streamIdx)
+        return self.inspectors[streamIdx]
+
+    @staticmethod
+    def validate_segment(data):
+        """ Check a segment before it is written to the sink; see `HTTPFetcher.get()`. """
+        reason = TSInspector.validate(data)
+        if reason:
+            logging.warning('Corrupt segment (%s); fetching it again' % reason)
+            metrics.inc('corrupt_segments')
+        return reason
+
+    def http_loop(self, urlTemplateAndInitSeq, fhStdout, streamIdx=0, resume=False):
+        segments = self.segments(urlTemplateAndInitSeq, resume)
+        if streamIdx == 0 and self.abr:
+            if isinstance(segments, LivePlaylistScheduler):
+                self.abrScheduler = segments
+            else:
+                logging.warning('Adaptive bitrate switching requires the `playlist` scheduler')
+        onFetched = lambda seq, nbytes, seconds: self.on_segment(streamIdx, seq, nbytes, seconds)
+        onResponse = lambda: startup.mark('first-byte')
+        depth = int(self.params['prefetch-depth'])
+        scheduler = segments if isinstance(segments, LivePlaylistScheduler) else None
+        inspector = self.inspector(streamIdx)
+        validate = self.validate_segment if inspector else None
+        if inspector:
+            inspector.scheduler = scheduler
+        if self.flow:
+            self.flow.attach(scheduler=scheduler)
+        try:
+            if depth > 0:
+                prefetcher = SegmentPrefetcher(self.fetcher, segments, depth,
+                                               int(self.params['prefetch-max-bytes']),
+                                               onFetched, onResponse, self.retries, validate)
+                self.prefetchers.append(prefetcher)
+                if self.flow:
+                    self.flow.attach(prefetcher)
+                try:
+                    for seq, data in prefetcher:
+                        if inspector:
+                            inspector.feed(data)
+                        fhStdout.write(data)
+                        self.on_delivered(streamIdx, seq, len(data))
+                finally:
+                    if self.flow:
+                        self.flow.detach(prefetcher)
+                    prefetcher.close()
+                    self.prefetchers.remove(prefetcher)
+            else:
+                for seq, url in segments:
+                    startTime = time.perf_counter()
+                    if inspector:
+                        data = self.fetcher.get(url, onResponse=onResponse, retries=self.retries,
+                                                validate=validate)
+                        inspector.feed(data)
+                        fhStdout.write(data)
+                        nbytes = len(data)
+                    else:
+                        nbytes = self.fetcher.fetch(url, fhStdout, onResponse, self.retries)
+                    self.on_delivered(streamIdx, seq, nbytes)
+                    onFetched(seq, nbytes, time.perf_counter() - startTime)
+        except FetchError as err:
+            self.on_fetch_error(err, urlTemplateAndInitSeq, streamIdx, resume)
+        except BrokenPipeError:
+            pass
+        finally:
+            if self.flow:
+                self.flow.detach(scheduler=scheduler)
+
+    def on_fetch_error(self, err, urlTemplateAndInitSeq, streamIdx, resume):
+        """ Called if the stream `streamIdx` stops because a segment or playlist could not be fetched. """
+        if isinstance(err, SegmentGoneError):
+            logging.warning(str(err))
+            self.gone = True
+            return
+        metrics.fetch_error(err.status)
+        logging.debug(str(err))
+        # Without a playlist, a missing first segment is the only hint that it expired; otherwise,
+        # `LivePlaylistScheduler` tells (see above) and a 404 may well be transient
+        withPlaylist = self.params['scheduler'] == 'playlist' and len(urlTemplateAndInitSeq) > 2
+        if resume and not withPlaylist and err.status in (404, 410) \
+           and self.delivered[streamIdx] == urlTemplateAndInitSeq[1] - 1:
+            self.gone = True
+
+    def fetch_loop(self, urlTemplateAndInitSeq, fhStdout, streamIdx=0):
+        """ Fetch the sequence of MPEG TS given by `urlTemplateAndInitSeq` and write it to `fhStdout`
+        using the configured engine.  Returns on the first failure.
+        """
+        urlTemplateAndInitSeq, resume = self.resume_point(urlTemplateAndInitSeq, streamIdx)
+        if resume:
+            logging.info('Resuming stream %d at segment %d' % (streamIdx, urlTemplateAndInitSeq[1]))
+        if self.params['engine'] == 'http':
+            self.http_loop(urlTemplateAndInitSeq, fhStdout, streamIdx, resume)
+        else:
+            onSegment = lambda seq, nbytes: self.on_delivered(streamIdx, seq, nbytes)
+            CurlMpegtsSequenceAVSource.curl_loop(['curl', '--silent', '--fail', '--fail-early',
+                                                  '--retry', str(self.retries)] + self.addHeaders,
+                                                 *urlTemplateAndInitSeq[:2], self.urlsPerProc, fhStdout,
+                                                 onSegment)
+
+    def flow_controller(self, sink):
+        """ Create the `FlowController` for the sink pipe of `sink`, for a call to `run()`. """
+        self.flow = FlowController(sink_pipe(sink), int(self.params['prefetch-depth']),
+                                   self.params['low-latency'] == 'on')
+        return self.flow
+
     def run(self, sink):
-        CurlMpegtsSequenceAVSource.curl_loop(['curl', '--silent', '--fail', '--fail-early'] + self.addHeaders,
-                                             *self.urlTemplateAndInitSeq, self.urlsPerProc, sink.stdin)
+        self.fetch_loop(self.urlTemplateAndInitSeq,
+                        _FirstWriteMarker(sink.stdin, sink_pipe(sink), flow=self.flow_controller(sink)))
         return sink.poll() == None
 
+    def resumable(self):
+        return bool(self.delivered) and not self.gone
+
+    def stats(self):
+        ret = {'prefetch': [p.fill() for p in self.prefetchers]}
+        if self.fetcher:
+            ret |= {'spliced-bytes': self.fetcher.splicedBytes,
+                    'copied-bytes': self.fetcher.copiedBytes}
+        if self.abr:
+            ret |= {'abr-variant': self.abr.current,
+                    'abr-throughput': self.abr.estimate()}
+        if self.flow:
+            ret['flow'] = self.flow.stats()
+        if self.inspectors:
+            ret['inspect'] = {i: x.stats() for i, x in self.inspectors.items()}
+        ret['delivered'] = dict(self.delivered)
+        return ret
+
 class CurlMpegtsSequenceMuxAVSource(CurlMpegtsSequenceAVSource):
     """ An A/V source that spawns different `curl` processes to separately fetch
     the video and audio data.  An extra `ffmpeg` process is used to multiplex
@@ -87,25 +432,293 @@ class CurlMpegtsSequenceMuxAVSource(CurlMpegtsSequenceAVSource):
                                                   ("https://site.org/mpegts_audio/%s.ts", 2000),
                                               }, 2)
     ```
+
+    If the `mux` parameter is `builtin`, the streams are multiplexed in-process by `MpegtsMuxer`
+    instead of `ffmpeg`.  In that case, the source stops as soon as any of the streams ends, and
+    every stream ends at the same segment (see `stop_mux()`).  On resume, all the streams start
+    over from a common segment (see `rewind()`).
+    Several audio streams, e.g. one per language, are kept as separate tracks; only `MpegtsMuxer`
+    labels them with their language (see `languages`).
+
+    With `MpegtsMuxer`, a segment only counts as delivered (see `resumable()`) once the multiplexer
+    consumed it from the internal pipe, so that the segments discarded along with the pipes (or by
+    the multiplexer) when the source stops are fetched again on resume.  `ffmpeg` does not tell
+    how much it consumed; data that it buffered when it died is lost.
     """
+    _DEFAULT_PARAMS = CurlMpegtsSequenceAVSource._DEFAULT_PARAMS | {
+        'mux': 'ffmpeg',
+    }
+
+    def _fetch_to_pipe(self, urlTemplateAndInitSeq, fhStdout, streamIdx):
+        with fhStdout:
+            self.fetch_loop(urlTemplateAndInitSeq, fhStdout, streamIdx)
+
     def run(self, sink):
+        self.rewind()
+        flow = self.flow_controller(sink)
         threads = []
         pipes = []
+        builtin = self.params['mux'] == 'builtin'
+        self._segmentEnds = [[] for _ in self.urlTemplateAndInitSeq] if builtin else None
         argv_ffmpeg_input = []
-        for T in self.urlTemplateAndInitSeq:
+        for i, T in enumerate(self.urlTemplateAndInitSeq):
             pipes += [os.pipe()]
             argv_ffmpeg_input += ['-i', ('pipe:%i' % pipes[-1][0])]
             curl_fhStdout = os.fdopen(pipes[-1][1], 'wb', buffering=0)
-            threads += [Thread(target=CurlMpegtsSequenceAVSource.curl_loop,
-                               args=[['curl', '--silent', '--fail', '--fail-early'] + self.addHeaders,
-                                     *T, self.urlsPerProc, curl_fhStdout])]
+            threads += [Thread(target=self._fetch_to_pipe, args=[T, curl_fhStdout, i])]
             threads[-1].start()
 
-        mux = subprocess.Popen(['ffmpeg', '-loglevel', 'quiet',
-                                '-c:v', 'copy', '-c:a', 'copy', '-f', 'mpegts', '-'] + argv_ffmpeg_input,
+        if builtin:
+            fhs = [os.fdopen(p[0], 'rb', buffering=0) for p in pipes]
+            fhSink = _FirstWriteMarker(sink.stdin, sink_pipe(sink), flow=flow)
+            mux = MpegtsMuxer(len(fhs), fhSink.write, self.languages)
+            try:
+                mux.run(fhs)
+            except BrokenPipeError:
+                pass
+            finally:
+                # Closing the read end of the pipes makes the remaining fetch loops return
+                for fh in fhs:
+                    fh.close()
+            # Wait for them, so that `delivered` is final before the source is resumed
+            for t in threads:
+                t.join()
+            self.stop_mux(mux)
+            return sink.poll() == None
+
+        argv_ffmpeg_map = []
+        if len(pipes) > 2:
+            # Otherwise, `ffmpeg` keeps a single audio track
+            argv_ffmpeg_map = [x for i in range(len(pipes)) for x in ('-map', str(i))]
+        mux = subprocess.Popen(['ffmpeg', '-loglevel', 'quiet'] + argv_ffmpeg_map +
+                               ['-c:v', 'copy', '-c:a', 'copy', '-f', 'mpegts', '-'] + argv_ffmpeg_input,
                                stdout=sink.stdin, pass_fds=[p[0] for p in pipes])
 
         # Close unused read end of the pipes
         for p in pipes:
             os.close(p[0])
-        return mux.wait() != 0 and sink.poll() == None
+        ret = mux.wait() != 0 and sink.poll() == None
+        for t in threads:
+            t.join()
+        return ret
+
+class _SinkProtocol(asyncio.Protocol):
+    """ Protocol for the sink pipe.  `drain()` waits while the transport buffers more than its
+    high-water mark, i.e. between `pause_writing()` and `resume_writing()`; `closed` is resolved
+    once the sink closes its end.
+    """
+    def __init__(self):
+        self.closed = asyncio.get_running_loop().create_future()
+        self._drained = None
+
+    def pause_writing(self):
+        if self._drained is None:
+            self._drained = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if self._drained is not None:
+            self._drained.set_result(None)
+            self._drained = None
+
+    def connection_lost(self, exc):
+        self.resume_writing()
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    async def drain(self):
+        if self._drained is not None:
+            # Shielded, so that a cancelled writer does not cancel the others
+            await asyncio.shield(self._drained)
+        if self.closed.done():
+            raise ConnectionResetError('Connection lost')
+
+class AsyncMpegtsSequenceAVSource(CurlMpegtsSequenceAVSource):
+    """ An A/V source that runs on a single asyncio event loop: segments are fetched (see
+    `AsyncHTTPFetcher`), media playlists polled (see `LivePlaylistScheduler`), streams multiplexed
+    (see `MpegtsMuxer`) and the result written to the sink by coroutines, instead of threads and
+    `curl` processes.  As for `CurlMpegtsSequenceMuxAVSource`, the constructor takes a list of
+    `urlTemplateAndInitSeq` tuples (or a single tuple), e.g.
+    ```
+          src = AsyncMpegtsSequenceAVSource([
+                                                ("https://site.org/mpegts_video/%s.ts", 1000),
+                                                ("https://site.org/mpegts_audio/%s.ts", 2000),
+                                            ], 0)
+    ```
+
+    If there is more than one stream, they are multiplexed in-process.  Writes to the sink are
+    awaited, so that a slow sink throttles fetching.  The source stops as soon as any of the
+    streams ends or the sink closes its stdin; the remaining operations are then cancelled, and
+    the streams end and resume together as with `CurlMpegtsSequenceMuxAVSource`.
+
+    Parameters are those of `CurlMpegtsSequenceAVSource`, except that `engine` is `asyncio` and
+    `prefetch-depth` is the number of segments per stream fetched concurrently; `urlsPerProc`,
+    `fetcher`, `zero-copy` and `prefetch-max-bytes` are not used.  Flow control (see
+    `FlowController`) only applies to `low-latency`, i.e. `prefetch-depth` stays fixed.
+    """
+    _ENGINES = ('asyncio',)
+    _DEFAULT_PARAMS = CurlMpegtsSequenceAVSource._DEFAULT_PARAMS | {
+        'engine': 'asyncio',
+    }
+
+    def __init__(self, urlTemplateAndInitSeq, urlsPerProc, userAgent=None, cookies=[], params={},
+                 variants=None, fetcher=None, languages=None):
+        super().__init__(urlTemplateAndInitSeq, urlsPerProc, userAgent, cookies, params, variants,
+                         languages=languages)
+        self.afetcher = AsyncHTTPFetcher(userAgent, cookies)
+
+    async def _sequence(urlTemplate, startAt):
+        for i in itertools.count(startAt):
+            yield i, urlTemplate % i
+
+    def segments(self, urlTemplateAndInitSeq, resume=False):
+        """ Return an async iterator of `(seq, url)` tuples for the given MPEG TS sequence. """
+        urlTemplate, startAt = urlTemplateAndInitSeq[:2]
+        if self.params['scheduler'] == 'playlist' and len(urlTemplateAndInitSeq) > 2:
+            return LivePlaylistScheduler(self.afetcher, urlTemplateAndInitSeq[2], urlTemplate, startAt,
+                                         int(self.params['live-edge-segments']), resume)
+        return AsyncMpegtsSequenceAVSource._sequence(urlTemplate, startAt)
+
+    async def _prefetch_loop(self, segments, write, streamIdx, depth, onResponse, validate=None):
+        queue = asyncio.Queue(depth)
+
+        async def fetch(seq, url):
+            startTime = time.perf_counter()
+            data = await self.afetcher.get(url, onResponse=onResponse, retries=self.retries,
+                                           validate=validate)
+            self.on_segment(streamIdx, seq, len(data), time.perf_counter() - startTime)
+            return data
+
+        async def produce():
+            try:
+                async for seq, url in segments:
+                    await queue.put((seq, asyncio.ensure_future(fetch(seq, url))))
+                await queue.put((None, None))
+            except Exception as err:
+                await queue.put((None, err))
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                seq, task = await queue.get()
+                if seq is None:
+                    if task:
+                        raise task
+                    return
+                data = await task
+                await write(data)
+                self.on_delivered(streamIdx, seq, len(data))
+        finally:
+            producer.cancel()
+            while not queue.empty():
+                seq, task = queue.get_nowait()
+                if seq is None:
+                    continue
+                if task.done() and not task.cancelled():
+                    task.exception()
+                task.cancel()
+
+    async def stream_loop(self, urlTemplateAndInitSeq, write, streamIdx=0):
+        """ Fetch the sequence of MPEG TS given by `urlTemplateAndInitSeq` and pass it to
+        `await write(data)`.  Returns on the first failure.
+        """
+        urlTemplateAndInitSeq, resume = self.resume_point(urlTemplateAndInitSeq, streamIdx)
+        if resume:
+            logging.info('Resuming stream %d at segment %d' % (streamIdx, urlTemplateAndInitSeq[1]))
+        segments = self.segments(urlTemplateAndInitSeq, resume)
+        if streamIdx == 0 and self.abr:
+            if isinstance(segments, LivePlaylistScheduler):
+                self.abrScheduler = segments
+            else:
+                logging.warning('Adaptive bitrate switching requires the `playlist` scheduler')
+        onResponse = lambda: startup.mark('first-byte')
+        depth = int(self.params['prefetch-depth'])
+        scheduler = segments if isinstance(segments, LivePlaylistScheduler) else None
+        self.flow.attach(scheduler=scheduler)
+        inspector = self.inspector(streamIdx)
+        validate = self.validate_segment if inspector else None
+        if inspector:
+            inspector.scheduler = scheduler
+            sinkWrite = write
+
+            async def write(data):
+                inspector.feed(data)
+                await sinkWrite(data)
+        try:
+            if depth > 0:
+                await self._prefetch_loop(segments, write, streamIdx, depth, onResponse, validate)
+            else:
+                async for seq, url in segments:
+                    startTime = time.perf_counter()
+                    if inspector:
+                        data = await self.afetcher.get(url, onResponse=onResponse, retries=self.retries,
+                                                       validate=validate)
+                        await write(data)
+                        nbytes = len(data)
+                    else:
+                        nbytes = await self.afetcher.fetch(url, write, onResponse, self.retries)
+                    self.on_delivered(streamIdx, seq, nbytes)
+                    self.on_segment(streamIdx, seq, nbytes, time.perf_counter() - startTime)
+        except FetchError as err:
+            self.on_fetch_error(err, urlTemplateAndInitSeq, streamIdx, resume)
+        except ConnectionError:
+            pass
+        finally:
+            self.flow.detach(scheduler=scheduler)
+
+    async def _run(self, sink):
+        self.rewind()
+        loop = asyncio.get_running_loop()
+        # The transport owns (and closes) a duplicate of the sink's stdin
+        pipe = os.fdopen(os.dup(sink.stdin.fileno()), 'wb', buffering=0)
+        transport, protocol = await loop.connect_write_pipe(_SinkProtocol, pipe)
+        # Writes are buffered by the transport; the time blocked is that of `drain()`
+        fhSink = _FirstWriteMarker(transport, None, timed=False)
+        sinkFd = sink_pipe(sink)
+        flow = self.flow_controller(sink)
+        streams = self.urlTemplateAndInitSeq
+        if not isinstance(streams, list):
+            streams = [streams]
+
+        def write_sink(data):
+            # Writing to a closed transport only logs a warning
+            if not transport.is_closing():
+                fhSink.write(data)
+        mux = MpegtsMuxer(len(streams), write_sink, self.languages) if len(streams) > 1 else None
+        self._segmentEnds = [[] for _ in streams] if mux else None
+
+        def writer_for(idx):
+            async def write(data):
+                if transport.is_closing():
+                    raise BrokenPipeError()
+                flow.writing(len(data))
+                if mux:
+                    mux.feed(idx, data)
+                else:
+                    write_sink(data)
+                await metrics.sink_drain(sinkFd, len(data), protocol.drain)
+            return write
+
+        tasks = [asyncio.create_task(self.stream_loop(T, writer_for(i), i)) for i, T in enumerate(streams)]
+        try:
+            await asyncio.wait(tasks + [protocol.closed], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if mux and not transport.is_closing():
+                self.stop_mux(mux)
+                try:
+                    await protocol.drain()
+                except ConnectionError:
+                    pass
+            transport.close()
+            await self.afetcher.close()
+            # The file status flags are shared with the duplicate
+            os.set_blocking(sink.stdin.fileno(), True)
+
+    def run(self, sink):
+        asyncio.run(self._run(sink))
+        return sink.poll() == None
+
+    def stats(self):
+        return super().stats() | {'copied-bytes': self.afetcher.copiedBytes}
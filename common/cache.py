@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+class MetadataCache:
+    """ On-disk cache for HTTP resources that rarely change, e.g. channel lists or master playlists.
+    Each entry has a time-to-live given by the caller; once it expires, the entry is revalidated
+    using the `ETag` / `Last-Modified` headers of the previous response, so that an unchanged
+    resource is not downloaded again, e.g.
+
+      cache = MetadataCache(os.path.expanduser('~/.atresplayer-cache'), opener)
+      channels = json.loads(cache.get('https://api.site.org/channels', ttl=86400))
+
+    Every entry is stored in `path` as a pair of files: `<key>.json` (metadata) and `<key>.body`,
+    where `key` is the SHA-1 of `identity` and the URL.  `identity` tells apart the credentials of
+    `opener`, e.g. it is set to a hash of the authentication cookies once they are loaded, so that
+    responses cached without authentication are not reused after logging in.  If `enabled` is
+    `False`, every request goes to the network and nothing is stored.
+    """
+    def __init__(self, path, opener, enabled=True, identity=''):
+        """ Constructs a MetadataCache.
+
+        @param path Directory where the entries are stored; created on first use
+        @param opener A urllib.request.OpenerDirector instance used for requests
+        @param enabled Whether the cache is used at all
+        @param identity A string that identifies the credentials used by `opener` (see above)
+        """
+        self.path = path
+        self.opener = opener
+        self.enabled = enabled
+        self.identity = identity
+
+    def _entry_path(self, url):
+        key = (self.identity + '\n' + url) if self.identity else url
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _load(self, url):
+        base = self._entry_path(url)
+        try:
+            with open(base + '.json') as f:
+                meta = json.load(f)
+            with open(base + '.body', 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        return (meta, body) if meta.get('url') == url else (None, None)
+
+    def _write_atomic(self, filename, data):
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, filename)
+
+    def _store(self, url, meta, body):
+        try:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            base = self._entry_path(url)
+            if body is not None:
+                self._write_atomic(base + '.body', body)
+            self._write_atomic(base + '.json', json.dumps(meta).encode('utf-8'))
+        except OSError as err:
+            logging.debug("Couldn't store cache entry for '%s': %s" % (url, err))
+
+    def get(self, url, ttl):
+        """ Return the body of the resource at `url`, which is downloaded only if the cached copy is
+        older than `ttl` seconds and the server reports that it changed.
+
+        @param url The URL of the resource
+        @param ttl Time-to-live of the cached copy, in seconds
+        @return The body of the resource as `bytes`
+        """
+        if not self.enabled:
+            return self.opener.open(url).read()
+
+        meta, body = self._load(url)
+        now = time.time()
+        if meta and now - meta['time'] < ttl:
+            logging.debug("Cache hit: '%s'" % url)
+            return body
+
+        req = urllib.request.Request(url)
+        if meta and meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta and meta.get('last-modified'):
+            req.add_header('If-Modified-Since', meta['last-modified'])
+        try:
+            resp = self.opener.open(req)
+        except urllib.error.HTTPError as err:
+            if err.code != 304 or not meta:
+                raise
+            logging.debug("Cache entry revalidated: '%s'" % url)
+            meta['time'] = now
+            self._store(url, meta, None)
+            return body
+
+        body = resp.read()
+        self._store(url, {'url': url,
+                          'time': now,
+                          'etag': resp.headers.get('ETag'),
+                          'last-modified': resp.headers.get('Last-Modified')}, body)
+        return body
+
+    def invalidate(self, url):
+        """ Drop the cached copy of the resource at `url`, if any. """
+        for ext in ('.json', '.body'):
+            try:
+                os.unlink(self._entry_path(url) + ext)
+            except OSError:
+                pass
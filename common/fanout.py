@@ -0,0 +1,225 @@
+import fcntl
+import logging
+import os
+import subprocess
+from collections import deque
+from threading import Condition, Lock, Thread
+from common.tsmux import TS_PACKET_SIZE
+
+class _SinkOutput:
+    """ One of the outputs of a FanoutSink: a process (fed through its stdin) or a file.  Data is
+    queued up to `maxBytes` and written by a dedicated thread.
+    """
+    def __init__(self, name, fh, process, maxBytes, policy):
+        self.name = name
+        self.fh = fh
+        self.process = process
+        self.maxBytes = maxBytes
+        self.policy = policy
+        self.queue = deque()
+        self.bytes = 0
+        self.droppedBytes = 0
+        self.writtenBytes = 0
+        self.dead = False
+        self._eof = False
+        self._lagging = False
+        self._cond = Condition()
+        self._thread = Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def put(self, data):
+        """ Queue `data`; returns `False` if this output is gone. """
+        with self._cond:
+            if self.dead or self._eof:
+                return False
+            if self.bytes + len(data) > self.maxBytes:
+                if self.policy == 'disconnect':
+                    logging.warning("Sink '%s' is lagging behind; disconnecting" % self.name)
+                    self._eof = True
+                    self.queue.clear()
+                    self.bytes = 0
+                    self._cond.notify_all()
+                    return False
+                if not self._lagging:
+                    logging.warning("Sink '%s' is lagging behind; dropping data" % self.name)
+                    self._lagging = True
+                while self.queue and self.bytes + len(data) > self.maxBytes:
+                    dropped = self.queue.popleft()
+                    self.bytes -= len(dropped)
+                    self.droppedBytes += len(dropped)
+            elif self.bytes == 0:
+                self._lagging = False
+            self.queue.append(data)
+            self.bytes += len(data)
+            self._cond.notify_all()
+        return True
+
+    def close(self):
+        """ Write the queued data and close the output. """
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.queue or self._eof)
+                if not self.queue:
+                    break
+                data = self.queue.popleft()
+                self.bytes -= len(data)
+            try:
+                self.fh.write(data)
+                self.writtenBytes += len(data)
+            except OSError as err:
+                logging.debug("Sink '%s' closed: %s" % (self.name, err))
+                break
+        with self._cond:
+            self.dead = True
+            self.queue.clear()
+            self.bytes = 0
+        try:
+            self.fh.close()
+        except OSError:
+            pass
+
+    def join(self):
+        self._thread.join()
+
+    def alive(self):
+        return not self.dead and (self.process is None or self.process.poll() is None)
+
+    def stats(self):
+        with self._cond:
+            return {'queued-bytes': self.bytes,
+                    'written-bytes': self.writtenBytes,
+                    'dropped-bytes': self.droppedBytes}
+
+class FanoutSink:
+    """ Duplicates the output of an A/V source into several sinks, e.g. a player and a recording,
+    so that each segment is downloaded only once.  Instances of this class can be used in place
+    of the `subprocess.Popen` instance passed to `AVSource.run()`, e.g.
+
+      sink = FanoutSink()
+      sink.add_process(['ffplay', '-'])
+      sink.add_file('recording.ts')
+      source.run(sink)
+
+    Every output has a bounded buffer of `maxBytes`, so that a slow output does not stall the
+    others.  Once it is full, `policy` decides what happens: `drop` discards the oldest buffered
+    data (whole TS packets) and `disconnect` closes that output.  The fan-out is alive while any
+    of its outputs is; outputs may be added or removed at any time.
+    """
+    _PIPE_SIZE = 1048576
+    _BUF_SIZE = 65536 - 65536 % TS_PACKET_SIZE
+    # `stdin` is drained by a thread; see `sink_pipe()`
+    buffered = True
+
+    def __init__(self, maxBytes=16 << 20, policy='drop'):
+        """ Constructs a FanoutSink.
+
+        @param maxBytes Maximum number of bytes buffered per output
+        @param policy Either `drop` or `disconnect`; see above
+        """
+        if policy not in ('drop', 'disconnect'):
+            raise ValueError("'%s': unknown sink policy" % policy)
+        self.maxBytes = maxBytes
+        self.policy = policy
+        self.outputs = []
+        self._lock = Lock()
+        self._returncode = None
+        rfd, wfd = os.pipe()
+        try:
+            fcntl.fcntl(wfd, fcntl.F_SETPIPE_SZ, self._PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass
+        self._fhIn = os.fdopen(rfd, 'rb', buffering=0)
+        self.stdin = os.fdopen(wfd, 'wb', buffering=0)
+        self._thread = Thread(target=self._distribute, daemon=True)
+        self._thread.start()
+
+    def add(self, name, fh, process=None):
+        """ Add an output that writes to the file object `fh`; if `process` is given, the output
+        is alive while the process runs.
+        """
+        output = _SinkOutput(name, fh, process, self.maxBytes, self.policy)
+        with self._lock:
+            self.outputs.append(output)
+        return output
+
+    def add_process(self, argv):
+        """ Spawn `argv` and add an output that writes to its stdin. """
+        process = subprocess.Popen(argv, stdin=subprocess.PIPE, bufsize=0, pipesize=self._PIPE_SIZE)
+        return self.add(argv[0], process.stdin, process)
+
+    def add_file(self, path):
+        """ Add an output that records to the file at `path`. """
+        return self.add(path, open(path, 'wb'))
+
+    def remove(self, output):
+        """ Remove (and close) the given output. """
+        with self._lock:
+            self.outputs.remove(output)
+        output.close()
+
+    def _distribute(self):
+        buf = bytearray(self._BUF_SIZE)
+        partial = b''
+        try:
+            while n := self._fhIn.readinto(buf):
+                data = partial + buf[:n]
+                # Queue whole TS packets only, so that dropping data keeps the stream aligned
+                cut = len(data) - len(data) % TS_PACKET_SIZE
+                data, partial = bytes(data[:cut]), bytes(data[cut:])
+                with self._lock:
+                    outputs = list(self.outputs)
+                if data:
+                    for output in outputs:
+                        output.put(data)
+                if outputs and not any(o.alive() for o in outputs):
+                    break
+        finally:
+            # Make further writes to `stdin` fail, so that the A/V source stops
+            self._fhIn.close()
+            with self._lock:
+                outputs = list(self.outputs)
+            for output in outputs:
+                output.close()
+
+    def poll(self):
+        """ Return `None` while any output is alive; otherwise, the exit status of the first process
+        (or 0 if there are only files).
+        """
+        with self._lock:
+            outputs = list(self.outputs)
+        if any(o.alive() for o in outputs):
+            return None
+        for o in outputs:
+            if o.process:
+                return o.process.poll()
+        return 0
+
+    def close(self):
+        """ Close the input and wait until every output is written out.  Processes are not waited for. """
+        try:
+            self.stdin.close()
+        except OSError:
+            pass
+        self._thread.join()
+        with self._lock:
+            outputs = list(self.outputs)
+        for o in outputs:
+            o.join()
+        return outputs
+
+    def wait(self):
+        """ Like `close()`, but also wait until every process exits. """
+        for o in self.close():
+            if o.process:
+                o.process.wait()
+        return self.poll()
+
+    def stats(self):
+        """ Return a dictionary that describes the state of each output. """
+        with self._lock:
+            return {o.name: o.stats() for o in self.outputs}
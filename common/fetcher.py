@@ -0,0 +1,271 @@
+import http.client
+import logging
+import os
+import random
+import select
+import ssl
+import stat
+import time
+import urllib.parse
+from threading import Lock, local
+from common.metrics import metrics
+
+class FetchError(RuntimeError):
+    """ Raised if a resource could not be fetched; `status` holds the HTTP status code, if any. """
+    def __init__(self, url, status=None, reason=''):
+        super().__init__("Couldn't fetch '%s': %s %s" % (url, status or '', reason))
+        self.url = url
+        self.status = status
+
+def http_headers(userAgent=None, cookies=[]):
+    """ Return a dictionary of HTTP headers that carry the given user agent and cookies.
+
+    @param userAgent Value for the `User-agent` HTTP header
+    @param cookies An array of http.cookiejar.Cookie instances
+    """
+    headers = {}
+    if userAgent:
+        headers['User-agent'] = userAgent
+    if cookies:
+        headers['Cookie'] = '; '.join(map(lambda c: c.name + '=' + c.value, cookies))
+    return headers
+
+class HTTPFetcher:
+    """ Fetches HTTP/HTTPS resources over a pool of persistent HTTP/1.1 connections.
+    Idle connections are kept per (scheme, host) and reused by subsequent requests,
+    which avoids a new TCP (and TLS) handshake per resource, e.g.
+
+      fetcher = HTTPFetcher(userAgent='Mozilla/5.0')
+      fetcher.fetch('https://site.org/mpegts/1000.ts', sink.stdin)
+      fetcher.fetch('https://site.org/mpegts/1001.ts', sink.stdin)  # reuses the connection
+
+    On Linux, if `zeroCopy` is enabled and the body is written to a pipe, `fetch()` moves the data
+    from the socket to the pipe using `os.splice()`, i.e. without copying it to user space.  This
+    requires a plain HTTP connection and a known `Content-Length`; otherwise, the body is copied
+    through a reusable per-thread buffer.  The `splicedBytes` and `copiedBytes` counters tell which
+    path was taken; bodies read by `get()` (e.g. prefetched segments or playlists) are always copied.
+
+    Instances of this class are thread-safe.
+    """
+    _CHUNK_SIZE = 65536
+    _SPLICE_SIZE = 1048576
+
+    def __init__(self, userAgent=None, cookies=[], maxIdlePerHost=4, timeout=15, zeroCopy=True,
+                 retryBackoff=0.5):
+        """ Constructs a HTTPFetcher.
+
+        @param userAgent Value for the `User-agent` HTTP header
+        @param cookies An array of http.cookiejar.Cookie instances
+        @param maxIdlePerHost Maximum number of idle connections kept per host
+        @param timeout Socket timeout, in seconds
+        @param zeroCopy Whether to use `os.splice()` where possible
+        @param retryBackoff Base delay between retries, in seconds; the delay doubles on every
+        attempt and is randomized by +/-50% (see the `retries` argument of `get()` and `fetch()`)
+        """
+        self.headers = http_headers(userAgent, cookies)
+        self.maxIdlePerHost = maxIdlePerHost
+        self.timeout = timeout
+        self.retryBackoff = retryBackoff
+        self.zeroCopy = zeroCopy and hasattr(os, 'splice')
+        self.splicedBytes = 0
+        self.copiedBytes = 0
+        self._idle = {}
+        self._lock = Lock()
+        self._local = local()
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = key
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return cls(netloc, timeout=self.timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxIdlePerHost:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """ Close all the idle connections. """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+    def open(self, url, headers={}, onResponse=None):
+        """ Issue a GET request for `url` and return a `(key, conn, response)` tuple.  The caller
+        should read the response body and then call `done()`.  A stale keep-alive connection is
+        transparently replaced by a new one.
+
+        @param url The URL of the resource
+        @param headers Additional HTTP headers for this request
+        @param onResponse If not `None`, a callable that is called once the response headers are received
+        """
+        u = urllib.parse.urlsplit(url)
+        key = (u.scheme, u.netloc)
+        path = urllib.parse.urlunsplit(('', '', u.path or '/', u.query, ''))
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request('GET', path, headers=self.headers | headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError) as err:
+                conn.close()
+                if reused:
+                    logging.debug('Stale connection to %s; reconnecting' % u.netloc)
+                    continue
+                raise FetchError(url, reason=str(err))
+            except (OSError, http.client.HTTPException) as err:
+                conn.close()
+                raise FetchError(url, reason=str(err))
+            if resp.status != 200:
+                resp.read()
+                self.done(key, conn, resp)
+                raise FetchError(url, resp.status, resp.reason)
+            if onResponse:
+                onResponse()
+            return key, conn, resp
+
+    def done(self, key, conn, resp):
+        """ Return a connection to the pool once the response body has been consumed. """
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+        else:
+            self._release(key, conn)
+
+    def _count(self, spliced=0, copied=0):
+        with self._lock:
+            self.splicedBytes += spliced
+            self.copiedBytes += copied
+
+    def _backoff(self, err, attempt):
+        delay = self.retryBackoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        logging.debug('%s; retrying in %.2fs' % (err, delay))
+        metrics.retry()
+        time.sleep(delay)
+
+    def get(self, url, headers={}, onResponse=None, retries=0, validate=None):
+        """ Fetch the given URL and return the response body as `bytes`.  See `open()`.
+
+        @param retries Number of times the request is retried on failure
+        @param validate If not `None`, a callable that is passed the response body and returns the
+        reason why it is not valid (or `None`), in which case the request fails and is retried
+        """
+        for attempt in range(retries + 1):
+            try:
+                data = self._get(url, headers, onResponse)
+                reason = validate(data) if validate else None
+                if reason:
+                    raise FetchError(url, reason=reason)
+                return data
+            except FetchError as err:
+                if attempt == retries:
+                    raise
+                self._backoff(err, attempt)
+
+    def _get(self, url, headers, onResponse):
+        key, conn, resp = self.open(url, headers, onResponse)
+        try:
+            data = resp.read()
+        except (OSError, http.client.HTTPException) as err:
+            conn.close()
+            raise FetchError(url, reason=str(err))
+        self.done(key, conn, resp)
+        self._count(copied=len(data))
+        return data
+
+    def _can_splice(self, conn, resp, fhOut):
+        if not self.zeroCopy or resp.length is None or resp.chunked \
+           or isinstance(conn.sock, ssl.SSLSocket):
+            return False
+        try:
+            return stat.S_ISFIFO(os.fstat(fhOut.fileno()).st_mode)
+        except (AttributeError, OSError):
+            return False
+
+    def _splice_body(self, conn, resp, fhOut, progress):
+        # Data that was already read into the buffer of `http.client` has to be written first
+        remaining = resp.length
+        head = resp.fp.peek(remaining)[:remaining] if remaining else b''
+        resp.fp.read(len(head))
+        fhOut.write(head)
+        fhOut.flush()
+        self._count(copied=len(head))
+        progress[0] += len(head)
+        remaining -= len(head)
+
+        sockFd, pipeFd = conn.sock.fileno(), fhOut.fileno()
+        spliced = 0
+        try:
+            while remaining:
+                try:
+                    n = os.splice(sockFd, pipeFd, min(remaining, self._SPLICE_SIZE))
+                except BlockingIOError:
+                    # Sockets that have a timeout are in non-blocking mode
+                    if not select.select([sockFd], [], [], self.timeout)[0]:
+                        raise TimeoutError('timed out')
+                    continue
+                if n == 0:
+                    raise http.client.IncompleteRead(b'', remaining)
+                spliced += n
+                progress[0] += n
+                remaining -= n
+        finally:
+            self._count(spliced=spliced)
+        # Let `http.client` know that the body was consumed
+        resp.length = 0
+        resp.read()
+
+    def _copy_body(self, resp, fhOut, progress):
+        if not hasattr(self._local, 'buf'):
+            self._local.buf = bytearray(self._CHUNK_SIZE)
+        buf = self._local.buf
+        mv = memoryview(buf)
+        copied = 0
+        try:
+            while n := resp.readinto(buf):
+                fhOut.write(mv[:n])
+                copied += n
+                progress[0] += n
+        finally:
+            self._count(copied=copied)
+
+    def fetch(self, url, fhOut, onResponse=None, retries=0):
+        """ Fetch the given URL and stream the response body to `fhOut`.
+
+        @param url The URL of the resource
+        @param fhOut A writable binary file object, e.g. the stdin of the sink process
+        @param onResponse See `open()`
+        @param retries Number of times the request is retried on failure.  A request is not retried
+        once part of the body was written to `fhOut`
+        @return The number of bytes written
+        """
+        progress = [0]
+        for attempt in range(retries + 1):
+            try:
+                return self._fetch(url, fhOut, onResponse, progress)
+            except FetchError as err:
+                if attempt == retries or progress[0] > 0:
+                    raise
+                self._backoff(err, attempt)
+
+    def _fetch(self, url, fhOut, onResponse, progress):
+        key, conn, resp = self.open(url, onResponse=onResponse)
+        try:
+            if self._can_splice(conn, resp, fhOut):
+                self._splice_body(conn, resp, fhOut, progress)
+            else:
+                self._copy_body(resp, fhOut, progress)
+        except (OSError, http.client.HTTPException) as err:
+            conn.close()
+            if isinstance(err, BrokenPipeError):
+                raise
+            raise FetchError(url, reason=str(err))
+        self.done(key, conn, resp)
+        return progress[0]
@@ -0,0 +1,143 @@
+import fcntl
+import logging
+import time
+from threading import Lock
+from common.metrics import pipe_occupancy
+
+class FlowController:
+    """ Adapts an A/V source to the rate at which the sink consumes data.  Before each write to
+    the sink pipe, the fill level of the pipe is sampled (see `pipe_occupancy()`) at most once
+    per second, from which the consumption rate of the sink is estimated, e.g.
+
+      flow = FlowController(sink.stdin.fileno(), maxDepth=3)
+      flow.attach(prefetcher, scheduler)
+      flow.writing(len(data))
+      sink.stdin.write(data)
+
+    Sampling before the write tells what the sink left over since the previous one; right after
+    writing a segment as large as the pipe, the pipe would look full however fast it drains.
+
+    While the pipe stays above `_HIGH_WATER`, the sink is the bottleneck and the depth of the
+    attached `SegmentPrefetcher`s is lowered, down to 1, so that segments are not fetched (and
+    held in memory) long before they can be written; below `_LOW_WATER`, it is raised again up to
+    `maxDepth`.
+
+    If `fd` is `None`, e.g. the sink buffers its input in-process (see `sink_pipe()`), the fill
+    level is unknown and the depth stays at `maxDepth`.
+
+    In low-latency mode, the attached `LivePlaylistScheduler`s keep at most `maxBehind` segments
+    queued, i.e. fetching skips forward to the live edge once it falls behind.  `maxBehind`
+    starts at `_LOW_LATENCY_BEHIND`; it is raised by one (up to `_MAX_BEHIND`) every time segments
+    are skipped, so that a jittery network does not cause skips over and over, and lowered again
+    after `_CALM_SECONDS` without skips.
+    """
+    _INTERVAL = 1.0
+    _HIGH_WATER = 0.5
+    _LOW_WATER = 0.1
+    _LOW_LATENCY_BEHIND = 1
+    _MAX_BEHIND = 3
+    _CALM_SECONDS = 30
+
+    def __init__(self, fd, maxDepth, lowLatency=False):
+        """ Constructs a FlowController.
+
+        @param fd File descriptor of the sink pipe, or `None`
+        @param maxDepth Maximum prefetch depth
+        @param lowLatency Whether to skip forward to the live edge (see above)
+        """
+        self.fd = fd
+        self.capacity = None
+        if fd is not None:
+            try:
+                self.capacity = fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+            except (AttributeError, OSError):
+                pass
+        self.maxDepth = max(1, maxDepth)
+        self.depth = self.maxDepth
+        self.lowLatency = lowLatency
+        self.maxBehind = self._LOW_LATENCY_BEHIND if lowLatency else None
+        self.rate = None
+        self.fill = None
+        self.prefetchers = []
+        self.schedulers = []
+        self._written = 0
+        self._sample = None
+        self._skipped = 0
+        self._lastSkip = time.monotonic()
+        self._lock = Lock()
+
+    def attach(self, prefetcher=None, scheduler=None):
+        """ Put the given `SegmentPrefetcher` and/or `LivePlaylistScheduler` under control. """
+        with self._lock:
+            if prefetcher:
+                prefetcher.set_depth(self.depth)
+                self.prefetchers.append(prefetcher)
+            if scheduler:
+                scheduler.maxBehind = self.maxBehind
+                self.schedulers.append(scheduler)
+
+    def detach(self, prefetcher=None, scheduler=None):
+        with self._lock:
+            if prefetcher in self.prefetchers:
+                self.prefetchers.remove(prefetcher)
+            if scheduler in self.schedulers:
+                self.schedulers.remove(scheduler)
+
+    def writing(self, nbytes):
+        """ Called before `nbytes` are written to the sink pipe. """
+        now = time.monotonic()
+        with self._lock:
+            written = self._written
+            self._written += nbytes
+            if self._sample and now - self._sample[0] < self._INTERVAL:
+                return
+            occupancy = pipe_occupancy(self.fd)
+            if occupancy is None:
+                # Skips (see `_adjust()`) are still tracked
+                self._sample = (now, written, None)
+                self._adjust(now)
+                return
+            if self._sample and self._sample[2] is not None:
+                t, lastWritten, queued = self._sample
+                rate = ((written - lastWritten) - (occupancy - queued)) / (now - t)
+                self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+            self._sample = (now, written, occupancy)
+            self.fill = occupancy / self.capacity if self.capacity else None
+            self._adjust(now)
+
+    def _adjust(self, now):
+        depth = self.depth
+        if self.fill is not None and self.fill >= self._HIGH_WATER:
+            depth = max(1, depth - 1)
+        elif self.fill is not None and self.fill <= self._LOW_WATER:
+            depth = min(self.maxDepth, depth + 1)
+        if depth != self.depth:
+            logging.debug('Flow control: prefetch depth %d -> %d (sink pipe %.0f%% full, %.0f bytes/s)'
+                          % (self.depth, depth, self.fill * 100, self.rate or 0))
+            self.depth = depth
+            for p in self.prefetchers:
+                p.set_depth(depth)
+
+        if not self.lowLatency:
+            return
+        maxBehind = self.maxBehind
+        skipped = sum(s.skipped for s in self.schedulers)
+        if skipped > self._skipped:
+            self._lastSkip = now
+            maxBehind = min(self._MAX_BEHIND, maxBehind + 1)
+        elif now - self._lastSkip >= self._CALM_SECONDS and maxBehind > self._LOW_LATENCY_BEHIND:
+            self._lastSkip = now
+            maxBehind -= 1
+        self._skipped = skipped
+        if maxBehind != self.maxBehind:
+            logging.debug('Flow control: keeping at most %d segment(s) behind the live edge' % maxBehind)
+            self.maxBehind = maxBehind
+            for s in self.schedulers:
+                s.maxBehind = maxBehind
+
+    def stats(self):
+        with self._lock:
+            return {'depth': self.depth,
+                    'max-behind': self.maxBehind,
+                    'sink-fill': self.fill,
+                    'sink-rate': self.rate}
@@ -1,40 +1,135 @@
 import re
 
+# RFC 8216, Section 4.2: AttributeName=AttributeValue, where a quoted-string may contain commas
+_ATTR_RE = re.compile(r'\s*([A-Za-z0-9_-]+)\s*=\s*(?:"([^"\r\n]*)"|([^,]*))\s*(?:,|$)')
+
+class M3UEntry:
+    """ An entry of a M3U playlist.  `href` is the location of the resource; `attrs` is the list
+    of `(tag, value)` tuples for the EXTM3U tags that precede it.  For compatibility, both can
+    also be accessed as `entry['href']` and `entry['attrs']`.
+    """
+    __slots__ = ('href', 'attrs')
+
+    def __init__(self, href, attrs):
+        self.href = href
+        self.attrs = attrs
+
+    def __getitem__(self, key):
+        if key == 'href':
+            return self.href
+        if key == 'attrs':
+            return self.attrs
+        raise KeyError(key)
+
+    def __repr__(self):
+        return repr({'href': self.href, 'attrs': self.attrs})
+
 class M3UPlaylist:
     """ Simple M3U/EXTM3U playlist. Objects of this type partially implement the
     container interface, i.e. its elements may be accessed using `playlist[i]`.
 
-    Each entry is a dictionary that contains two keys ('href' and 'attrs').
-    'href' contains the location od the resource; 'attrs' is a dictionary of
-    parsed EXTM3U attributes.
+    Each entry is a `M3UEntry` that holds the location of the resource (`href`) and the list of
+    EXTM3U tags that precede it (`attrs`).  The first entry also carries the playlist tags, e.g.
+    `EXT-X-MEDIA-SEQUENCE`.
+
+    Live media playlists are re-polled often and typically change only by dropping segments from
+    the head and appending new ones.  If `previous` is given, the entries that both versions share
+    (as per `EXT-X-MEDIA-SEQUENCE`) are reused and only the appended lines are parsed, e.g.
+
+      playlist = M3UPlaylist(fetch(url), expectExtm3u=True)
+      playlist = M3UPlaylist(fetch(url), expectExtm3u=True, previous=playlist)
+
+    The result is the same as that of a full parse.
     """
-    def __init__(self, content, expectExtm3u=False):
+    def __init__(self, content, expectExtm3u=False, previous=None):
         """ Parses the given string as a [EXT]M3U playlist.
 
         @param content String to parse
         @param expectExtm3u If true, the `#EXTM3U` header is required
+        @param previous A previous version of the same playlist, for incremental parsing
         """
         self.ents = []
-
-        lines = content.splitlines()
-        if not lines:
-            return
-        self.extm3u = lines[0] == '#EXTM3U'
-        if self.extm3u:
-            del lines[0]
+        self.mediaSequence = None
+        self.extm3u = content.startswith('#EXTM3U') and content[7:8] in ('', '\r', '\n')
         if expectExtm3u and not self.extm3u:
             raise ValueError("Expected #EXTM3U header")
 
+        pos = content.find('\n') + 1 if self.extm3u else 0
+        if pos == 0 and self.extm3u:
+            return
+        # The first entry carries the playlist tags; always parse it
+        pos = self._parse(content, pos, limit=1)
+        if not self.ents:
+            return
+        for k, v in self.ents[0].attrs:
+            if k == 'EXT-X-MEDIA-SEQUENCE':
+                self.mediaSequence = int(v)
+                break
+        if previous is None or not self._reuse(content, pos, previous):
+            self._parse(content, pos)
+
+    def _parse(self, content, pos, limit=None):
+        """ Parse the lines of `content` from offset `pos` and append the entries found, up to
+        `limit`.  Returns the offset of the first unparsed line.
+        """
+        ents = self.ents
         attrs = []
-        for line in lines:
+        if limit is None:
+            for line in content[pos:].splitlines():
+                if not line:
+                    continue
+                if line[0] == '#':
+                    tag, _, value = line[1:].partition(':')
+                    attrs.append((tag, value.strip()))
+                else:
+                    ents.append(M3UEntry(line, attrs))
+                    attrs = []
+            return len(content)
+
+        end = len(content)
+        while pos < end:
+            nl = content.find('\n', pos)
+            if nl == -1:
+                nl = end
+            line = content[pos:nl].rstrip('\r')
+            pos = nl + 1
             if not line:
                 continue
-            m = re.match('#([^:]+):?(.*)', line)
-            if m:
-                attrs += [(m[1], m[2].strip())]
+            if line[0] == '#':
+                tag, _, value = line[1:].partition(':')
+                attrs.append((tag, value.strip()))
             else:
-                self.ents += [{'href': line, 'attrs': attrs}]
+                ents.append(M3UEntry(line, attrs))
                 attrs = []
+                if len(ents) >= limit:
+                    break
+        return pos
+
+    def _reuse(self, content, pos, previous):
+        """ Reuse the entries of `previous` that follow the (already parsed) first entry and
+        parse only the lines after the last entry of `previous`.  Returns `False` if the
+        playlists do not match, in which case nothing is changed.
+        """
+        if self.mediaSequence is None or previous.mediaSequence is None or not previous.ents:
+            return False
+        skip = self.mediaSequence - previous.mediaSequence
+        if skip < 0 or skip >= len(previous.ents) or previous.ents[skip].href != self.ents[0].href:
+            return False
+        if skip == len(previous.ents) - 1:
+            self._parse(content, pos)
+            return True
+        last = previous.ents[-1].href
+        i = content.find('\n' + last, pos - 1)
+        while i != -1:
+            after = i + 1 + len(last)
+            if content[after:after + 1] in ('', '\n') or content[after:after + 2] == '\r\n':
+                break
+            i = content.find('\n' + last, after)
+        if i == -1:
+            return False
+        self.ents += previous.ents[skip + 1:]
+        self._parse(content, content.find('\n', i + 1) + 1 or len(content))
+        return True
 
     def __len__(self):
         return len(self.ents)
@@ -45,7 +140,20 @@ class M3UPlaylist:
     @staticmethod
     def parse_kv_attr(kvs):
         """ Return a dictionary that is the result of parsing a string consisting of a
-        comma-separated list of `key=value` pairs.
+        comma-separated list of `key=value` pairs (see RFC 8216, Section 4.2).  Quotes around
+        quoted-string values are removed.
         """
-        # TODO: improve regex matching of quoted values
-        return {k: v for k, v in re.findall(r'([A-Za-z0-9_-]+)\s*=\s*"?([^"=,]+)"?', kvs)}
+        ret = {}
+        pos, end = 0, len(kvs)
+        while pos < end:
+            m = _ATTR_RE.match(kvs, pos)
+            if not m:
+                # Skip malformed attribute
+                comma = kvs.find(',', pos)
+                if comma == -1:
+                    break
+                pos = comma + 1
+                continue
+            ret[m[1]] = m[2] if m[2] is not None else m[3].strip()
+            pos = m.end()
+        return ret
@@ -0,0 +1,232 @@
+import fcntl
+import json
+import logging
+import struct
+import termios
+import time
+from collections import deque
+from contextvars import ContextVar
+from threading import Lock, Thread
+
+# Retries of the current request; context-local, so that it is per thread and per asyncio task
+_retries = ContextVar('retries', default=0)
+
+def pipe_occupancy(fd):
+    """ Return the number of bytes queued in the pipe `fd` (either end), or `None`, e.g. if `fd`
+    is `None`.
+    """
+    if fd is None:
+        return None
+    try:
+        return struct.unpack('i', fcntl.ioctl(fd, termios.FIONREAD, b'\0' * 4))[0]
+    except OSError:
+        return None
+
+class PipelineMetrics:
+    """ Collects metrics of the streaming pipeline: per-segment fetch latency, size, throughput
+    and retries; failed requests by HTTP status; playlist polls; time spent blocked writing to the
+    sink and the occupancy of the sink pipe; and the number of stalls and A/V source restarts, e.g.
+
+      metrics.segment(0, 1000, nbytes, seconds)
+      metrics.inc('restarts')
+      print(metrics.prometheus())
+
+    A stall is counted if the sink pipe was empty when a write came and nothing had been written
+    for `stallGap` seconds, i.e. the sink likely ran out of data.  The last `history` segments are
+    kept in `recent`; see also `log_periodically()` and `serve()`.  Instances of this class are
+    thread-safe.
+    """
+    _HELP = {
+        'segments': ('counter', 'Segments fetched'),
+        'segment_bytes': ('counter', 'Bytes of the segments fetched'),
+        'segment_retries': ('counter', 'Retried segment requests'),
+        'segment_fetch_seconds': ('histogram', 'Time to fetch a segment'),
+        'segment_throughput_bps': ('gauge', 'Throughput of the last segment fetched, in bits/s'),
+        'fetch_errors': ('counter', 'Failed segment or playlist requests, by HTTP status'),
+        'playlist_fetch_seconds': ('histogram', 'Time to fetch a media playlist'),
+        'sink_writes': ('counter', 'Writes to the sink'),
+        'sink_write_bytes': ('counter', 'Bytes written to the sink'),
+        'sink_write_blocked_seconds': ('counter', 'Time spent blocked writing to the sink'),
+        'sink_pipe_bytes': ('gauge', 'Bytes queued in the sink pipe after the last write'),
+        'stalls': ('counter', 'Times the sink pipe ran dry'),
+        'restarts': ('counter', 'A/V source restarts'),
+        'corrupt_segments': ('counter', 'Segments refetched because they were corrupt'),
+        'ts_continuity_errors': ('counter', 'TS continuity counter errors'),
+        'ts_dropped_packets': ('counter', 'TS packets lost, as per the continuity counters'),
+        'ts_timestamp_jumps': ('counter', 'PES timestamp discontinuities'),
+        'ts_lag_seconds': ('gauge', 'Delay behind the live edge, as per the media playlist'),
+        'ts_drift_seconds': ('gauge', 'Delay gained since the start, as per the PCR'),
+    }
+    _BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix='tvstream', history=256, stallGap=1.0):
+        self.prefix = prefix
+        self.stallGap = stallGap
+        self.recent = deque(maxlen=history)
+        self._values = {}
+        self._lastWrite = None
+        self._lock = Lock()
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """ Add `value` to the histogram `name`. """
+        key = self._key(name, labels)
+        with self._lock:
+            h = self._values.setdefault(key, [0] * len(self._BUCKETS) + [0, 0.0])
+            for i, bound in enumerate(self._BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += 1
+            h[-1] += value
+
+    def retry(self):
+        """ Called by the fetchers before a request is retried. """
+        _retries.set(_retries.get() + 1)
+
+    def segment(self, stream, seq, nbytes, seconds):
+        """ Record a segment of the stream `stream` that was fetched in `seconds`.  Retries
+        recorded (see `retry()`) in the same thread or task since the last segment are
+        attributed to this one.
+        """
+        retries = _retries.get()
+        _retries.set(0)
+        throughput = nbytes * 8 / seconds if seconds > 0 else 0
+        self.inc('segments', stream=stream)
+        self.inc('segment_bytes', nbytes, stream=stream)
+        if retries:
+            self.inc('segment_retries', retries, stream=stream)
+        self.observe('segment_fetch_seconds', seconds, stream=stream)
+        self.set('segment_throughput_bps', throughput, stream=stream)
+        with self._lock:
+            self.recent.append({'time': round(time.time(), 3), 'stream': stream, 'seq': seq,
+                                'bytes': nbytes, 'seconds': round(seconds, 4),
+                                'throughput': int(throughput), 'retries': retries})
+
+    def fetch_error(self, status):
+        _retries.set(0)
+        self.inc('fetch_errors', status=status or 'none')
+
+    def sink_write(self, fd, nbytes, write):
+        """ Call `write()`, which writes `nbytes` to the pipe `fd`, and record the time it blocked.
+        If `fd` is `None`, i.e. the sink is not fed through a pipe, stalls and the occupancy of the
+        sink pipe are not recorded.
+        """
+        queued = pipe_occupancy(fd)
+        start = time.monotonic()
+        ret = write()
+        self._sink_written(fd, nbytes, queued, start, time.monotonic())
+        return ret
+
+    async def sink_drain(self, fd, nbytes, drain):
+        """ The asyncio counterpart of `sink_write()`, for `await drain()`. """
+        queued = pipe_occupancy(fd)
+        start = time.monotonic()
+        await drain()
+        self._sink_written(fd, nbytes, queued, start, time.monotonic())
+
+    def _sink_written(self, fd, nbytes, queued, start, end):
+        with self._lock:
+            stalled = queued == 0 and self._lastWrite is not None and start - self._lastWrite > self.stallGap
+            self._lastWrite = end
+        if stalled:
+            self.inc('stalls')
+        self.inc('sink_writes')
+        self.inc('sink_write_bytes', nbytes)
+        self.inc('sink_write_blocked_seconds', end - start)
+        queued = pipe_occupancy(fd)
+        if queued is not None:
+            self.set('sink_pipe_bytes', queued)
+
+    def snapshot(self):
+        """ Return a dictionary of all the metrics, e.g. for JSON encoding. """
+        ret = {}
+        with self._lock:
+            for (name, labels), value in sorted(self._values.items(), key=lambda kv: str(kv[0])):
+                if isinstance(value, list):
+                    value = {'count': value[-2], 'sum': round(value[-1], 4)}
+                key = name + ''.join('.%s' % v for _, v in labels)
+                ret[key] = value
+        return ret
+
+    def prometheus(self):
+        """ Return all the metrics in the Prometheus text exposition format. """
+        with self._lock:
+            values = sorted(((k, list(v) if isinstance(v, list) else v) for k, v in self._values.items()),
+                            key=lambda kv: str(kv[0]))
+        out = []
+        lastName = None
+        for (name, labels), value in values:
+            kind, help = self._HELP.get(name, ('untyped', name))
+            metric = '%s_%s%s' % (self.prefix, name, '_total' if kind == 'counter' else '')
+            if name != lastName:
+                out.append('# HELP %s %s' % (metric, help))
+                out.append('# TYPE %s %s' % (metric, kind))
+                lastName = name
+            fmt = lambda extra=(): '{%s}' % ','.join('%s="%s"' % kv for kv in labels + extra) \
+                if labels or extra else ''
+            if kind == 'histogram':
+                for bound, n in zip(self._BUCKETS, value):
+                    out.append('%s_bucket%s %d' % (metric, fmt((('le', str(bound)),)), n))
+                out.append('%s_bucket%s %d' % (metric, fmt((('le', '+Inf'),)), value[-2]))
+                out.append('%s_count%s %d' % (metric, fmt(), value[-2]))
+                out.append('%s_sum%s %s' % (metric, fmt(), value[-1]))
+            else:
+                out.append('%s%s %s' % (metric, fmt(), value))
+        return '\n'.join(out) + '\n'
+
+    def log_periodically(self, interval):
+        """ Log a JSON line with all the metrics and the segments fetched since the previous one
+        every `interval` seconds, from a background thread.
+        """
+        def run():
+            last = 0
+            while True:
+                time.sleep(interval)
+                with self._lock:
+                    segments = [s for s in self.recent if s['time'] > last]
+                    if segments:
+                        last = segments[-1]['time']
+                logging.info('metrics %s' % json.dumps(self.snapshot() | {'recent-segments': segments}))
+        Thread(target=run, daemon=True).start()
+
+    def serve(self, address):
+        """ Serve the metrics at `http://<address>/metrics` in the Prometheus text format, from
+        a background thread.  Returns the server.
+        """
+        # Imported here, as it pulls in a good part of the standard library
+        import http.server
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = http.server.ThreadingHTTPServer(address, Handler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+# Metrics of the streaming pipeline of this process
+metrics = PipelineMetrics()
@@ -0,0 +1,165 @@
+import logging
+import time
+from threading import Condition, Lock, Thread
+
+class SegmentPrefetcher:
+    """ Downloads the next segments of a sequence in parallel on a pool of worker threads and
+    yields them strictly in sequence order.  Downloaded segments are held in a ring buffer of
+    `depth` slots whose total size is capped to `maxBytes`, e.g.
+
+      segments = ((i, 'https://site.org/mpegts/%s.ts' % i) for i in itertools.count(1000))
+      for seq, data in SegmentPrefetcher(fetcher, segments, 4, 16 << 20):
+          sink.stdin.write(data)
+
+    Iteration stops once `segments` is exhausted; if a segment cannot be fetched, the exception
+    is raised by the iterator when that segment is due.
+    """
+    def __init__(self, fetcher, segments, depth, maxBytes, onFetched=None, onResponse=None, retries=0,
+                 validate=None):
+        """ Constructs a SegmentPrefetcher and starts its worker threads.
+
+        @param fetcher An HTTPFetcher instance
+        @param segments An iterator of `(seq, url)` tuples
+        @param depth Number of segments that may be fetched ahead, i.e. number of workers and slots
+        @param maxBytes Maximum number of bytes held in the buffer
+        @param onFetched If not `None`, a callable that is called as `onFetched(seq, nbytes, seconds)`
+        after each segment is downloaded
+        @param onResponse If not `None`, a callable that is called once the response headers of a
+        segment are received
+        @param retries Number of times a failed segment download is retried (see `HTTPFetcher.get()`)
+        @param validate If not `None`, a callable that checks each segment (see `HTTPFetcher.get()`)
+        """
+        self.fetcher = fetcher
+        self.onFetched = onFetched
+        self.onResponse = onResponse
+        self.retries = retries
+        self.validate = validate
+        self.segments = segments
+        self.depth = max(1, depth)
+        self.limit = self.depth
+        self.maxBytes = maxBytes
+        self._slots = [None] * self.depth
+        self._head = 0
+        self._next = 0
+        self._bytes = 0
+        self._inflight = 0
+        self._avgSize = 0
+        self._ended = False
+        self._closed = False
+        self._cond = Condition()
+        self._srcLock = Lock()
+        self._workers = [Thread(target=self._worker, daemon=True) for _ in range(self.depth)]
+        for w in self._workers:
+            w.start()
+
+    def set_depth(self, depth):
+        """ Limit the number of segments fetched ahead to `depth`, which is capped to the depth
+        given to the constructor; e.g. to follow the consumption rate of the sink.
+        """
+        with self._cond:
+            self.limit = max(1, min(depth, self.depth))
+            self._cond.notify_all()
+
+    def _has_room(self):
+        if self._next - self._head >= self.limit:
+            return False
+        # Always allow fetching the segment that is due; otherwise account for in-flight downloads
+        return self._next == self._head or \
+            self._bytes + (self._inflight + 1) * self._avgSize <= self.maxBytes
+
+    def _worker(self):
+        while True:
+            with self._srcLock:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed or self._ended or self._has_room())
+                    if self._closed or self._ended:
+                        return
+                    n = self._next
+                try:
+                    seq, url = next(self.segments)
+                except StopIteration:
+                    with self._cond:
+                        self._ended = True
+                        self._cond.notify_all()
+                    return
+                except Exception as e:
+                    # e.g. the playlist could not be polled; raised once the previous segments are consumed
+                    with self._cond:
+                        self._slots[n % self.depth] = [None, None, e]
+                        self._next += 1
+                        self._ended = True
+                        self._cond.notify_all()
+                    return
+                with self._cond:
+                    if self._closed:
+                        return
+                    self._slots[n % self.depth] = [seq, None, None]
+                    self._next += 1
+                    self._inflight += 1
+
+            data, err = None, None
+            try:
+                startTime = time.perf_counter()
+                data = self.fetcher.get(url, onResponse=self.onResponse, retries=self.retries,
+                                        validate=self.validate)
+                if self.onFetched:
+                    self.onFetched(seq, len(data), time.perf_counter() - startTime)
+            except Exception as e:
+                err = e
+            with self._cond:
+                self._inflight -= 1
+                slot = self._slots[n % self.depth]
+                if self._closed or slot is None or slot[0] != seq:
+                    return
+                slot[1], slot[2] = data, err
+                if data is not None:
+                    self._bytes += len(data)
+                    self._avgSize = len(data) if not self._avgSize else (self._avgSize * 7 + len(data)) // 8
+                self._cond.notify_all()
+
+    def __iter__(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: (self._ended and self._head == self._next)
+                                    or (self._head < self._next
+                                        and self._slots[self._head % self.depth][1:] != [None, None]))
+                if self._head == self._next:
+                    return
+                seq, data, err = self._slots[self._head % self.depth]
+                self._slots[self._head % self.depth] = None
+                self._head += 1
+                if data is not None:
+                    self._bytes -= len(data)
+                self._cond.notify_all()
+            if err:
+                raise err
+            logging.debug('Prefetch buffer: %(segments)d/%(depth)d segments, %(bytes)d/%(max-bytes)d bytes'
+                          % self.fill())
+            yield seq, data
+
+    def fill(self):
+        """ Return a dictionary that describes how full the buffer is. """
+        with self._cond:
+            return {'segments': self._next - self._head - self._inflight,
+                    'inflight': self._inflight,
+                    'depth': self.limit,
+                    'bytes': self._bytes,
+                    'max-bytes': self.maxBytes}
+
+    def close(self):
+        """ Stop the worker threads and discard buffered segments.  The segment source is closed
+        too, so that a worker blocked waiting for the next segment (e.g. a `LivePlaylistScheduler`
+        waiting for the next poll) returns.
+        """
+        with self._cond:
+            self._closed = True
+            self._slots = [None] * self.depth
+            self._bytes = 0
+            self._cond.notify_all()
+        close = getattr(self.segments, 'close', None)
+        if close:
+            try:
+                close()
+            except ValueError:
+                # A generator that is running in a worker; it does not block, though
+                pass
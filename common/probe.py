@@ -0,0 +1,75 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# An alternative is recommended if its segments download this many times faster than real time
+_REALTIME_MARGIN = 1.5
+
+def _summarize(result):
+    """ Add the aggregate figures of the segments fetched to a `probe_stream()` result. """
+    segments = result['segments']
+    nbytes = sum(s['bytes'] for s in segments)
+    seconds = sum(s['seconds'] for s in segments)
+    duration = sum(s['duration'] for s in segments)
+    result |= {'ttfb': segments[0]['ttfb'] if segments else None,
+               'throughput-bps': int(nbytes * 8 / seconds) if seconds > 0 else None,
+               'duration': duration,
+               'download-seconds': seconds,
+               'realtime-factor': duration / seconds if seconds > 0 else None}
+    return result
+
+def _probe_alternative(provider, channel, info, alternative, segments):
+    ret = {'channel': channel, 'alternative': alternative}
+    startTime = time.perf_counter()
+    try:
+        ret |= _summarize(provider.probe_stream(info, alternative, segments))
+        ret['ok'] = bool(ret['segments'])
+    except Exception as err:
+        ret |= {'ok': False, 'error': str(err)}
+    ret['seconds'] = time.perf_counter() - startTime
+    return ret
+
+def _stream_info(provider, channel):
+    try:
+        return provider.get_stream_info(channel)
+    except Exception as err:
+        return err
+
+def probe_channels(provider, channels=None, workers=8, segments=2):
+    """ Probe every alternative of the given channels (by default, all of them, as per
+    `get_channel_list()`) on a pool of `workers` threads: first the stream information of each
+    channel is resolved, then `provider.probe_stream()` is called for each alternative.
+
+    Returns a list of dictionaries, one per alternative, sorted by channel and alternative.  Each
+    holds the `channel`, `alternative` and `ok` keys, plus either `error` or the result of
+    `probe_stream()` with the time to first byte of the first segment (`ttfb`), the throughput
+    (`throughput-bps`), the total duration of the segments, the time it took to fetch them
+    (`download-seconds`) and their ratio (`realtime-factor`).  If the stream information of a
+    channel could not be resolved, there is a single entry with `alternative` set to `None`.
+    Among the alternatives of a channel, the one with the highest bandwidth whose realtime factor
+    is at least `_REALTIME_MARGIN` is marked as `recommended`.
+    """
+    if channels is None:
+        channels = list(provider.get_channel_list())
+    ret = []
+    with ThreadPoolExecutor(workers) as pool:
+        infos = list(pool.map(lambda c: _stream_info(provider, c), channels))
+        jobs = []
+        for channel, info in zip(channels, infos):
+            if isinstance(info, Exception):
+                logging.debug("'%s': %s" % (channel, info))
+                ret += [{'channel': channel, 'alternative': None, 'ok': False, 'error': str(info)}]
+                continue
+            jobs += [pool.submit(_probe_alternative, provider, channel, info, i, segments)
+                     for i in range(len(info['alt']))]
+        ret += [j.result() for j in jobs]
+
+    ret.sort(key=lambda r: (channels.index(r['channel']), r['alternative'] or 0))
+    for channel in channels:
+        usable = [r for r in ret if r['channel'] == channel and r['ok']
+                  and (r['realtime-factor'] or 0) >= _REALTIME_MARGIN]
+        best = max(usable, key=lambda r: (r.get('bandwidth', 0), r['throughput-bps']), default=None)
+        for r in ret:
+            if r['channel'] == channel and r['alternative'] is not None:
+                r['recommended'] = r is best
+    return ret
@@ -58,3 +58,17 @@ class ContentProvider:
         @return An instance of an AVSource subclass
         """
         pass
+
+    @abstractmethod
+    def probe_stream(self, streamInfo, alternative, segments=2):
+        """ Check the health of an alternative of a stream by fetching its last `segments` MPEG TS
+        segments (see `probe_channels()`).
+
+        @param streamInfo Stream information, as returned by `get_stream_info()`
+        @param alternative Alternative #.
+        @param segments Number of segments to fetch
+        @return A dictionary that contains, at least, the `segments` key: a list of dictionaries
+        with the `seq`, `duration`, `bytes`, `ttfb` and `seconds` keys, one per segment fetched.
+        Errors are raised as exceptions
+        """
+        pass
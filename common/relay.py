@@ -0,0 +1,449 @@
+import http.server
+import json
+import logging
+import math
+import random
+import time
+import urllib.parse
+from collections import OrderedDict, deque
+from threading import Condition, Lock, Thread
+from common.fanout import FanoutSink
+from common.metrics import metrics
+from common.tsmux import PAT_PID, TS_PACKET_SIZE, parse_pat, pes_timestamp, psi_section
+
+class SegmentCache:
+    """ Memory-bounded LRU cache of the segments produced by the relayed channels.  It is shared
+    by all the channels, so that the least recently requested segments are evicted first,
+    regardless of their channel.
+    """
+    def __init__(self, maxBytes):
+        """ Constructs a SegmentCache.
+
+        @param maxBytes Maximum number of bytes held
+        """
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def put(self, key, data):
+        with self._lock:
+            self._entries[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.maxBytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.counters['evictions'] += 1
+
+    def get(self, key):
+        """ Return the data stored for `key` (and mark it as recently used), or `None`. """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return data
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def stats(self):
+        with self._lock:
+            return {'segments': len(self._entries), 'bytes': self.bytes} | self.counters
+
+class ChannelRelay:
+    """ Fetches a channel once, via the `get_av_source()` method of a `ContentProvider`, and cuts the
+    resulting transport stream into segments that are stored in a `SegmentCache`.  The A/V source
+    writes into a `FanoutSink` whose only output is this object (see `write()`).
+
+    Segments are cut at a PAT once they span at least `segmentDuration` seconds (as per the
+    timestamps of the first elementary stream), so that each one can be decoded on its own.  If
+    the stream carries no PAT for twice that long, the segment is cut at the next PES packet
+    and the last PAT/PMT are repeated at the start of the new one.
+    """
+    _MAX_RETRIES = 5
+    _MAX_BACKOFF = 30
+
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+        self.epoch = time.time_ns()
+        self.cache = server.cache
+        self.segmentDuration = server.segmentDuration
+        self.cond = Condition()
+        self.listed = deque()
+        self.nextSeq = 0
+        self.discontinuitySeq = 0
+        self.tsClients = 0
+        self.hlsClients = {}
+        self.waiting = 0
+        self.lastAccess = time.monotonic()
+        self.source = None
+        self.failed = False
+        self.stopped = False
+        # State of the segment being cut
+        self._current = bytearray()
+        self._start = self._last = None
+        self._refPid = None
+        self._pmtPid = None
+        self._psi = {}
+        self._discontinuity = False
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """ Stop fetching the channel; this takes effect on the next write of the A/V source. """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def _resolve(self):
+        provider = self.server.provider
+        with self.server.providerLock:
+            info = provider.get_stream_info(self.name)
+            return provider.get_av_source(info, self.server.alternative)
+
+    def _run(self):
+        sink = FanoutSink(self.server.sinkBuffer)
+        sink.add(self.name, self)
+        failures = 0
+        try:
+            logging.info('Relay (%s): starting' % self.name)
+            self.source = self._resolve()
+            while not self.stopped:
+                startTime = time.monotonic()
+                retry = self.source.run(sink)
+                if not retry or self.stopped:
+                    break
+                if time.monotonic() - startTime >= self._MAX_BACKOFF:
+                    failures = 0
+                failures += 1
+                if failures > self._MAX_RETRIES:
+                    logging.error('Relay (%s): A/V source died %d times in a row; giving up'
+                                  % (self.name, failures - 1))
+                    break
+                time.sleep(min(self._MAX_BACKOFF, 2 ** (failures - 1)) * random.uniform(0.5, 1.5))
+                metrics.inc('restarts')
+                if not self.source.resumable():
+                    logging.info('Relay (%s): cannot resume A/V source; getting stream information again'
+                                 % self.name)
+                    self.source = self._resolve()
+                    self._discontinuity = True
+        except Exception as err:
+            logging.error('Relay (%s): %s' % (self.name, err))
+        finally:
+            with self.cond:
+                self.failed = not self.stopped
+                self.stopped = True
+                self.cond.notify_all()
+            sink.close()
+            logging.info('Relay (%s): stopped' % self.name)
+
+    def write(self, data):
+        """ Called by the `FanoutSink` with whole TS packets of the relayed stream. """
+        if self.stopped:
+            raise BrokenPipeError('Relay stopped')
+        mv = memoryview(data)
+        cut = 0
+        for i in range(0, len(mv) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+            if not mv[i + 1] & 0x40:
+                continue
+            pid = ((mv[i + 1] & 0x1F) << 8) | mv[i + 2]
+            pkt = mv[i:i + TS_PACKET_SIZE]
+            if pid == PAT_PID or pid == self._pmtPid:
+                if pid == PAT_PID:
+                    if self._elapsed() >= self.segmentDuration:
+                        self._current += mv[cut:i]
+                        cut = i
+                        self._publish()
+                    section = psi_section(pkt)
+                    if section:
+                        self._pmtPid = parse_pat(section)
+                self._psi[pid] = bytes(pkt)
+                continue
+            ts = pes_timestamp(pkt)
+            if ts is None or (self._refPid is not None and pid != self._refPid):
+                continue
+            self._refPid = pid
+            if self._elapsed() >= 2 * self.segmentDuration and PAT_PID in self._psi:
+                self._current += mv[cut:i]
+                cut = i
+                self._publish()
+                self._current += b''.join(self._psi.values())
+            if self._start is None or ts < self._last:
+                # First timestamp of this segment, or a discontinuity
+                self._start = ts
+            self._last = ts
+        self._current += mv[cut:]
+
+    def close(self):
+        pass
+
+    def _elapsed(self):
+        if self._start is None:
+            return 0
+        return (self._last - self._start) / 90000
+
+    def _publish(self):
+        if not self._current:
+            return
+        duration = self._elapsed()
+        data, self._current = bytes(self._current), bytearray()
+        self._start = self._last
+        with self.cond:
+            seq = self.nextSeq
+            self.nextSeq += 1
+            self.cache.put((self.name, self.epoch, seq), data)
+            self.listed.append((seq, duration, self._discontinuity))
+            self._discontinuity = False
+            while len(self.listed) > self.server.window:
+                if self.listed.popleft()[2]:
+                    self.discontinuitySeq += 1
+            self.cond.notify_all()
+
+    def segment(self, seq):
+        return self.cache.get((self.name, self.epoch, seq))
+
+    def wait_segments(self, n, timeout):
+        """ Wait until at least `n` segments are listed; returns `False` if the relay stopped or
+        the timeout expired.
+        """
+        with self.cond:
+            self.waiting += 1
+            try:
+                return self.cond.wait_for(lambda: len(self.listed) >= n or self.stopped, timeout) \
+                    and len(self.listed) >= n
+            finally:
+                self.waiting -= 1
+                self.lastAccess = time.monotonic()
+
+    def playlist(self):
+        """ Return the HLS media playlist of the segments that are still cached. """
+        with self.cond:
+            listed = [s for s in self.listed if (self.name, self.epoch, s[0]) in self.cache]
+            discontinuitySeq = self.discontinuitySeq
+        targetDuration = max([math.ceil(d) for _, d, _ in listed] + [math.ceil(self.segmentDuration)])
+        s = '#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:%d\n#EXT-X-MEDIA-SEQUENCE:%d\n' \
+            '#EXT-X-DISCONTINUITY-SEQUENCE:%d\n' % (targetDuration, listed[0][0] if listed else 0,
+                                                   discontinuitySeq)
+        for seq, duration, discontinuity in listed:
+            if discontinuity:
+                s += '#EXT-X-DISCONTINUITY\n'
+            s += '#EXTINF:%.3f,\n%d.ts\n' % (duration, seq)
+        return s
+
+    def touch(self, client=None):
+        """ Record an access to this channel; `client` identifies an HLS client. """
+        now = time.monotonic()
+        with self.cond:
+            self.lastAccess = now
+            if client:
+                self.hlsClients[client] = now
+
+    def idle(self):
+        """ Return the number of seconds since this channel was last accessed; 0 while any
+        continuous stream client is connected or any client waits for the first segments.
+        """
+        with self.cond:
+            return 0 if self.tsClients or self.waiting else time.monotonic() - self.lastAccess
+
+    def stats(self):
+        now = time.monotonic()
+        with self.cond:
+            # An HLS client is considered gone once it stops polling the playlist
+            expiry = 3 * max([self.segmentDuration] + [d for _, d, _ in self.listed])
+            for client, t in list(self.hlsClients.items()):
+                if now - t > expiry:
+                    del self.hlsClients[client]
+            ret = {'ts-clients': self.tsClients,
+                   'hls-clients': len(self.hlsClients),
+                   'segments': len(self.listed),
+                   'state': 'failed' if self.failed else 'stopped' if self.stopped else 'running'}
+        if self.source:
+            ret['source'] = self.source.stats()
+        return ret
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug('Relay: %s - %s' % (self.client_address[0], format % args))
+
+    def send(self, body, contentType, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = urllib.parse.unquote(self.path.partition('?')[0])
+        try:
+            if path == '/status':
+                return self.send(json.dumps(server.stats()).encode(), 'application/json')
+            if path == '/channels.m3u':
+                return self.send(server.channel_playlist(self.headers.get('Host')).encode(),
+                                 'audio/x-mpegurl')
+
+            parts = path.split('/')
+            if len(parts) != 4 or parts[1] != 'channel':
+                return self.send(b'', 'text/plain', 404)
+            # Only playlist and stream requests start a relay; a client that still holds the playlist
+            # of a reaped channel gets 404 for its segments
+            relay = server.channel(parts[2], start=parts[3] in ('index.m3u8', 'live.ts'))
+            if not relay:
+                return self.send(b'', 'text/plain', 404)
+            if parts[3] == 'live.ts':
+                return self.stream(relay)
+            relay.touch(self.client_address[0])
+            if parts[3] == 'index.m3u8':
+                if not relay.wait_segments(server.minSegments, server.startTimeout):
+                    return self.send(b'', 'text/plain', 503)
+                return self.send(relay.playlist().encode(), 'application/vnd.apple.mpegurl')
+            seq = parts[3].removesuffix('.ts')
+            data = relay.segment(int(seq)) if seq.isdigit() else None
+            if data is None:
+                return self.send(b'', 'text/plain', 404)
+            self.send(data, 'video/mp2t')
+        except ConnectionError:
+            pass
+
+    def stream(self, relay):
+        """ Serve the channel as a continuous transport stream, starting at the newest segment. """
+        server = self.server
+        if not relay.wait_segments(1, server.startTimeout):
+            return self.send(b'', 'text/plain', 503)
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        with relay.cond:
+            relay.tsClients += 1
+            seq = relay.listed[-1][0]
+        try:
+            while True:
+                data = relay.segment(seq)
+                if data is None:
+                    # Evicted before it was sent, i.e. this client is lagging behind; skip ahead to the
+                    # newest segment, or wait for a newer one if that is the evicted one (e.g. evicted by
+                    # the traffic of another channel)
+                    with relay.cond:
+                        if not relay.listed or relay.listed[-1][0] < seq:
+                            break
+                        if not relay.cond.wait_for(lambda: relay.listed[-1][0] > seq or relay.stopped,
+                                                   server.startTimeout) or relay.stopped:
+                            break
+                        logging.warning('Relay (%s): client %s is lagging behind; skipping to segment %d'
+                                        % (relay.name, self.client_address[0], relay.listed[-1][0]))
+                        seq = relay.listed[-1][0]
+                    continue
+                self.wfile.write(data)
+                seq += 1
+                with relay.cond:
+                    if not relay.cond.wait_for(lambda: relay.nextSeq > seq or relay.stopped,
+                                               server.startTimeout) or relay.nextSeq <= seq:
+                        break
+        finally:
+            with relay.cond:
+                relay.tsClients -= 1
+                relay.lastAccess = time.monotonic()
+
+class RelayServer(http.server.ThreadingHTTPServer):
+    """ Relays the live channels of a content provider over HTTP, so that several players in a
+    LAN share a single upstream session, e.g.
+
+      server = RelayServer(('', 8080), provider)
+      server.serve_forever()
+
+    A channel is fetched (once, see `ChannelRelay`) while it has clients, and served either as
+    an HLS media playlist or as a continuous MPEG transport stream:
+
+      /channels.m3u                 Playlist of the continuous stream of every channel
+      /channel/<name>/index.m3u8    HLS media playlist; segments are `/channel/<name>/<seq>.ts`
+      /channel/<name>/live.ts       Continuous MPEG transport stream
+      /status                       Per-channel client counts and cache statistics (JSON)
+
+    Segments are kept in a `SegmentCache` of `cacheBytes` shared by all the channels.  A channel
+    is stopped once no client requested it for `idleTimeout` seconds; only requests for the media
+    playlist or the continuous stream start it again, i.e. segment requests get 404 meanwhile.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, provider, alternative=-1, cacheBytes=256 << 20, segmentDuration=4.0,
+                 window=6, idleTimeout=30, sinkBuffer=16 << 20):
+        """ Constructs a RelayServer.
+
+        @param address `(host, port)` to listen on
+        @param provider A ContentProvider instance
+        @param alternative Alternative # of every channel (see `ContentProvider.get_av_source()`)
+        @param cacheBytes Size of the segment cache, in bytes
+        @param segmentDuration Minimum duration of a relayed segment, in seconds
+        @param window Number of segments listed in the media playlists
+        @param idleTimeout Seconds without clients after which a channel is stopped
+        @param sinkBuffer Bytes buffered between an A/V source and its `ChannelRelay`
+        """
+        super().__init__(address, _Handler)
+        self.provider = provider
+        self.providerLock = Lock()
+        self.alternative = alternative
+        self.cache = SegmentCache(cacheBytes)
+        self.segmentDuration = segmentDuration
+        self.window = window
+        self.minSegments = min(2, window)
+        self.startTimeout = 3 * segmentDuration + 15
+        self.idleTimeout = idleTimeout
+        self.sinkBuffer = sinkBuffer
+        self.channels = {}
+        self._lock = Lock()
+        Thread(target=self._reap, daemon=True).start()
+
+    def channel_names(self):
+        with self.providerLock:
+            return list(self.provider.get_channel_list())
+
+    def channel(self, name, start=True):
+        """ Return the `ChannelRelay` for `name`, which is started if needed, or `None` if there is
+        no such channel.  If `start` is `False`, return the current relay of `name`, if any.
+        """
+        with self._lock:
+            relay = self.channels.get(name)
+            if (relay and not relay.stopped) or not start:
+                return relay
+        if name not in self.channel_names():
+            return None
+        with self._lock:
+            relay = self.channels.get(name)
+            if not relay or relay.stopped:
+                relay = self.channels[name] = ChannelRelay(self, name)
+                relay.start()
+            return relay
+
+    def channel_playlist(self, host):
+        s = '#EXTM3U\n'
+        for name in self.channel_names():
+            s += '#EXTINF:-1,%s\nhttp://%s/channel/%s/live.ts\n' % (name, host, urllib.parse.quote(name))
+        return s
+
+    def _reap(self):
+        while True:
+            time.sleep(self.idleTimeout / 3)
+            with self._lock:
+                for name, relay in list(self.channels.items()):
+                    if relay.idle() > self.idleTimeout:
+                        logging.info('Relay (%s): no clients for %ds' % (name, self.idleTimeout))
+                        relay.stop()
+                        del self.channels[name]
+
+    def stats(self):
+        with self._lock:
+            channels = dict(self.channels)
+        return {'channels': {name: relay.stats() for name, relay in channels.items()},
+                'cache': self.cache.stats()}
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import re
+import time
+import urllib.parse
+from threading import Event
+from common.fetcher import FetchError
+from common.m3u import M3UPlaylist
+from common.metrics import metrics
+
+class SegmentGoneError(FetchError):
+    """ Raised if the segment to resume at is no longer listed in the media playlist. """
+    def __init__(self, url, seq, first):
+        super().__init__(url, reason='segment %d is no longer listed (first is %d)' % (seq, first))
+        self.seq = seq
+
+class LivePlaylistScheduler:
+    """ An iterator of `(seq, url)` tuples for the segments of a live media playlist (RFC 8216).
+    In contrast to counting up from an initial sequence number, only segments that are already
+    listed in the playlist are returned; the playlist is re-polled on the `EXT-X-TARGETDURATION`
+    cadence and the iterator blocks until a new segment is published, e.g.
+
+      for seq, url in LivePlaylistScheduler(fetcher, 'https://site.org/live/video.m3u8'):
+          fetcher.fetch(url, sink.stdin)
+
+    If given, `urlTemplate` (e.g. `https://site.org/live/video-%s.ts`) is used to extract the
+    sequence number from the segment href and to generate its URL; otherwise, the sequence number
+    is derived from `EXT-X-MEDIA-SEQUENCE` and the URL is resolved relative to the playlist.
+
+    The scheduler can also be consumed with `async for` if `fetcher` is an `AsyncHTTPFetcher`.
+
+    If `resume` is `True`, `startAt` is the segment that follows the last one delivered by a
+    previous run; if it already fell off the playlist, `SegmentGoneError` is raised instead of
+    skipping ahead.
+
+    If `maxBehind` is not `None`, at most that many segments are kept queued; i.e. if the consumer
+    falls further behind the live edge, the oldest segments are skipped (see `FlowController`).
+
+    `close()` ends the iteration, also if another thread is blocked waiting for the next poll.
+    `behind()` tells how far a segment is behind the live edge.
+    """
+    _MAX_POLL_FAILURES = 3
+
+    def __init__(self, fetcher, playlistUrl, urlTemplate=None, startAt=None, liveEdgeSegments=3,
+                 resume=False):
+        """ Constructs a LivePlaylistScheduler.
+
+        @param fetcher An HTTPFetcher (or AsyncHTTPFetcher, see above) instance
+        @param playlistUrl URL of the media playlist
+        @param urlTemplate Template used for URL generation, e.g. `https://domain.tld/path/%s.ts`
+        @param startAt Sequence number of the first segment to return.  If `None`, start
+        `liveEdgeSegments` segments behind the live edge
+        @param liveEdgeSegments Distance to the live edge, in segments, if `startAt` is `None`
+        @param resume Whether `startAt` must not be skipped (see above)
+        """
+        self.fetcher = fetcher
+        self.playlistUrl = playlistUrl
+        self.next = startAt
+        self.liveEdgeSegments = max(1, liveEdgeSegments)
+        self.targetDuration = None
+        self._set_template(urlTemplate)
+        self._pending = []
+        self._lastSeq = None
+        self._nextPoll = 0
+        self._switchTo = None
+        self.maxBehind = None
+        self.skipped = 0
+        self._closed = Event()
+        # Previous version of the playlist and `segments()` results, for incremental parsing
+        self._playlist = None
+        self._listed = {}
+        # `(seq, duration)` of the segments listed by the last poll, and when the newest appeared
+        self._edge = None
+        self.resume = resume and startAt is not None
+        # The caller saw `startAt` listed, so it can be requested while the playlist is polled
+        if startAt is not None and urlTemplate and not self.resume:
+            self._pending = [(startAt, urlTemplate % startAt)]
+
+    def _set_template(self, urlTemplate):
+        self.urlTemplate = urlTemplate
+        self._seqRe = None
+        if urlTemplate:
+            name = urlTemplate.rpartition('/')[2]
+            self._seqRe = re.compile(re.escape(name).replace('%s', '([0-9]+)') + '$')
+
+    def switch(self, playlistUrl, urlTemplate=None):
+        """ Switch to a different media playlist, e.g. another variant of the same stream, at the
+        next segment boundary.  Segments of both playlists should carry the same sequence numbers.
+        This method may be called from any thread.
+        """
+        self._switchTo = (playlistUrl, urlTemplate)
+
+    def _apply_switch(self):
+        if self._switchTo:
+            self.playlistUrl, urlTemplate = self._switchTo
+            self._switchTo = None
+            self._set_template(urlTemplate)
+            self._pending = []
+            self._lastSeq = None
+            self._nextPoll = 0
+            self._playlist = None
+            self._listed = {}
+
+    def close(self):
+        """ Stop the iteration; this method may be called from any thread. """
+        self._closed.set()
+
+    def _poll_failed(self, err, failures):
+        if isinstance(err, SegmentGoneError) or failures >= self._MAX_POLL_FAILURES:
+            raise err
+        logging.debug('Polling media playlist failed: %s' % err)
+        metrics.fetch_error(err.status)
+        self._nextPoll = time.monotonic() + (self.targetDuration or 2) / 2
+
+    def _pop(self):
+        seq, url = self._pending.pop(0)
+        self.next = seq + 1
+        return seq, url
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._apply_switch()
+        failures = 0
+        while not self._pending:
+            delay = self._nextPoll - time.monotonic()
+            if self._closed.wait(delay) if delay > 0 else self._closed.is_set():
+                raise StopIteration
+            try:
+                startTime = time.perf_counter()
+                self.poll()
+                metrics.observe('playlist_fetch_seconds', time.perf_counter() - startTime)
+                failures = 0
+            except FetchError as err:
+                failures += 1
+                self._poll_failed(err, failures)
+        return self._pop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self._apply_switch()
+        failures = 0
+        while not self._pending:
+            delay = self._nextPoll - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self._closed.is_set():
+                raise StopAsyncIteration
+            try:
+                startTime = time.perf_counter()
+                content = await self.fetcher.get(self.playlistUrl)
+                metrics.observe('playlist_fetch_seconds', time.perf_counter() - startTime)
+                self.update(content)
+                failures = 0
+            except FetchError as err:
+                failures += 1
+                self._poll_failed(err, failures)
+        return self._pop()
+
+    def segments(self, playlist):
+        """ Return the list of `(seq, url, duration)` tuples listed in the given media playlist. """
+        ret = []
+        listed = {}
+        mediaSeq = playlist.mediaSequence or 0
+        for i, entry in enumerate(playlist):
+            # Entries reused from the previous poll (see `M3UPlaylist`) were already processed
+            segment = self._listed.get(entry)
+            if segment is None:
+                duration = 0
+                for k, v in entry.attrs:
+                    if k == 'EXT-X-TARGETDURATION':
+                        self.targetDuration = int(v)
+                    elif k == 'EXTINF':
+                        duration = float(v.partition(',')[0] or 0)
+                m = self._seqRe and re.search(self._seqRe, entry.href.rpartition('/')[2].partition('?')[0])
+                if m:
+                    segment = (int(m[1]), self.urlTemplate % m[1], duration)
+                else:
+                    segment = (mediaSeq + i, urllib.parse.urljoin(self.playlistUrl, entry.href), duration)
+            listed[entry] = segment
+            ret.append(segment)
+        self._listed = listed
+        return ret
+
+    def behind(self, seq):
+        """ Return how far the segment `seq` is behind the live edge, in seconds, as per the last poll:
+        the duration of the segments listed after it, plus the time elapsed since the newest one
+        appeared.  Returns `None` if the playlist was not polled yet.  This method may be called
+        from any thread.
+        """
+        edge = self._edge
+        if not edge:
+            return None
+        listed, seenAt = edge
+        # Segments that fell off the playlist count as of the target duration
+        gone = max(0, listed[0][0] - seq - 1) * (self.targetDuration or 0)
+        return gone + sum(d for s, d in listed if s > seq) + time.monotonic() - seenAt
+
+    def poll(self):
+        """ Fetch the media playlist and queue the segments not yet returned. """
+        self.update(self.fetcher.get(self.playlistUrl))
+
+    def update(self, content):
+        """ Queue the segments not yet returned from `content`, the body of the media playlist. """
+        playlist = M3UPlaylist(content.decode('utf-8'), expectExtm3u=True, previous=self._playlist)
+        self._playlist = playlist
+        listed = self.segments(playlist)
+        now = time.monotonic()
+        if not listed:
+            self._nextPoll = now + (self.targetDuration or 2) / 2
+            return
+
+        if self.next is None:
+            self.next = listed[max(0, len(listed) - self.liveEdgeSegments)][0]
+            logging.debug('Starting at segment %d (live edge is %d)' % (self.next, listed[-1][0]))
+        elif self.next < listed[0][0]:
+            if self.resume:
+                raise SegmentGoneError(self.playlistUrl, self.next, listed[0][0])
+            logging.warning('Segment %d is no longer listed in the playlist; skipping to %d'
+                            % (self.next, listed[0][0]))
+            self.next = listed[0][0]
+
+        self.resume = False
+        newest = self._pending[-1][0] if self._pending else self.next - 1
+        self._pending += [(seq, url) for seq, url, _ in listed if seq > newest]
+        if self.maxBehind is not None and len(self._pending) > self.maxBehind:
+            skipped = len(self._pending) - self.maxBehind
+            logging.info('Skipping %d segment(s) to catch up with the live edge' % skipped)
+            del self._pending[:skipped]
+            self.skipped += skipped
+        # RFC 8216, Section 6.3.4: if the playlist did not change, wait one-half the target duration
+        changed = listed[-1][0] != self._lastSeq
+        self._lastSeq = listed[-1][0]
+        self._edge = ([(seq, duration) for seq, _, duration in listed],
+                      now if changed or not self._edge else self._edge[1])
+        self._nextPoll = now + (self.targetDuration or 2) / (1 if changed else 2)
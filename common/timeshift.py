@@ -0,0 +1,235 @@
+import bisect
+import fcntl
+import logging
+import mmap
+import os
+import tempfile
+from threading import Condition, Thread
+from common.tsmux import PAT_PID, TS_PACKET_SIZE, pes_timestamp
+
+class TimeshiftBuffer:
+    """ Records the output of an A/V source into a fixed-size ring file that is memory-mapped, and
+    plays it to `sink` from a movable cursor, so that the stream can be paused, rewound and
+    fast-forwarded up to the live edge, e.g.
+
+      sink = TimeshiftBuffer(subprocess.Popen(['ffplay', '-'], stdin=subprocess.PIPE), 1 << 30)
+      source.run(sink)       # in another thread
+      sink.pause()
+      sink.rewind(30)
+      sink.live()
+
+    Instances of this class can be used in place of the `subprocess.Popen` instance passed to
+    `AVSource.run()`.  Recording never blocks the A/V source; once the ring is full, the oldest
+    data is overwritten and a cursor that falls behind it is moved forward.
+
+    The ring is indexed at every PAT, i.e. at the points where the player can resynchronize;
+    each index entry holds the offset, a sequence number and the first timestamp (90 kHz) that
+    follows it.  The cursor only jumps to index entries.  The ring lives in the page cache, so
+    that memory use does not depend on `size`.
+
+    `close()` lets the player write out the data between the cursor and the live edge first, unless
+    playback is paused.
+    """
+    _PIPE_SIZE = 1048576
+    _BUF_SIZE = 65536 - 65536 % TS_PACKET_SIZE
+    # `stdin` is drained by a thread; see `sink_pipe()`
+    buffered = True
+
+    def __init__(self, sink, size=1 << 30, path=None):
+        """ Constructs a TimeshiftBuffer.
+
+        @param sink A `subprocess.Popen` instance (or anything with `stdin` and `poll()`) to play to
+        @param size Size of the ring, in bytes
+        @param path Path of the ring file; if `None`, an anonymous temporary file is used
+        """
+        self.sink = sink
+        self.size = size - size % TS_PACKET_SIZE
+        if self.size < self._BUF_SIZE:
+            raise ValueError('Timeshift buffer size must be at least %d bytes' % self._BUF_SIZE)
+        self._fh = open(path, 'w+b') if path else tempfile.TemporaryFile(prefix='timeshift-')
+        self._fh.truncate(self.size)
+        self._mm = mmap.mmap(self._fh.fileno(), self.size)
+        # Positions are absolute byte counts; the ring holds [writePos - size, writePos)
+        self.writePos = 0
+        self.cursor = 0
+        self.paused = False
+        self.index = []
+        self._nextSeq = 0
+        self._refPid = None
+        self._closed = False
+        # Set once the recorder reached the end of its input
+        self._ended = False
+        self._overrun = False
+        self._cond = Condition()
+
+        rfd, wfd = os.pipe()
+        try:
+            fcntl.fcntl(wfd, fcntl.F_SETPIPE_SZ, self._PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass
+        self._fhIn = os.fdopen(rfd, 'rb', buffering=0)
+        self.stdin = os.fdopen(wfd, 'wb', buffering=0)
+        self._recorder = Thread(target=self._record, daemon=True)
+        self._player = Thread(target=self._play, daemon=True)
+        self._recorder.start()
+        self._player.start()
+
+    def _index(self, data, pos):
+        """ Add an index entry for each PAT in `data` (whole TS packets written at `pos`). """
+        mv = memoryview(data)
+        for i in range(0, len(mv), TS_PACKET_SIZE):
+            if not mv[i + 1] & 0x40:
+                continue
+            pid = ((mv[i + 1] & 0x1F) << 8) | mv[i + 2]
+            if pid == PAT_PID:
+                self.index.append([pos + i, self._nextSeq, None])
+                self._nextSeq += 1
+            elif self.index and self.index[-1][2] is None and pid == (self._refPid or pid):
+                ts = pes_timestamp(mv[i:i + TS_PACKET_SIZE])
+                if ts is not None:
+                    self._refPid = pid
+                    self.index[-1][2] = ts
+
+    def _record(self):
+        buf = bytearray(self._BUF_SIZE)
+        partial = b''
+        try:
+            while not self._closed and (n := self._fhIn.readinto(buf)):
+                data = partial + buf[:n]
+                cut = len(data) - len(data) % TS_PACKET_SIZE
+                data, partial = data[:cut], data[cut:]
+                with self._cond:
+                    pos = self.writePos
+                    off = pos % self.size
+                    head = min(len(data), self.size - off)
+                    self._mm[off:off + head] = data[:head]
+                    self._mm[0:len(data) - head] = data[head:]
+                    self.writePos += len(data)
+                    self._index(data, pos)
+                    self._trim()
+                    self._cond.notify_all()
+        finally:
+            # Make further writes to `stdin` fail, so that the A/V source stops
+            self._fhIn.close()
+            with self._cond:
+                self._ended = True
+                self._cond.notify_all()
+
+    def _trim(self):
+        oldest = self.writePos - self.size
+        if oldest <= 0:
+            return
+        drop = bisect.bisect_left(self.index, oldest, key=lambda e: e[0])
+        del self.index[:drop]
+        if self.cursor < oldest:
+            self.cursor = self.index[0][0] if self.index else self.writePos
+            if not self._overrun:
+                logging.warning('Timeshift: the cursor fell out of the buffer; skipping ahead')
+                self._overrun = True
+
+    def _play(self):
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed or self._ended
+                                        or (not self.paused and self.cursor < self.writePos))
+                    if self._closed or (self._ended and (self.paused or self.cursor >= self.writePos)):
+                        break
+                    pos = self.cursor
+                    off = pos % self.size
+                    n = min(self.writePos - pos, self._BUF_SIZE, self.size - off)
+                    data = self._mm[off:off + n]
+                self.sink.stdin.write(data)
+                with self._cond:
+                    # Unless the cursor was moved in the meantime
+                    if self.cursor == pos:
+                        self.cursor = pos + n
+                        self._overrun = False
+        except OSError as err:
+            logging.debug('Timeshift: sink closed: %s' % err)
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+    def _entry(self, pos):
+        """ Return the position in `index` of the last entry at or before `pos`. """
+        return max(0, bisect.bisect_right(self.index, pos, key=lambda e: e[0]) - 1)
+
+    def _seek(self, seconds):
+        with self._cond:
+            if not self.index:
+                return
+            i = self._entry(self.cursor)
+            pts = self.index[i][2]
+            if pts is not None:
+                target = pts + int(seconds * 90000)
+                step = 1 if seconds > 0 else -1
+                while 0 <= i + step < len(self.index):
+                    i += step
+                    entryPts = self.index[i][2]
+                    if entryPts is not None and (entryPts >= target if step > 0 else entryPts <= target):
+                        break
+            self.cursor = self.index[i][0]
+            self._cond.notify_all()
+
+    def rewind(self, seconds):
+        """ Move the cursor `seconds` back, or to the oldest data held. """
+        self._seek(-seconds)
+
+    def forward(self, seconds):
+        """ Move the cursor `seconds` forward, but not past the last index entry. """
+        self._seek(seconds)
+
+    def live(self):
+        """ Move the cursor to the live edge, i.e. to the last index entry. """
+        with self._cond:
+            self.cursor = self.index[-1][0] if self.index else self.writePos
+            self.paused = False
+            self._cond.notify_all()
+
+    def pause(self, paused=True):
+        """ Stop (or, if `paused` is `False`, resume) feeding the sink; recording continues. """
+        with self._cond:
+            self.paused = paused
+            self._cond.notify_all()
+
+    def behind_live(self):
+        """ Return the distance between the cursor and the live edge, in seconds. """
+        with self._cond:
+            if not self.index:
+                return 0.0
+            pts = self.index[self._entry(self.cursor)][2]
+            last = next((e[2] for e in reversed(self.index) if e[2] is not None), None)
+            return (last - pts) / 90000 if pts is not None and last is not None else 0.0
+
+    def poll(self):
+        return self.sink.poll()
+
+    def close(self):
+        """ Stop recording, write out what is left to play (see above), and close the input of the sink. """
+        try:
+            self.stdin.close()
+        except OSError:
+            pass
+        # The recorder stops at EOF; then the player stops once it caught up with the live edge
+        self._recorder.join()
+        self._player.join()
+        if hasattr(self.sink, 'close'):
+            self.sink.close()
+        else:
+            self.sink.stdin.close()
+        self._mm.close()
+        self._fh.close()
+
+    def stats(self):
+        behind = self.behind_live()
+        with self._cond:
+            buffered = min(self.writePos, self.size)
+            first = next((e[2] for e in self.index if e[2] is not None), None)
+            last = next((e[2] for e in reversed(self.index) if e[2] is not None), None)
+            return {'buffered-bytes': buffered,
+                    'buffered-seconds': (last - first) / 90000 if first is not None else 0.0,
+                    'behind-live': behind,
+                    'paused': self.paused,
+                    'index-entries': len(self.index)}
@@ -0,0 +1,64 @@
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+class StageTimer:
+    """ Records the duration of named stages and the time at which named events happened, relative
+    to the creation of the timer (or the last call to `reset()`), e.g.
+
+      with startup.stage('channel-list'):
+          ls = p.get_channel_list()
+      startup.mark('first-byte')
+      logging.info(startup.report())
+
+    Instances of this class are thread-safe; stages may overlap.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """ Discard all the recorded stages and events and restart the clock. """
+        with self._lock:
+            self.t0 = time.perf_counter()
+            self.stages = []
+            self.events = {}
+            self._callbacks = {}
+
+    @contextmanager
+    def stage(self, name):
+        """ Context manager that records the duration of the enclosed block as stage `name`. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages.append((name, start - self.t0, time.perf_counter() - start))
+
+    def mark(self, name):
+        """ Record the time of the event `name`, unless it was already recorded. """
+        with self._lock:
+            if name in self.events:
+                return
+            self.events[name] = time.perf_counter() - self.t0
+            callbacks = self._callbacks.pop(name, [])
+        for fn in callbacks:
+            fn()
+
+    def notify(self, name, fn):
+        """ Call `fn()` once the event `name` is recorded (see `mark()`). """
+        with self._lock:
+            if name not in self.events:
+                self._callbacks.setdefault(name, []).append(fn)
+                return
+        fn()
+
+    def report(self):
+        """ Return a human-readable summary of the recorded stages and events. """
+        with self._lock:
+            stages = ['%s %.3fs' % (name, duration) for name, _, duration in self.stages]
+            events = ['%s @%.3fs' % (name, t) for name, t in sorted(self.events.items(), key=lambda e: e[1])]
+        return ', '.join(stages + events)
+
+# Timer for the startup path, i.e. from the resolution of the stream to the first write to the sink
+startup = StageTimer()
@@ -0,0 +1,171 @@
+import logging
+import time
+from common.metrics import metrics
+from common.tsmux import TS_PACKET_SIZE, TS_SYNC_BYTE, pcr_timestamp, pes_timestamp
+
+_NULL_PID = 0x1FFF
+_TIMESTAMP_WRAP = 1 << 33
+# A timestamp that goes back or jumps forward more than this (90 kHz) is a discontinuity
+_MAX_TIMESTAMP_STEP = 5 * 90000
+# Maps the second byte of a TS header to 1 if `transport_error_indicator` is set
+_TEI_TABLE = bytes(1 if b & 0x80 else 0 for b in range(256))
+
+class _PidState:
+    __slots__ = ('cc', 'packets', 'ccErrors', 'dropped', 'ts', 'tsJumps')
+
+    def __init__(self):
+        self.cc = None
+        self.packets = 0
+        self.ccErrors = 0
+        self.dropped = 0
+        self.ts = None
+        self.tsJumps = 0
+
+class TSInspector:
+    """ Inspects an MPEG transport stream as it passes by, e.g. on its way to the sink:
+
+      inspector = TSInspector(0)
+      for seq, data in prefetcher:
+          inspector.feed(data)
+          sink.stdin.write(data)
+
+    For each PID, the continuity counter (CC) is tracked to count continuity errors and estimate
+    the number of packets lost, and PES timestamps (90 kHz) are tracked to count discontinuities,
+    i.e. jumps of more than 5 seconds or backwards.  The first PID that carries a PCR (or, until
+    one is seen, PES timestamps) is used as the clock: the bitrate of each PID is measured over
+    stream time, and `drift` is the wall-clock time elapsed minus the stream time elapsed since
+    the clock started, i.e. the delay gained since the start, e.g. by stalls.
+
+    If `scheduler` is set to the `LivePlaylistScheduler` of the stream, `lag` is how far the last
+    segment written out (see `delivered()`) is behind the live edge, in seconds.
+
+    Packet headers are extracted by slicing the data with a stride of 188 bytes, so that the
+    per-packet work in Python is limited to a few integer operations; PES and adaptation field
+    headers are only parsed where a flag says they are present.  `feed()` expects whole TS
+    packets, as is the case for HLS segments.  See also `validate()`.
+    """
+    def __init__(self, stream=0):
+        """ Constructs a TSInspector.
+
+        @param stream Stream index, used in log messages and as metrics label
+        """
+        self.stream = stream
+        self.pids = {}
+        self.packets = 0
+        self.clockPid = None
+        self.drift = None
+        self.scheduler = None
+        self.lag = None
+        self._clockIsPcr = False
+        self._clock0 = None
+        self._clock = None
+
+    @staticmethod
+    def validate(data):
+        """ Return the reason why `data` is not a well-formed sequence of TS packets, i.e. a
+        truncated or corrupt segment, or `None`.
+        """
+        n, rest = divmod(len(data), TS_PACKET_SIZE)
+        if rest or not n:
+            return 'size %d is not a multiple of %d' % (len(data), TS_PACKET_SIZE)
+        synced = data[0::TS_PACKET_SIZE].count(TS_SYNC_BYTE)
+        if synced != n:
+            return '%d of %d packets lack the sync byte' % (n - synced, n)
+        errors = data[1::TS_PACKET_SIZE].translate(_TEI_TABLE).count(1)
+        if errors:
+            return '%d packet(s) flagged with transport errors' % errors
+        return None
+
+    def feed(self, data):
+        """ Inspect `data`, which holds whole TS packets. """
+        mv = memoryview(data)
+        now = time.monotonic()
+        pids = self.pids
+        ccErrors, dropped, tsJumps = 0, 0, 0
+        headers = zip(data[1::TS_PACKET_SIZE], data[2::TS_PACKET_SIZE], data[3::TS_PACKET_SIZE])
+        for i, (b1, b2, b3) in enumerate(headers):
+            pid = ((b1 & 0x1F) << 8) | b2
+            if pid == _NULL_PID:
+                continue
+            state = pids.get(pid)
+            if state is None:
+                state = pids[pid] = _PidState()
+            state.packets += 1
+            pkt = None
+            cc = b3 & 0x0F
+            if b3 & 0x20:
+                pkt = mv[i * TS_PACKET_SIZE:(i + 1) * TS_PACKET_SIZE]
+                if pkt[4] and pkt[5] & 0x80:
+                    # `discontinuity_indicator`
+                    state.cc, state.ts = None, None
+                if (not self._clockIsPcr or self.clockPid == pid) and (pcr := pcr_timestamp(pkt)) is not None:
+                    if not self._clockIsPcr:
+                        self.clockPid, self._clockIsPcr = pid, True
+                        self._clock0, self._clock = None, None
+                    self._tick(pcr, now)
+            if b3 & 0x10:
+                if state.cc is not None and cc != (state.cc + 1) & 0x0F and cc != state.cc:
+                    lost = (cc - state.cc - 1) & 0x0F
+                    state.ccErrors += 1
+                    state.dropped += lost
+                    ccErrors += 1
+                    dropped += lost
+                    logging.debug('TS inspector (stream %s): PID %d continuity error, %d packet(s) lost'
+                                  % (self.stream, pid, lost))
+                state.cc = cc
+            if b1 & 0x40:
+                if pkt is None:
+                    pkt = mv[i * TS_PACKET_SIZE:(i + 1) * TS_PACKET_SIZE]
+                ts = pes_timestamp(pkt)
+                if ts is not None:
+                    if state.ts is not None:
+                        step = (ts - state.ts) % _TIMESTAMP_WRAP
+                        if step > _MAX_TIMESTAMP_STEP:
+                            state.tsJumps += 1
+                            tsJumps += 1
+                            logging.debug('TS inspector (stream %s): PID %d timestamp discontinuity'
+                                          % (self.stream, pid))
+                    state.ts = ts
+                    if self.clockPid is None:
+                        self.clockPid = pid
+                    if not self._clockIsPcr and self.clockPid == pid:
+                        self._tick(ts, now)
+        self.packets += len(data) // TS_PACKET_SIZE
+        if ccErrors:
+            metrics.inc('ts_continuity_errors', ccErrors, stream=self.stream)
+            metrics.inc('ts_dropped_packets', dropped, stream=self.stream)
+        if tsJumps:
+            metrics.inc('ts_timestamp_jumps', tsJumps, stream=self.stream)
+        if self.drift is not None:
+            metrics.set('ts_drift_seconds', self.drift, stream=self.stream)
+
+    def delivered(self, seq):
+        """ Called once the segment `seq` was written out; updates `lag` (see above). """
+        self.lag = self.scheduler.behind(seq) if self.scheduler else None
+        if self.lag is not None:
+            metrics.set('ts_lag_seconds', self.lag, stream=self.stream)
+
+    def _tick(self, ts, now):
+        """ Advance the clock to the timestamp `ts` (90 kHz), seen at the wall-clock time `now`. """
+        if self._clock is not None and (ts - self._clock[0]) % _TIMESTAMP_WRAP > _MAX_TIMESTAMP_STEP:
+            # Rebase the clock; the stream time elapsed before the discontinuity is kept in `_clock0`
+            self._clock0 = (self._clock[1], self._clock0[1], ts)
+        if self._clock0 is None:
+            self._clock0 = (0, now, ts)
+        # `_clock0` holds the stream time, wall-clock time and timestamp at which the clock was
+        # (re)based; `_clock`, the last timestamp and the stream time elapsed
+        self._clock = (ts, self._clock0[0] + (ts - self._clock0[2]) % _TIMESTAMP_WRAP / 90000)
+        self.drift = (now - self._clock0[1]) - self._clock[1]
+
+    def stats(self):
+        """ Return a dictionary with the figures collected so far; `bitrate` is in bits/s. """
+        seconds = self._clock[1] if self._clock else 0
+        return {'packets': self.packets,
+                'lag': self.lag,
+                'drift': self.drift,
+                'pids': {pid: {'packets': s.packets,
+                               'bitrate': int(s.packets * TS_PACKET_SIZE * 8 / seconds) if seconds else None,
+                               'cc-errors': s.ccErrors,
+                               'dropped': s.dropped,
+                               'timestamp-jumps': s.tsJumps}
+                         for pid, s in sorted(self.pids.items())}}
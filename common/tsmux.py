@@ -0,0 +1,385 @@
+import logging
+import selectors
+import struct
+from collections import deque
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+PAT_PID = 0x0000
+ISO_639_LANGUAGE_DESCRIPTOR = 0x0A
+# ISO 639-1 to ISO 639-2 (bibliographic) codes of common languages
+_ISO_639_1 = {
+    'ar': 'ara', 'ca': 'cat', 'cs': 'cze', 'da': 'dan', 'de': 'ger', 'el': 'gre', 'en': 'eng',
+    'es': 'spa', 'eu': 'baq', 'fi': 'fin', 'fr': 'fre', 'gl': 'glg', 'he': 'heb', 'hi': 'hin',
+    'hu': 'hun', 'it': 'ita', 'ja': 'jpn', 'ko': 'kor', 'nl': 'dut', 'no': 'nor', 'pl': 'pol',
+    'pt': 'por', 'ro': 'rum', 'ru': 'rus', 'sv': 'swe', 'tr': 'tur', 'uk': 'ukr', 'zh': 'chi',
+}
+
+def _crc32_table():
+    table = []
+    for i in range(256):
+        c = i << 24
+        for _ in range(8):
+            c = ((c << 1) ^ 0x04C11DB7) if c & 0x80000000 else (c << 1)
+        table.append(c & 0xFFFFFFFF)
+    return table
+
+_CRC32_TABLE = _crc32_table()
+
+def crc32_mpeg2(data):
+    """ Return the CRC-32/MPEG-2 of `data`, as used in PSI sections. """
+    crc = 0xFFFFFFFF
+    for b in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC32_TABLE[(crc >> 24) ^ b]
+    return crc
+
+def packet_pid(pkt):
+    return ((pkt[1] & 0x1F) << 8) | pkt[2]
+
+def payload_offset(pkt):
+    """ Return the offset of the payload in a TS packet, or `None` if it carries no payload. """
+    afc = (pkt[3] >> 4) & 0x3
+    if not afc & 0x1:
+        return None
+    off = 4 + (1 + pkt[4] if afc & 0x2 else 0)
+    return off if off < TS_PACKET_SIZE else None
+
+def _decode_timestamp(b, off):
+    return (((b[off] >> 1) & 0x7) << 30) | (b[off + 1] << 22) | ((b[off + 2] >> 1) << 15) \
+        | (b[off + 3] << 7) | (b[off + 4] >> 1)
+
+def pes_timestamp(pkt):
+    """ Return the DTS (or PTS, if there is no DTS) of the PES packet that starts in the given TS
+    packet, or `None` if it carries none.  The TS packet should have `payload_unit_start_indicator` set.
+    """
+    off = payload_offset(pkt)
+    if off is None or off + 14 > TS_PACKET_SIZE or pkt[off:off + 3] != b'\x00\x00\x01':
+        return None
+    flags = pkt[off + 7] >> 6
+    if flags == 0x3 and off + 19 <= TS_PACKET_SIZE:
+        return _decode_timestamp(pkt, off + 14)
+    if flags & 0x2:
+        return _decode_timestamp(pkt, off + 9)
+    return None
+
+def pcr_timestamp(pkt):
+    """ Return the PCR base (90 kHz) carried in the adaptation field of a TS packet, if any. """
+    if pkt[3] & 0x20 and pkt[4] >= 7 and pkt[5] & 0x10:
+        return (pkt[6] << 25) | (pkt[7] << 17) | (pkt[8] << 9) | (pkt[9] << 1) | (pkt[10] >> 7)
+    return None
+
+def psi_section(pkt):
+    """ Return the PSI section that starts in the given TS packet, or `None`.  Sections that span
+    more than one TS packet are not supported.
+    """
+    off = payload_offset(pkt)
+    if off is None or not pkt[1] & 0x40:
+        return None
+    off += 1 + pkt[off]
+    if off + 3 > TS_PACKET_SIZE:
+        return None
+    end = off + 3 + (((pkt[off + 1] & 0x0F) << 8) | pkt[off + 2])
+    return bytes(pkt[off:end]) if end <= TS_PACKET_SIZE else None
+
+def parse_pat(section):
+    """ Return the PID of the first program's PMT in a PAT section. """
+    for i in range(8, len(section) - 4, 4):
+        program, pid = struct.unpack_from('>HH', section, i)
+        if program != 0:
+            return pid & 0x1FFF
+    return None
+
+def parse_pmt(section):
+    """ Parse a PMT section and return a tuple `(pcr_pid, [(stream_type, pid, es_info), ...])`. """
+    pcrPid, infoLen = struct.unpack_from('>HH', section, 8)
+    i = 12 + (infoLen & 0x0FFF)
+    streams = []
+    while i + 5 <= len(section) - 4:
+        streamType, pid, esInfoLen = struct.unpack_from('>BHH', section, i)
+        esInfoLen &= 0x0FFF
+        streams.append((streamType, pid & 0x1FFF, section[i + 5:i + 5 + esInfoLen]))
+        i += 5 + esInfoLen
+    return pcrPid & 0x1FFF, streams
+
+def has_descriptor(esInfo, tag):
+    """ Return `True` if the descriptor loop `esInfo` (e.g. of a PMT stream) holds a descriptor `tag`. """
+    i = 0
+    while i + 2 <= len(esInfo):
+        if esInfo[i] == tag:
+            return True
+        i += 2 + esInfo[i + 1]
+    return False
+
+def iso639_2(language):
+    """ Return the ISO 639-2 code for the language tag `language` (RFC 5646, e.g. `es` or `es-ES`,
+    as in the `LANGUAGE` attribute of HLS renditions), or `None` if it is not known.
+    """
+    primary = (language or '').partition('-')[0].lower()
+    if len(primary) == 3 and primary.isalpha():
+        return primary
+    return _ISO_639_1.get(primary)
+
+def language_descriptor(language):
+    """ Return an ISO 639 language descriptor for the given ISO 639-2 code, e.g. `spa`. """
+    return bytes([ISO_639_LANGUAGE_DESCRIPTOR, 4]) + language.encode('ascii') + b'\x00'
+
+class _MuxInput:
+    __slots__ = ('pmtPid', 'pmt', 'pcrPid', 'streams', 'units', 'pending', 'tailOpen',
+                 'ts', 'lastRaw', 'wrap', 'partial', 'eof')
+
+    def __init__(self):
+        self.pmtPid = None
+        self.pmt = None
+        self.pcrPid = None
+        self.streams = []
+        self.units = deque()
+        self.pending = 0
+        self.tailOpen = False
+        self.ts = None
+        self.lastRaw = None
+        self.wrap = 0
+        self.partial = b''
+        self.eof = False
+
+    def unwrap(self, raw):
+        if self.lastRaw is not None and raw < self.lastRaw - (1 << 32):
+            self.wrap += 1 << 33
+        elif self.lastRaw is not None and raw > self.lastRaw + (1 << 32):
+            self.wrap -= 1 << 33
+        self.lastRaw = raw
+        return raw + self.wrap
+
+class MpegtsMuxer:
+    """ Multiplexes several MPEG transport streams into a single-program transport stream; this is
+    a lightweight in-process replacement for `ffmpeg -c copy -f mpegts`.  The elementary streams of
+    all the inputs are remapped to unique PIDs and announced in a new PAT/PMT; packets are
+    interleaved by their DTS/PTS (or PCR), e.g.
+
+      mux = MpegtsMuxer(2, sink.stdin.write)
+      mux.feed(0, videoData)
+      mux.feed(1, audioData)
+      mux.close(0)
+      mux.close(1)
+
+    The PCR of the output program is taken from the first input.  Data is passed as whole or
+    partial TS packets; packets are only copied once, to rewrite the PID.  Several inputs may carry
+    the same kind of stream, e.g. one audio track per language; each is announced as a separate
+    stream, labeled with its language if `languages` gives one.
+
+    `received[idx]` counts the bytes fed from input `idx`, except those discarded by `stop()`; e.g.
+    to tell which part of an input was consumed when the multiplexer stops.
+    """
+    _PMT_PID = 0x1000
+    _FIRST_ES_PID = 0x100
+    # Each input gets its own range of PIDs, so that they do not depend on which PMT arrives first;
+    # e.g. they stay the same if a new multiplexer takes over the stream
+    _PIDS_PER_INPUT = 0x10
+    _PSI_INTERVAL = 45000
+    _MAX_PENDING_BYTES = 8 << 20
+
+    def __init__(self, nInputs, write, languages=None):
+        """ Constructs a MpegtsMuxer.
+
+        @param nInputs Number of input transport streams
+        @param write A callable that is used to write the multiplexed output
+        @param languages If not `None`, a list of language tags (or `None`), one per input, for the
+        streams of inputs that do not announce a language; see `iso639_2()`
+        """
+        self.write = write
+        self.inputs = [_MuxInput() for _ in range(nInputs)]
+        self.received = [0] * nInputs
+        self.languages = [iso639_2(l) for l in languages or []]
+        for l, code in zip(languages or [], self.languages):
+            if l and not code:
+                logging.debug("TS mux: '%s': unknown language; the stream is not labeled" % l)
+        self.pidMap = {}
+        self.pmtVersion = 0
+        self.cc = {PAT_PID: 0, self._PMT_PID: 0}
+        self._psiDirty = True
+        self._lastPsiTs = None
+
+    def _update_pmt(self, idx, section):
+        inp = self.inputs[idx]
+        if section == inp.pmt:
+            return
+        inp.pmt = section
+        inp.pcrPid, inp.streams = parse_pmt(section)
+        for streamType, pid, esInfo in inp.streams + [(None, inp.pcrPid, b'')]:
+            if (idx, pid) not in self.pidMap and pid != 0x1FFF:
+                n = sum(1 for i, _ in self.pidMap if i == idx)
+                self.pidMap[(idx, pid)] = self._FIRST_ES_PID + self._PIDS_PER_INPUT * idx + n
+        self.pmtVersion = (self.pmtVersion + 1) & 0x1F
+        self._psiDirty = True
+        logging.debug('TS mux: input %d PMT: %s' % (idx, [(hex(t), p) for t, p, _ in inp.streams]))
+
+    def _build_psi(self):
+        pat = struct.pack('>HBBBHH', 1, 0xC1 | (self.pmtVersion << 1), 0, 0, 1, 0xE000 | self._PMT_PID)
+        pat = bytes([0x00]) + struct.pack('>H', 0xB000 | (len(pat) + 4)) + pat
+
+        pcr = self.inputs[0].pcrPid
+        pcrPid = self.pidMap.get((0, pcr), 0x1FFF)
+        es = b''
+        for idx, inp in enumerate(self.inputs):
+            language = self.languages[idx] if idx < len(self.languages) else None
+            for streamType, pid, esInfo in inp.streams:
+                outPid = self.pidMap[(idx, pid)]
+                if language and not has_descriptor(esInfo, ISO_639_LANGUAGE_DESCRIPTOR):
+                    esInfo += language_descriptor(language)
+                es += struct.pack('>BHH', streamType, 0xE000 | outPid, 0xF000 | len(esInfo)) + esInfo
+        pmt = struct.pack('>HBBBHH', 1, 0xC1 | (self.pmtVersion << 1), 0, 0, 0xE000 | pcrPid, 0xF000) + es
+        pmt = bytes([0x02]) + struct.pack('>H', 0xB000 | (len(pmt) + 4)) + pmt
+
+        return self._packetize(PAT_PID, pat + struct.pack('>I', crc32_mpeg2(pat))) \
+            + self._packetize(self._PMT_PID, pmt + struct.pack('>I', crc32_mpeg2(pmt)))
+
+    def _packetize(self, pid, section):
+        out = bytearray()
+        data = b'\x00' + section
+        first = True
+        while data:
+            chunk, data = data[:TS_PACKET_SIZE - 4], data[TS_PACKET_SIZE - 4:]
+            out += bytes([TS_SYNC_BYTE, (0x40 if first else 0) | (pid >> 8), pid & 0xFF,
+                          0x10 | self.cc[pid]])
+            out += chunk + b'\xff' * (TS_PACKET_SIZE - 4 - len(chunk))
+            self.cc[pid] = (self.cc[pid] + 1) & 0xF
+            first = False
+        return out
+
+    def _queue(self, inp, idx, pkt, pid, offset):
+        outPid = self.pidMap.get((idx, pid))
+        if outPid is None:
+            return
+        if pkt[1] & 0x40:
+            raw = pes_timestamp(pkt)
+            if raw is None and pid == inp.pcrPid:
+                raw = pcr_timestamp(pkt)
+            if raw is not None:
+                inp.ts = inp.unwrap(raw)
+                inp.tailOpen = False
+        if not inp.tailOpen:
+            inp.units.append([inp.ts, bytearray(), offset])
+            inp.tailOpen = True
+        unit = inp.units[-1][1]
+        pos = len(unit)
+        unit += pkt
+        unit[pos + 1] = (unit[pos + 1] & 0xE0) | (outPid >> 8)
+        unit[pos + 2] = outPid & 0xFF
+        inp.pending += TS_PACKET_SIZE
+
+    def feed(self, idx, data):
+        """ Feed data read from the input `idx`.  `data` is a bytes-like object that holds whole
+        or partial TS packets; a partial packet at the end is kept until the next call.
+        """
+        inp = self.inputs[idx]
+        # Offset in the input of `data[0]`, once prefixed with the partial packet
+        base = self.received[idx] - len(inp.partial)
+        self.received[idx] += len(data)
+        if inp.partial:
+            data = inp.partial + data
+            inp.partial = b''
+        mv = memoryview(data)
+        i, end = 0, len(mv)
+        while i + TS_PACKET_SIZE <= end:
+            if mv[i] != TS_SYNC_BYTE:
+                # Lost synchronization; skip to the next sync byte
+                i += 1
+                continue
+            pkt = mv[i:i + TS_PACKET_SIZE]
+            i += TS_PACKET_SIZE
+            pid = ((pkt[1] & 0x1F) << 8) | pkt[2]
+            if pid == PAT_PID:
+                section = psi_section(pkt)
+                if section:
+                    inp.pmtPid = parse_pat(section)
+            elif pid == inp.pmtPid:
+                section = psi_section(pkt)
+                if section:
+                    self._update_pmt(idx, section)
+            else:
+                self._queue(inp, idx, pkt, pid, base + i - TS_PACKET_SIZE)
+        if i < end:
+            inp.partial = bytes(mv[i:])
+        self._interleave()
+
+    def close(self, idx):
+        """ Signal that no more data will be fed from input `idx`. """
+        self.inputs[idx].eof = True
+        self._interleave()
+
+    def flush(self):
+        """ Write all the queued packets, regardless of the inputs' state. """
+        for inp in self.inputs:
+            inp.eof = True
+        self._interleave()
+
+    def stop(self, limits):
+        """ Stop multiplexing, e.g. once any of the inputs ended, and write the queued packets that
+        were read before the offset `limits[idx]` of each input `idx`; e.g. the end of the last
+        segment that every input got to, so that all the streams end together.  The rest is
+        discarded, and not counted in `received`.
+        """
+        for idx, inp in enumerate(self.inputs):
+            consumed = self.received[idx] - len(inp.partial)
+            inp.partial = b''
+            while inp.units and inp.units[-1][2] >= limits[idx]:
+                _, unit, consumed = inp.units.pop()
+                inp.pending -= len(unit)
+            if consumed < self.received[idx]:
+                logging.debug('TS mux: discarding %d bytes of input %d'
+                              % (self.received[idx] - consumed, idx))
+                self.received[idx] = consumed
+            inp.tailOpen = False
+        self.flush()
+
+    def _interleave(self):
+        while True:
+            best = None
+            for inp in self.inputs:
+                if not inp.units:
+                    if not inp.eof and inp.pending < self._MAX_PENDING_BYTES:
+                        # The next timestamp of this input is unknown; wait unless others are overflowing
+                        if not any(i.pending >= self._MAX_PENDING_BYTES for i in self.inputs):
+                            return
+                    continue
+                ts = inp.units[0][0]
+                if ts is None:
+                    best = inp
+                    break
+                if best is None or ts < best.units[0][0]:
+                    best = inp
+            if best is None:
+                return
+
+            ts, unit, _ = best.units.popleft()
+            if not best.units:
+                best.tailOpen = False
+            best.pending -= len(unit)
+            if self._psiDirty or (ts is not None and (self._lastPsiTs is None
+                                                      or ts - self._lastPsiTs >= self._PSI_INTERVAL)):
+                self.write(self._build_psi())
+                self._psiDirty = False
+                self._lastPsiTs = ts
+            self.write(unit)
+
+    def run(self, fhs, bufSize=65536):
+        """ Read the inputs from the given unbuffered binary file objects (e.g. the read end of
+        pipes) until any of them reaches EOF, and multiplex them.  The packets that are still queued
+        are left for `stop()` or `flush()`.
+
+        @param fhs A list of file objects, one per input
+        @param bufSize Size of the read buffer
+        """
+        buf = bytearray(bufSize)
+        mv = memoryview(buf)
+        sel = selectors.DefaultSelector()
+        for idx, fh in enumerate(fhs):
+            sel.register(fh, selectors.EVENT_READ, idx)
+        try:
+            while True:
+                for key, _ in sel.select():
+                    n = key.fileobj.readinto(buf)
+                    if not n:
+                        return
+                    self.feed(key.data, mv[:n])
+        finally:
+            sel.close()
@@ -1,8 +1,14 @@
-import http.cookiejar, urllib.request, urllib.parse, json
-import os.path, re
-from common.avsource import CurlMpegtsSequenceMuxAVSource
+import http.cookiejar, urllib.request, urllib.parse, urllib.error, json, hashlib
+import logging, os.path, re, time
+from concurrent.futures import ThreadPoolExecutor
+from common.avsource import AsyncMpegtsSequenceAVSource, CurlMpegtsSequenceMuxAVSource
+from common.cache import MetadataCache
+from common.fetcher import FetchError, HTTPFetcher
 from common.m3u import M3UPlaylist
+from common.metrics import metrics
 from common.provider import ContentProvider
+from common.timing import startup
+from common.tsmux import iso639_2
 
 # Provider for [ES] Atresplayer (https://atresplayer.com/).  Atresplayer conforms to RFC 8216 for HTTP Live Streaming
 class AtresplayerProvider(ContentProvider):
@@ -12,19 +18,62 @@ class AtresplayerProvider(ContentProvider):
 
     _DEFAULT_AUTH_COOKIE_FILE = os.path.join(os.path.expanduser('~'),
                                              '.atresplayer-cookie.txt')
+    # The cache is kept in the directory of the authentication cookie file, unless `cache-dir` is given
+    _CACHE_DIR_NAME = '.atresplayer-cache'
+    _DEFAULT_CACHE_TTL_CHANNELS = 86400
+    _DEFAULT_CACHE_TTL_STREAM_INFO = 300
+    _DEFAULT_CACHE_TTL_MASTER = 300
     _DEFAULT_URLS_PER_PROC = 20
+    _DEFAULT_ENGINE = 'http'
+    _DEFAULT_PREFETCH_DEPTH = 3
+    _DEFAULT_SCHEDULER = 'playlist'
+    _DEFAULT_LIVE_EDGE_SEGMENTS = 3
+    _DEFAULT_MUX = 'builtin'
+    _DEFAULT_ABR = 'off'
+    _DEFAULT_AUDIO = ''
+    _DEFAULT_AUDIO_MAX_BANDWIDTH = 384000
+    # Assumed bitrate of an audio rendition whose `EXT-X-MEDIA` tag does not announce one
+    _AUDIO_BANDWIDTH_ESTIMATE = 128000
 
     def __init__(self, params={}):
         self.params = {
             'auth-cookie-file': self._DEFAULT_AUTH_COOKIE_FILE,
+            'cache': 'on',
+            'cache-dir': None,
+            'cache-ttl-channels': self._DEFAULT_CACHE_TTL_CHANNELS,
+            'cache-ttl-stream-info': self._DEFAULT_CACHE_TTL_STREAM_INFO,
+            'cache-ttl-master': self._DEFAULT_CACHE_TTL_MASTER,
             'urls-per-proc': self._DEFAULT_URLS_PER_PROC,
+            'engine': self._DEFAULT_ENGINE,
+            'prefetch-depth': self._DEFAULT_PREFETCH_DEPTH,
+            'scheduler': self._DEFAULT_SCHEDULER,
+            'live-edge-segments': self._DEFAULT_LIVE_EDGE_SEGMENTS,
+            'mux': self._DEFAULT_MUX,
+            'abr': self._DEFAULT_ABR,
+            'audio': self._DEFAULT_AUDIO,
+            'audio-max-bandwidth': self._DEFAULT_AUDIO_MAX_BANDWIDTH,
         }
         self.params |= params
+        if not self.params['cache-dir']:
+            cookieDir = os.path.dirname(os.path.abspath(self.params['auth-cookie-file']))
+            self.params['cache-dir'] = os.path.join(cookieDir, self._CACHE_DIR_NAME)
 
         self.cookieJar = http.cookiejar.MozillaCookieJar()
         self.http = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookieJar))
         if params.get('user-agent'):
-            self.http.addHeader = [('User-agent', params['user-agent'])]
+            self.http.addheaders = [('User-agent', params['user-agent'])]
+        self.cache = MetadataCache(self.params['cache-dir'], self.http,
+                                   enabled=self.params['cache'] != 'off')
+        self.fetcher = None
+
+    def get_fetcher(self):
+        """ Get the HTTPFetcher shared by the media playlist requests and the A/V sources.  It is
+        created on first use, so that it picks up the cookies loaded by `import_auth_cookie()`.
+        """
+        if not self.fetcher:
+            self.fetcher = HTTPFetcher(self.params.get('user-agent'), self.cookieJar,
+                                       zeroCopy=self.params.get('zero-copy', 'auto') != 'off')
+        return self.fetcher
 
     def authenticate(self, username, password):
         # FIXME: this currently does not allow access to protected resources.
@@ -34,12 +83,19 @@ class AtresplayerProvider(ContentProvider):
         # If authentication fails, this raises an exception due to HTTP status 403
         self.http.open(self._URL_AUTH, data)
         self.cookieJar.save(self.params['auth-cookie-file'])
+        self.cache.identity = self._cookie_identity()
 
     def import_auth_cookie(self):
         self.cookieJar.load(self.params['auth-cookie-file'])
+        self.cache.identity = self._cookie_identity()
+
+    def _cookie_identity(self):
+        """ Return a hash of the authentication cookies, which keys the cached metadata. """
+        cookies = sorted('%s\t%s\t%s' % (c.domain, c.name, c.value) for c in self.cookieJar)
+        return hashlib.sha1('\n'.join(cookies).encode('utf-8')).hexdigest() if cookies else ''
 
     def get_channel_list(self):
-        j = json.load(self.http.open(self._URL_CHANNELS))
+        j = json.loads(self.cache.get(self._URL_CHANNELS, int(self.params['cache-ttl-channels'])))
         return {i['title']: {'id': i['id'],
                              'href': i['link']['href']} for i in j}
 
@@ -48,40 +104,52 @@ class AtresplayerProvider(ContentProvider):
 
         This comprises several steps: (i) fetch channel list; (ii) download
         stream information -contains title and URL of the `master.m3u8` playlist
-        -; and (iii) download and parse `master.m3u8`.
+        -; and (iii) download and parse `master.m3u8`.  The result of each step is
+        cached (see `MetadataCache`) for the time given by the `cache-ttl-*` parameters.
         """
         if re.match('^https?://', resource):
             raise ValueError('Providing a URL is not currently supported')
 
-        ls = self.get_channel_list()
+        with startup.stage('channel-list'):
+            ls = self.get_channel_list()
         if not ls.get(resource):
             raise ValueError("'%s': no such entry in the channel list" % resource)
 
-        j = json.load(self.http.open(self._URL_STREAM_INFO % ls[resource]['id']))
+        url_stream_info = self._URL_STREAM_INFO % ls[resource]['id']
+        with startup.stage('stream-info'):
+            j = json.loads(self.cache.get(url_stream_info, int(self.params['cache-ttl-stream-info'])))
         master_m3u8 = j['sourcesLive'][0]['src']
 
         try:
+            with startup.stage('master-playlist'):
+                master = self.cache.get(master_m3u8, int(self.params['cache-ttl-master']))
             return {'title': j['titulo'],
-                    'alt': M3UPlaylist(self.http.open(master_m3u8).read().decode('utf-8'),
-                                       expectExtm3u=True),
-                    '__prefix': master_m3u8.rpartition('/')[0] + '/'}
+                    'alt': M3UPlaylist(master.decode('utf-8'), expectExtm3u=True),
+                    '__prefix': master_m3u8.rpartition('/')[0] + '/',
+                    '__resource': resource,
+                    '__cached': [url_stream_info, master_m3u8]}
         except Exception:
             raise RuntimeError("Couldn't get stream information.  Did you forget to authenticate?")
 
     def parse_media_playlist(self, prefix, playlistUrl):
         """
         Parse a media playlist (RFC 8216) and return a tuple that holds the URL
-        template and initial media sequence.  This tuple can be used to construct
-        a CurlMpegtsSequenceAVSource.
+        template, initial media sequence and the playlist URL.  This tuple can be
+        used to construct a CurlMpegtsSequenceAVSource.  The initial media sequence
+        is `live-edge-segments` segments behind the live edge.
         """
-        ts = M3UPlaylist(self.http.open(playlistUrl).read().decode('utf-8'),
-                         expectExtm3u=True)
+        startTime = time.perf_counter()
+        content = self.get_fetcher().get(playlistUrl)
+        metrics.observe('playlist_fetch_seconds', time.perf_counter() - startTime)
+        ts = M3UPlaylist(content.decode('utf-8'), expectExtm3u=True)
         # Do not rely on the `EXT-X-MEDIA-SEQUENCE` attribute as it has been seen to carry incorrect
         # values; instead use the sequence number in the href string
         r = re.compile(r'-([0-9]+).ts')
-        seq = re.search(r, ts[0]['href'])[1]
-        return (prefix + re.sub(r, '-%s.ts', ts[0]['href']),
-                int(seq))
+        start = ts[max(0, len(ts) - int(self.params['live-edge-segments']))]
+        seq = re.search(r, start['href'])[1]
+        return (prefix + re.sub(r, '-%s.ts', start['href']),
+                int(seq),
+                playlistUrl)
 
     def collect_audio_playlists(self, masterPlaylist):
         """
@@ -103,29 +171,143 @@ class AtresplayerProvider(ContentProvider):
                         audio_playlists += [attr_kv]
         return (audio_playlists, default)
 
-    def get_mpegts_url(self, streamInfo, alternative):
+    def select_audio_playlists(self, streamInfo):
+        """
+        Return the list of audio renditions (see `collect_audio_playlists()`) to fetch: the default
+        one, followed by those requested via the `audio` parameter, i.e. a comma-separated list of
+        `NAME`s or `LANGUAGE`s (or `all`) of renditions in the same group.  Additional renditions are
+        taken in order for as long as their bandwidth (`BANDWIDTH` attribute, if any, or
+        `_AUDIO_BANDWIDTH_ESTIMATE`) fits in `audio-max-bandwidth` bits/s.
+        """
+        audio_playlists, audio_default = self.collect_audio_playlists(streamInfo['alt'])
+        if audio_default == -1:
+            logging.warning("Couldn't determine the default audio playlist; using 0")
+            audio_default = 0
+        default = audio_playlists[audio_default]
+        ret = [default]
+        wanted = [w.strip() for w in self.params['audio'].split(',') if w.strip()]
+        # Languages match regardless of the form of the code, e.g. `en` and `eng`
+        wantedLanguages = {iso639_2(w) for w in wanted} - {None}
+        budget = int(self.params['audio-max-bandwidth'])
+        for attr_kv in audio_playlists:
+            if attr_kv is default or attr_kv.get('GROUP-ID') != default.get('GROUP-ID'):
+                continue
+            if 'all' not in wanted and attr_kv.get('NAME') not in wanted and attr_kv.get('LANGUAGE') not in wanted \
+               and iso639_2(attr_kv.get('LANGUAGE')) not in wantedLanguages:
+                continue
+            bandwidth = int(attr_kv.get('BANDWIDTH', self._AUDIO_BANDWIDTH_ESTIMATE))
+            if bandwidth > budget:
+                logging.warning("Audio rendition '%s' exceeds the bandwidth budget; skipped" % attr_kv.get('NAME'))
+                continue
+            budget -= bandwidth
+            ret += [attr_kv]
+        return ret
+
+    def get_mpegts_url(self, streamInfo, alternative, audio_playlists=None):
         """ Get the base URL and current MPEG TS sequence number.  Specifically,
-        this downloads and parses a `bitrate_xxx.m3u8` playlist.
+        this downloads and parses a `bitrate_xxx.m3u8` playlist and the audio
+        playlists (see `select_audio_playlists()`); all are fetched concurrently.
 
         @param streamInfo Stream information, as returned by `get_stream_info()`
         @param alternative Alternative #.
+        @param audio_playlists The audio renditions to use; if `None`, `select_audio_playlists()`
         @return A dictionary that contains the required data to construct a
         CurlMpegtsSequenceMuxAVSource instance.
         """
-        audio_playlists, audio_default = self.collect_audio_playlists(streamInfo['alt'])
-        # TODO: infrastructure should be extended to convey both the video and audio streams to use
-        if audio_default == -1:
-            logging.warning("Couldn't determine the default audio playlist; using 0")
-            audio_default = 0
+        if audio_playlists is None:
+            audio_playlists = self.select_audio_playlists(streamInfo)
+        prefix = streamInfo['__prefix']
+        urls = [prefix + streamInfo['alt'][alternative]['href']] \
+            + [prefix + attr_kv['URI'] for attr_kv in audio_playlists]
+        with startup.stage('media-playlists'), ThreadPoolExecutor(len(urls)) as pool:
+            return list(pool.map(lambda url: self.parse_media_playlist(prefix, url), urls))
 
+    def get_variants(self, streamInfo, alternative, video):
+        """ Get the list of video variants for adaptive bitrate switching.  This downloads and
+        parses (concurrently) the media playlist of each alternative except `alternative`, for which
+        `video` (as returned by `parse_media_playlist()`) is used.
+
+        @return A list of `(bandwidth, urlTemplateAndInitSeq)` tuples
+        """
         prefix = streamInfo['__prefix']
-        video = self.parse_media_playlist(prefix, prefix + streamInfo['alt'][alternative]['href'])
-        audio = self.parse_media_playlist(prefix, prefix + audio_playlists[audio_default]['URI'])
-        return [video, audio]
+        alternative %= len(streamInfo['alt'])
+        entries = []
+        for i, entry in enumerate(streamInfo['alt']):
+            attr_kv = {}
+            for k, v in entry['attrs']:
+                if k == 'EXT-X-STREAM-INF':
+                    attr_kv = M3UPlaylist.parse_kv_attr(v)
+            if 'BANDWIDTH' in attr_kv:
+                entries += [(i, int(attr_kv['BANDWIDTH']), entry['href'])]
+        with startup.stage('variant-playlists'), ThreadPoolExecutor(max(1, len(entries))) as pool:
+            return list(pool.map(lambda e: (e[1], video if e[0] == alternative
+                                            else self.parse_media_playlist(prefix, prefix + e[2])),
+                                 entries))
+
+    def probe_stream(self, streamInfo, alternative, segments=2):
+        """ Fetch the media playlist of `alternative` and then its last `segments` segments, one
+        after the other over the shared HTTPFetcher.  Besides `segments`, the result holds the
+        `bandwidth` and `resolution` announced in the master playlist and the time it took to fetch
+        the media playlist (`playlist-seconds`).
+        """
+        entry = streamInfo['alt'][alternative]
+        attr_kv = {}
+        for k, v in entry['attrs']:
+            if k == 'EXT-X-STREAM-INF':
+                attr_kv = M3UPlaylist.parse_kv_attr(v)
+        playlistUrl = streamInfo['__prefix'] + entry['href']
+        fetcher = self.get_fetcher()
+
+        startTime = time.perf_counter()
+        ts = M3UPlaylist(fetcher.get(playlistUrl).decode('utf-8'), expectExtm3u=True)
+        ret = {'bandwidth': int(attr_kv.get('BANDWIDTH', 0)),
+               'resolution': attr_kv.get('RESOLUTION'),
+               'playlist-seconds': time.perf_counter() - startTime,
+               'segments': []}
+        r = re.compile(r'-([0-9]+).ts')
+        for seg in ts[max(0, len(ts) - segments):]:
+            duration = 0.0
+            for k, v in seg['attrs']:
+                if k == 'EXTINF':
+                    duration = float(v.partition(',')[0] or 0)
+            m = re.search(r, seg['href'])
+            firstByte = []
+            startTime = time.perf_counter()
+            data = fetcher.get(urllib.parse.urljoin(playlistUrl, seg['href']),
+                               onResponse=lambda: firstByte.append(time.perf_counter()))
+            ret['segments'] += [{'seq': int(m[1]) if m else None,
+                                 'duration': duration,
+                                 'bytes': len(data),
+                                 'ttfb': firstByte[0] - startTime,
+                                 'seconds': time.perf_counter() - startTime}]
+        return ret
 
     def get_av_source(self, streamInfo, alternative=-1):
-        urlTemplateAndInitSeq = self.get_mpegts_url(streamInfo, alternative)
-        return CurlMpegtsSequenceMuxAVSource(urlTemplateAndInitSeq,
-                                             int(self.params['urls-per-proc']),
-                                             self.params['user-agent'],
-                                             self.cookieJar)
+        try:
+            audio_playlists = self.select_audio_playlists(streamInfo)
+            urlTemplateAndInitSeq = self.get_mpegts_url(streamInfo, alternative, audio_playlists)
+        except (urllib.error.URLError, FetchError):
+            if not self.cache.enabled:
+                raise
+            # The cached master playlist might refer to media playlists that are no longer valid
+            logging.info('Media playlist unavailable; refreshing cached stream information')
+            for url in streamInfo['__cached']:
+                self.cache.invalidate(url)
+            streamInfo = self.get_stream_info(streamInfo['__resource'])
+            audio_playlists = self.select_audio_playlists(streamInfo)
+            urlTemplateAndInitSeq = self.get_mpegts_url(streamInfo, alternative, audio_playlists)
+        variants = None
+        if self.params['abr'] == 'on':
+            variants = self.get_variants(streamInfo, alternative, urlTemplateAndInitSeq[0])
+        cls = CurlMpegtsSequenceMuxAVSource
+        if self.params['engine'] == 'asyncio':
+            cls = AsyncMpegtsSequenceAVSource
+        languages = [None] + [attr_kv.get('LANGUAGE') for attr_kv in audio_playlists]
+        return cls(urlTemplateAndInitSeq,
+                   int(self.params['urls-per-proc']),
+                   self.params['user-agent'],
+                   self.cookieJar,
+                   self.params,
+                   variants,
+                   self.get_fetcher(),
+                   languages)
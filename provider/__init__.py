@@ -1,3 +1,20 @@
-__all__ = [
-    'ESatresplayer'
-]
+""" Registry of the content providers.  `PROVIDERS` maps the name of each provider class to the
+module that defines it, so that a provider module (and its dependencies) is only imported once it
+is selected; see `load()`.
+"""
+import importlib
+
+PROVIDERS = {
+    'AtresplayerProvider': 'provider.ESatresplayer',
+}
+
+def load(name):
+    """ Import and return the provider class `name`, which is either a key of `PROVIDERS` or, for
+    providers that are not part of this package, `MODULE:CLASS`.
+    """
+    module, _, cls = name.rpartition(':')
+    if not module:
+        if name not in PROVIDERS:
+            raise ValueError("'%s': unknown provider" % name)
+        module = PROVIDERS[name]
+    return getattr(importlib.import_module(module), cls)
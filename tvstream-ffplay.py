@@ -18,53 +18,145 @@
    License along with this program; if not, see <https://www.gnu.org/licenses/>.
 """
 
-from common.provider import ContentProvider
-from provider import *
-import logging
-import subprocess, shlex, sys, getopt, time
-from enum import Enum
-
-_PROVIDERS = {c.__name__: c for c in ContentProvider.__subclasses__()}
+from common.timing import StageTimer, startup
+# Timer for the phases that precede the requested operation; see `--profile-startup`
+profile = StageTimer()
+# Only what is needed to parse the options; the rest is imported by the operation that uses it
+with profile.stage('imports'):
+    import provider
+    import logging
+    import shlex, sys, getopt
+    from enum import Enum
 
 _DEFAULT_PROVIDER = 'AtresplayerProvider'
 _DEFAULT_SINK = 'ffplay'
 _DEFAULT_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:86.0) Gecko/20100101 Firefox/86.0'
 _AVSOURCE_RETRY_THRESHOLD = 10
+_AVSOURCE_MAX_RETRIES = 5
+_AVSOURCE_MAX_BACKOFF = 30
+_SINK_FILE_PREFIX = 'file:'
+_DEFAULT_SINK_BUFFER = 16 << 20
+_DEFAULT_SINK_POLICY = 'drop'
+_DEFAULT_SERVE_CACHE = 256 << 20
+_TIMESHIFT_SEEK_SECONDS = 10
+_DEFAULT_PROBE_WORKERS = 8
+_DEFAULT_PROBE_SEGMENTS = 2
+_SINK_PIPE_SIZE = 1048576
+_LOW_LATENCY_PIPE_SIZE = 65536
+_LOW_LATENCY_PARAMS = {'low-latency': 'on', 'live-edge-segments': '1', 'prefetch-depth': '1'}
 
 def usage():
     print("Usage: %s [OPTION]... RESOURCE\n" % sys.argv[0])
     print("RESOURCE is either a channel name from the channel list or an URL.\n")
     print("OPTION can be one of:")
     print("  -h, --help              Show this usage message")
-    print("  --log-level=N           Change the log level to N (10=debug 20=info 30=warning 40=error 50=critical)\n")
+    print("  --log-level=N           Change the log level to N (10=debug 20=info 30=warning 40=error 50=critical)")
+    print("  --profile-startup       Log the time spent importing modules, parsing options and loading the provider\n")
 
     print("  --param='KEY=VALUE'     Pass an additional parameter to a provider")
+    print("  --no-cache              Do not use cached channel lists, stream information or playlists")
     print("  --list-providers        List the available providers")
-    print("  -p, --provider=PRV      Use PRV as provider; default is `%s'" % _DEFAULT_PROVIDER)
+    print("  -p, --provider=PRV      Use PRV as provider; default is `%s'.  Providers that are not" % _DEFAULT_PROVIDER)
+    print("                          bundled are given as MODULE:CLASS")
     print("  -l, --list-channels     List available live channels\n")
 
-    print("  -s, --sink=SINKCMD      Set SINKCMD as the sink; default is `%s'" % _DEFAULT_SINK)
-    print("  --sink-args=ARGS        Additional arguments for the sink command\n")
+    print("  -s, --sink=SINKCMD      Set SINKCMD as the sink; default is `%s'.  May be given several" % _DEFAULT_SINK)
+    print("                          times to feed several sinks; `%sPATH' records to PATH" % _SINK_FILE_PREFIX)
+    print("  --sink-args=ARGS        Additional arguments for the (last given) sink command")
+    print("  --sink-buffer=BYTES     Buffer size per sink if there are several; default is %d" % _DEFAULT_SINK_BUFFER)
+    print("  --sink-policy=POLICY    What to do with a sink whose buffer is full: `drop' data or")
+    print("                          `disconnect' it; default is `%s'" % _DEFAULT_SINK_POLICY)
+    print("  --low-latency           Stay close to the live edge: start at the last segment, fetch")
+    print("                          one segment ahead and skip forward if playback falls behind\n")
+
+    print("  --metrics-log=SECONDS   Log a JSON line with the pipeline metrics every SECONDS")
+    print("  --metrics-port=[HOST:]PORT  Serve the pipeline metrics in the Prometheus text format at")
+    print("                          http://HOST:PORT/metrics; HOST defaults to 127.0.0.1\n")
 
     print("  --authenticate-as=USER  Authenticate as USER and save the authentication cookie")
     print("  --password=PASSWD       Use PASSWD for authentication (used with --authenticate-as=)")
     print("  --use-auth-cookie       Use saved authentication cookie for this request (see also --authenticate-as=)\n")
 
+    print("  --timeshift=BYTES       Keep the last BYTES of the stream in a ring file, so that it can be")
+    print("                          paused and rewound; commands are read from the standard input")
+    print("  --timeshift-file=PATH   Path of the timeshift ring file; default is a temporary file\n")
+
+    print("  --serve=[HOST:]PORT     Relay the channels over HTTP to other players in the LAN")
+    print("  --serve-cache=BYTES     Size of the relay segment cache; default is %d\n" % _DEFAULT_SERVE_CACHE)
+
     print("  --list-alternatives     List available alternatives for the requested resource")
-    print("  --alternative=N         Request alternative N\n\n")
+    print("  --alternative=N         Request alternative N\n")
+
+    print("  --probe                 Fetch a few segments of every alternative of the given channels (default:")
+    print("                          all) concurrently and print the results as JSON lines")
+    print("  --probe-workers=N       Number of concurrent requests; default is %d" % _DEFAULT_PROBE_WORKERS)
+    print("  --probe-segments=N      Number of segments fetched per alternative; default is %d\n\n" % _DEFAULT_PROBE_SEGMENTS)
 
     print("Examples:")
     print("  $ %s --list-channels" % sys.argv[0])
     print("  $ %s --list-alternatives 'Antena 3'" % sys.argv[0])
     print("  $ %s --sink-args='-vcodec h264_mmal -fs' --alternative=2 'laSexta'" % sys.argv[0])
     print("  $ %s --param='urls-per-proc=30' 'Antena 3'" % sys.argv[0])
+    print("  $ %s -s ffplay -s file:antena3.ts 'Antena 3'" % sys.argv[0])
+    print("  $ %s --timeshift=2000000000 'Antena 3'" % sys.argv[0])
+    print("  $ %s --low-latency 'Antena 3'" % sys.argv[0])
+    print("  $ %s --serve=8080" % sys.argv[0])
+    print("  $ %s --probe 'Antena 3' 'laSexta'" % sys.argv[0])
     sys.exit(1)
 
+def timeshift_control(buffer):
+    """ Read timeshift commands from the standard input until EOF; see the README. """
+    logging.info('Timeshift: [p]ause/resume, [r]ewind [SECONDS], [f]orward [SECONDS], [l]ive, [s]tatus')
+    for line in sys.stdin:
+        cmd, _, arg = line.strip().partition(' ')
+        try:
+            seconds = float(arg) if arg else _TIMESHIFT_SEEK_SECONDS
+        except ValueError:
+            logging.warning("'%s': not a number of seconds" % arg)
+            continue
+        if cmd == 'p':
+            buffer.pause(not buffer.paused)
+        elif cmd == 'r':
+            buffer.rewind(seconds)
+        elif cmd == 'f':
+            buffer.forward(seconds)
+        elif cmd == 'l':
+            buffer.live()
+        elif cmd == 's':
+            logging.info('Timeshift: %s' % buffer.stats())
+            continue
+        elif cmd:
+            logging.warning("'%s': unknown timeshift command" % cmd)
+            continue
+        else:
+            continue
+        logging.info('Timeshift: %s; %.1fs behind live' % ('paused' if buffer.paused else 'playing',
+                                                            buffer.behind_live()))
+
+def create_sink(sinkCmdlines, bufferBytes, policy, pipeSize=_SINK_PIPE_SIZE):
+    """ Spawn the given sinks.  A single sink process is fed directly, through a pipe of `pipeSize`
+    bytes; otherwise, the output is duplicated into each of them (see `FanoutSink`).
+    """
+    import subprocess
+    from common.fanout import FanoutSink
+    if len(sinkCmdlines) == 1 and not sinkCmdlines[0][0].startswith(_SINK_FILE_PREFIX):
+        return subprocess.Popen(sinkCmdlines[0] + ['-'], stdin=subprocess.PIPE, bufsize=0, pipesize=pipeSize)
+    sink = FanoutSink(bufferBytes, policy)
+    for cmdline in sinkCmdlines:
+        if cmdline[0].startswith(_SINK_FILE_PREFIX):
+            sink.add_file(cmdline[0][len(_SINK_FILE_PREFIX):])
+        else:
+            sink.add_process(cmdline + ['-'])
+    return sink
+
 class Operation(Enum):
     PLAY_RESOURCE = 0
     LIST_CHANNELS = 1
     AUTHENTICATE = 2
     LIST_ALTERNATIVES = 3
+    SERVE = 4
+    PROBE = 5
+    LIST_PROVIDERS = 6
 
 def main():
     logLevel = logging.INFO
@@ -73,17 +165,31 @@ def main():
     useAuthCookie = False
     username, password = '', ''
     alternative = -1
-    sinkCmdline = [_DEFAULT_SINK]
+    sinkCmdlines = []
+    sinkArgs = []
+    sinkBuffer = _DEFAULT_SINK_BUFFER
+    sinkPolicy = _DEFAULT_SINK_POLICY
+    lowLatency = False
+    serveAddress = None
+    serveCache = _DEFAULT_SERVE_CACHE
+    timeshiftSize, timeshiftFile = 0, None
+    metricsInterval, metricsAddress = 0, None
+    probeWorkers, probeSegments = _DEFAULT_PROBE_WORKERS, _DEFAULT_PROBE_SEGMENTS
+    profileStartup = False
     op = Operation.PLAY_RESOURCE
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'hp:s:la:',
-                                   ['help', 'log-level=', 'param=',
+                                   ['help', 'log-level=', 'profile-startup', 'param=', 'no-cache',
                                     'list-providers', 'provider=',
-                                    'sink=', 'sink-args=',
+                                    'sink=', 'sink-args=', 'sink-buffer=', 'sink-policy=', 'low-latency',
                                     'list-channels',
                                     'authenticate-as=', 'password=', 'use-auth-cookie',
-                                    'list-alternatives', 'alternative='])
+                                    'list-alternatives', 'alternative=',
+                                    'timeshift=', 'timeshift-file=',
+                                    'metrics-log=', 'metrics-port=',
+                                    'serve=', 'serve-cache=',
+                                    'probe', 'probe-workers=', 'probe-segments='])
     except getopt.GetoptError as err:
         print(err)
         usage()
@@ -93,19 +199,27 @@ def main():
             usage()
         elif o == '--log-level':
             logLevel = int(a)
+        elif o == '--profile-startup':
+            profileStartup = True
         elif o == '--param':
             k, v = a.split('=', 1)
             params[k] = v
+        elif o == '--no-cache':
+            params['cache'] = 'off'
         elif o == '--list-providers':
-            for k in _PROVIDERS:
-                print(k)
-            sys.exit(0)
+            op = Operation.LIST_PROVIDERS
         elif o in ('-p', '--provider'):
             providerName = a
         elif o in ('-s', '--sink'):
-            sinkCmdline[0] = a
+            sinkCmdlines += [[a]]
         elif o == '--sink-args':
-            sinkCmdline += shlex.split(a)
+            (sinkCmdlines[-1] if sinkCmdlines else sinkArgs).extend(shlex.split(a))
+        elif o == '--sink-buffer':
+            sinkBuffer = int(a)
+        elif o == '--sink-policy':
+            sinkPolicy = a
+        elif o == '--low-latency':
+            lowLatency = True
         elif o in ('-l', '--list-channels'):
             op = Operation.LIST_CHANNELS
         elif o == '--authenticate-as':
@@ -119,16 +233,74 @@ def main():
             op = Operation.LIST_ALTERNATIVES
         elif o in ('-a', '--alternative'):
             alternative = int(a)
+        elif o == '--timeshift':
+            timeshiftSize = int(a)
+        elif o == '--timeshift-file':
+            timeshiftFile = a
+        elif o == '--metrics-log':
+            metricsInterval = float(a)
+        elif o == '--metrics-port':
+            host, _, port = a.rpartition(':')
+            metricsAddress = (host or '127.0.0.1', int(port))
+        elif o == '--serve':
+            op = Operation.SERVE
+            host, _, port = a.rpartition(':')
+            serveAddress = (host, int(port))
+        elif o == '--serve-cache':
+            serveCache = int(a)
+        elif o == '--probe':
+            op = Operation.PROBE
+        elif o == '--probe-workers':
+            probeWorkers = int(a)
+        elif o == '--probe-segments':
+            probeSegments = int(a)
+
+    if not sinkCmdlines:
+        sinkCmdlines = [[_DEFAULT_SINK]]
+    # Arguments given before any `--sink` apply to the first sink
+    sinkCmdlines[0][1:1] = sinkArgs
+    # Explicit `--param`s take precedence
+    if lowLatency:
+        params = _LOW_LATENCY_PARAMS | params
 
     logging.basicConfig(format='[%(levelname)s] %(message)s', level=logLevel)
     if not username and password:
         logging.warning('No username specified via --authenticate-as=; ignoring password.')
 
-    p = _PROVIDERS[providerName](params)
+    if metricsInterval or metricsAddress:
+        from common.metrics import metrics
+        if metricsInterval:
+            metrics.log_periodically(metricsInterval)
+        if metricsAddress:
+            metrics.serve(metricsAddress)
+
+    profile.mark('options-parsed')
+    # `sys.modules` tells how much the operation requested pulls in
+    report = lambda: logging.info('Startup profile: %s; %d modules loaded'
+                                  % (profile.report(), len(sys.modules)))
+
+    if op == Operation.LIST_PROVIDERS:
+        if profileStartup:
+            report()
+        for k in provider.PROVIDERS:
+            print(k)
+        sys.exit(0)
+
+    try:
+        with profile.stage('provider-import'):
+            providerClass = provider.load(providerName)
+    except (ValueError, ImportError, AttributeError) as err:
+        print("'%s': cannot load provider: %s" % (providerName, err))
+        sys.exit(1)
+    with profile.stage('provider-init'):
+        p = providerClass(params)
     try:
         if op != Operation.AUTHENTICATE and useAuthCookie:
             logging.info('Using previous authentication cookie')
-            p.import_auth_cookie()
+            with profile.stage('auth-cookie'):
+                p.import_auth_cookie()
+        if profileStartup:
+            report()
 
         if op == Operation.LIST_CHANNELS:
             logging.info('Fetching channel list...')
@@ -137,11 +309,29 @@ def main():
         elif op == Operation.AUTHENTICATE:
             logging.info('Authenticating...')
             p.authenticate(username, password)
+        elif op == Operation.PROBE:
+            import json
+            from common.probe import probe_channels
+            logging.info('Probing channels...')
+            for result in probe_channels(p, args or None, probeWorkers, probeSegments):
+                print(json.dumps(result))
+        elif op == Operation.SERVE:
+            from common.relay import RelayServer
+            server = RelayServer(serveAddress, p, alternative, serveCache, sinkBuffer=sinkBuffer)
+            logging.info('Relaying channels on http://%s:%d/channels.m3u' % server.server_address[:2])
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
         else:
             if len(args) != 1:
                 usage()
+            import random, subprocess, threading, time
+            from common.metrics import metrics
+            from common.timeshift import TimeshiftBuffer
 
             logging.info('Getting stream information (%s)...' % args[0])
+            startup.reset()
             info = p.get_stream_info(args[0])
             logging.info(':: Title: %s' % info['title'])
 
@@ -151,20 +341,51 @@ def main():
                 sys.exit(0)
 
             logging.info('Creating A/V source (%d)' % alternative)
-            source = p.get_av_source(info, alternative)
+            with startup.stage('av-source'):
+                source = p.get_av_source(info, alternative)
 
-            sinkCmdline += ['-']
-            sink = subprocess.Popen(sinkCmdline, stdin=subprocess.PIPE, bufsize=0, pipesize=1048576)
+            with startup.stage('sink'):
+                sink = create_sink(sinkCmdlines, sinkBuffer, sinkPolicy,
+                                   _LOW_LATENCY_PIPE_SIZE if lowLatency else _SINK_PIPE_SIZE)
+                if timeshiftSize:
+                    sink = TimeshiftBuffer(sink, timeshiftSize, timeshiftFile)
+                    threading.Thread(target=timeshift_control, args=(sink,), daemon=True).start()
+            startup.notify('first-sink-write',
+                           lambda: logging.info('Startup (%s): %s' % (args[0], startup.report())))
+            failures = 0
             while True:
                 startTime = time.perf_counter()
                 retry = source.run(sink)
                 endTime = time.perf_counter()
+                logging.debug('A/V source stats: %s' % source.stats())
+                if not isinstance(sink, subprocess.Popen):
+                    logging.debug('Sink stats: %s' % sink.stats())
+                if not retry:
+                    break
 
-                if not retry or (endTime - startTime) < _AVSOURCE_RETRY_THRESHOLD:
+                # Only failures in a row count against the limit
+                if (endTime - startTime) >= _AVSOURCE_RETRY_THRESHOLD:
+                    failures = 0
+                failures += 1
+                metrics.inc('restarts')
+                if failures > _AVSOURCE_MAX_RETRIES:
+                    logging.error('A/V source died %d times in a row; giving up' % (failures - 1))
                     break
-                logging.info('A/V source died prematurely; retrying...')
+                delay = min(_AVSOURCE_MAX_BACKOFF, 2 ** (failures - 1)) * random.uniform(0.5, 1.5)
+                logging.info('A/V source died prematurely; retrying in %.1fs...' % delay)
+                time.sleep(delay)
+
+                startup.reset()
+                startup.notify('first-sink-write',
+                               lambda: logging.info('Restart (%s): %s' % (args[0], startup.report())))
+                if source.resumable():
+                    continue
+                logging.info('Cannot resume A/V source; getting stream information again...')
                 info = p.get_stream_info(args[0])
                 source = p.get_av_source(info, alternative)
+            if not isinstance(sink, subprocess.Popen):
+                # Write out whatever is still buffered, e.g. the tail of a recording
+                sink.close()
     except (ValueError, RuntimeError) as err:
         print(err)
 